@@ -0,0 +1,152 @@
+# benchmark the image encoders and profiles of convert_agf_to_png on real images
+import os
+import sys
+import json
+import time
+import argparse
+import platform
+import datetime
+
+import numpy as np
+import cv2
+import PIL
+
+import shared
+import convert_agf_to_png
+import benchmark_lzss
+
+
+def decode_agf_data_list(agf_content_list: list):
+    # returns a list of {'bgr': ..., 'rgb': ...} images
+    # both channel orders are decoded up front so only the encoders are timed
+    image_list = []
+    for agf_content_bs in agf_content_list:
+        try:
+            image_list.append({
+                'bgr': convert_agf_to_png.convert_agf_data_to_numpy_array(agf_content_bs, force_rgb=False).copy(),
+                'rgb': convert_agf_to_png.convert_agf_data_to_numpy_array(agf_content_bs, force_rgb=True).copy(),
+            })
+        except Exception as ex:
+            print(f'{shared.FG_YELLOW}WARNING: Failed to decode an AGF file - {ex}{shared.RESET_COLOR}')
+
+    return image_list
+
+
+def benchmark_encoder_profile(
+    image_list: list,
+    encoder: str,
+    profile: str,
+    repeat: int,
+):
+    channel_order = 'rgb' if convert_agf_to_png.ENCODER_CONFIG_DICT[encoder]['force_rgb'] else 'bgr'
+
+    total_seconds = 0.0
+    total_output_size = 0
+    total_input_size = 0
+    for image_info in image_list:
+        image = image_info[channel_order]
+        total_input_size += image.nbytes
+
+        # best of `repeat` runs
+        best_elapsed = None
+        for _ in range(repeat):
+            start = time.perf_counter()
+            encoded_bs = convert_agf_to_png.encode_image(image, encoder, profile)
+            elapsed = time.perf_counter() - start
+            if best_elapsed is None or elapsed < best_elapsed:
+                best_elapsed = elapsed
+
+        total_seconds += best_elapsed
+        total_output_size += len(memoryview(encoded_bs).cast('B'))
+
+    number_of_images = len(image_list)
+    result = {
+        'encoder': encoder,
+        'profile': profile,
+        'number_of_images': number_of_images,
+        'seconds': total_seconds,
+        'ms_per_image': total_seconds * 1000 / number_of_images,
+        'images_per_second': number_of_images / total_seconds if total_seconds > 0 else float('inf'),
+        'input_size': total_input_size,
+        'output_size': total_output_size,
+        'ratio': total_output_size / total_input_size if total_input_size > 0 else 0.0,
+    }
+
+    print(f'    {encoder:<12} {profile:<9} {result["ms_per_image"]:10.2f} ms/image {result["images_per_second"]:9.1f} images/s {total_output_size / 1e6:10.2f} MB {result["ratio"]:7.3f} of raw')
+    return result
+
+
+def get_environment_info():
+    return {
+        'datetime': datetime.datetime.now().isoformat(),
+        'python': sys.version,
+        'platform': platform.platform(),
+        'processor': platform.processor(),
+        'numpy': np.__version__,
+        'opencv': cv2.__version__,
+        'pillow': PIL.__version__,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the encode time and output size of every image encoder and profile.')
+    parser.add_argument('inpath', nargs='*', help='AGF files to encode')
+    parser.add_argument('--alf', default=None, help='ALF file to sample AGF entries from (requires --metadata)')
+    parser.add_argument('--metadata', default=None, help='metadata store or pickle log generated by process_metadata_file.py that lists the entries of --alf')
+    parser.add_argument('--sample', type=int, default=20, help='number of AGF entries sampled from --alf (0 for all)')
+    parser.add_argument('--seed', type=int, default=0, help='seed for the ALF sampling')
+    parser.add_argument('--encoder', action='append', choices=convert_agf_to_png.ENCODER_LIST, help='encoder to benchmark (default: all)')
+    parser.add_argument('--profile', action='append', choices=convert_agf_to_png.PROFILE_LIST, help='profile to benchmark (default: all)')
+    parser.add_argument('--repeat', type=int, default=1, help='number of timing runs per image (the best one is reported)')
+    parser.add_argument('--json', default=None, help='write the results to this JSON file')
+
+    args = parser.parse_args()
+    print('args', args)
+
+    if (args.alf is None) != (args.metadata is None):
+        print(f'{shared.FG_RED}ERROR: --alf and --metadata must be given together{shared.RESET_COLOR}')
+        return
+
+    agf_content_list = []
+    for inpath in args.inpath:
+        if not os.path.isfile(inpath):
+            print(f'{shared.FG_RED}ERROR: File does not exist: {inpath}{shared.RESET_COLOR}')
+            continue
+        with open(inpath, mode='rb') as infile:
+            agf_content_list.append(infile.read())
+
+    if args.alf is not None:
+        agf_content_list.extend(benchmark_lzss.read_agf_data_list_from_alf_file(
+            alf_filepath=args.alf,
+            metadata_filepath=args.metadata,
+            sample_count=args.sample,
+            seed=args.seed,
+        ))
+
+    image_list = decode_agf_data_list(agf_content_list)
+    print('len(image_list)', len(image_list))
+    if len(image_list) == 0:
+        print(f'{shared.FG_RED}ERROR: No image to encode{shared.RESET_COLOR}')
+        return
+
+    encoder_list = args.encoder or convert_agf_to_png.ENCODER_LIST
+    profile_list = args.profile or convert_agf_to_png.PROFILE_LIST
+
+    result_list = []
+    for encoder in encoder_list:
+        for profile in profile_list:
+            result_list.append(benchmark_encoder_profile(image_list, encoder, profile, args.repeat))
+
+    if args.json is not None:
+        report = {
+            'environment': get_environment_info(),
+            'args': vars(args),
+            'result_list': result_list,
+        }
+        with open(args.json, mode='w', encoding='utf-8') as outfile:
+            json.dump(report, outfile, indent=4)
+        print('json', os.path.abspath(args.json))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,416 @@
+# benchmark the LZSS decoders and encoder
+import os
+import io
+import sys
+import json
+import time
+import random
+import argparse
+import platform
+import datetime
+
+import shared
+import metadata_store
+import lzss
+
+
+def generate_lzss_stream(
+    section_size: int,
+    literal_ratio: float,
+    max_distance: int = None,
+    seed=0,
+):
+    # generate a valid LZSS stream from random tokens that decodes to at least `section_size` bytes
+    # match tokens point to random places in the ring buffer which is fine for benchmarking
+    # with `max_distance` matches only copy from the last few bytes like
+    # runs of flat colour in AGF pixel sections
+    rng = random.Random(seed)
+    stream = bytearray()
+    original_length = 0
+
+    while original_length < section_size:
+        flag_position = len(stream)
+        stream.append(0)
+        flag_byte = 0
+        for bit in range(8):
+            if original_length >= section_size:
+                break
+
+            if rng.random() < literal_ratio:
+                flag_byte |= 1 << bit
+                stream.append(rng.getrandbits(8))
+                original_length += 1
+            else:
+                if max_distance is None:
+                    i = rng.getrandbits(12)
+                else:
+                    distance = rng.randint(1, max_distance)
+                    i = (lzss.INITIAL_RING_POSITION + original_length - distance) & lzss.RING_BUFFER_MASK
+                j = rng.getrandbits(4)
+                stream.append(i & 0xff)
+                stream.append(((i >> 4) & 0xf0) | j)
+                original_length += j + lzss.THRESHOLD + 1
+
+        stream[flag_position] = flag_byte
+
+    return bytes(stream), original_length
+
+
+def count_lzss_tokens(section_content_bs: bytes):
+    # number of literal and match tokens in the stream
+    number_of_tokens = 0
+    src_len = len(section_content_bs)
+    s = 0
+    while s < src_len:
+        flag_byte = section_content_bs[s]
+        s += 1
+        for bit in range(8):
+            token_size = 1 if ((flag_byte >> bit) & 1) else 2
+            if (s + token_size) > src_len:
+                s = src_len
+                break
+            s += token_size
+            number_of_tokens += 1
+
+    return number_of_tokens
+
+
+def read_lzss_section_list_from_agf_data(agf_content_bs: bytes):
+    # collect the compressed sections of an AGF file
+    section_list = []
+    agf_content_view = memoryview(agf_content_bs)
+    offset = 12
+    while (offset + 12) <= len(agf_content_view):
+        original_length, original_length2, length = shared.unpack_lzss_section_header(agf_content_view, offset)
+        content_offset = offset + 12
+        offset = content_offset + length
+        if offset > len(agf_content_view):
+            break
+
+        if original_length != length:
+            section_list.append((bytes(agf_content_view[content_offset:offset]), original_length))
+
+        # skip the ACIF header in 32 bit AGF files
+        if agf_content_view[offset:offset + 4] == b'ACIF':
+            offset += 24
+
+    return section_list
+
+
+def read_agf_data_list_from_alf_file(
+    alf_filepath: str,
+    metadata_filepath: str,
+    sample_count: int,
+    seed=0,
+):
+    # sample AGF entries of an ALF file using the metadata store or pickle log from process_metadata_file.py
+    # only the entries of this ALF file are read from a metadata store
+    log_list = metadata_store.load_metadata_file_list(metadata_filepath)
+
+    alf_filename = os.path.basename(alf_filepath).lower()
+    archive_list = []
+    for metadata_info in log_list:
+        alf_filename_list = [entry['name'].decode('ascii').lower() for entry in metadata_info['alf_file_info_list']]
+        if alf_filename not in alf_filename_list:
+            continue
+
+        alf_filename_index = alf_filename_list.index(alf_filename)
+        for entry in metadata_store.get_alf_archive_entry_info_list(metadata_info, alf_filename_index):
+            if not entry['name'].lower().endswith(b'.agf'):
+                continue
+            archive_list.append(entry)
+
+    if len(archive_list) == 0:
+        raise Exception(f'no AGF entry of {alf_filepath} found in {metadata_filepath}')
+
+    if 0 < sample_count < len(archive_list):
+        archive_list = random.Random(seed).sample(archive_list, sample_count)
+
+    agf_content_list = []
+    with open(alf_filepath, mode='rb') as alf_infile:
+        for archive_info in archive_list:
+            alf_infile.seek(archive_info['offset'])
+            agf_content_list.append(alf_infile.read(archive_info['length']))
+
+    return agf_content_list
+
+
+def read_lzss_section_list_from_alf_file(
+    alf_filepath: str,
+    metadata_filepath: str,
+    sample_count: int,
+    seed=0,
+):
+    section_list = []
+    for agf_content_bs in read_agf_data_list_from_alf_file(alf_filepath, metadata_filepath, sample_count, seed):
+        section_list.extend(read_lzss_section_list_from_agf_data(agf_content_bs))
+
+    return section_list
+
+
+def create_decoder_dict(backend_list: list, include_reference=True):
+    decoder_dict = {}
+    if include_reference:
+        decoder_dict['decode'] = lambda section_content_bs, original_length: lzss.decode(io.BytesIO(section_content_bs))
+    decoder_dict['decode_bytes'] = lzss.decode_bytes
+
+    for backend in backend_list:
+        decode_into_function = lzss.load_backend(backend)
+
+        def decoder(section_content_bs, original_length, decode_into_function=decode_into_function):
+            out = bytearray(original_length)
+            decode_into_function(section_content_bs, out)
+            return out
+
+        decoder_dict[f'backend:{backend}'] = decoder
+
+    return decoder_dict
+
+
+def time_function(function, repeat: int):
+    # best of `repeat` runs
+    best_elapsed = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        elapsed = time.perf_counter() - start
+        if best_elapsed is None or elapsed < best_elapsed:
+            best_elapsed = elapsed
+
+    return best_elapsed
+
+
+def benchmark_decoders(
+    dataset_name: str,
+    section_list: list,
+    decoder_dict: dict,
+    repeat: int,
+):
+    total_original_length = sum(original_length for _, original_length in section_list)
+    total_compressed_length = sum(len(section_content_bs) for section_content_bs, _ in section_list)
+    total_number_of_tokens = sum(count_lzss_tokens(section_content_bs) for section_content_bs, _ in section_list)
+    print(f'{shared.FG_BLUE}{dataset_name}{shared.RESET_COLOR} sections={len(section_list)} original={total_original_length} compressed={total_compressed_length} tokens={total_number_of_tokens}')
+
+    # make sure all decoders agree before timing them
+    # this also triggers the JIT compilation of the numba backend
+    for section_content_bs, original_length in section_list:
+        expected_bs = bytes(lzss.decode_bytes(section_content_bs, original_length))
+        for decoder_name, decoder in decoder_dict.items():
+            if bytes(decoder(section_content_bs, original_length)) != expected_bs:
+                raise Exception(f'{decoder_name} output does not match lzss.decode_bytes')
+
+    result_list = []
+    for decoder_name, decoder in decoder_dict.items():
+        def run_decoder(decoder=decoder):
+            for section_content_bs, original_length in section_list:
+                decoder(section_content_bs, original_length)
+
+        elapsed = time_function(run_decoder, repeat)
+        mb_per_second = total_original_length / elapsed / 1e6
+        ns_per_token = (elapsed * 1e9 / total_number_of_tokens) if total_number_of_tokens > 0 else 0.0
+        print(f'    {shared.FG_GREEN}{decoder_name:<16}{shared.RESET_COLOR} {elapsed:10.4f} s {mb_per_second:10.2f} MB/s {ns_per_token:10.1f} ns/token')
+
+        result_list.append({
+            'dataset': dataset_name,
+            'decoder': decoder_name,
+            'number_of_sections': len(section_list),
+            'original_length': total_original_length,
+            'compressed_length': total_compressed_length,
+            'number_of_tokens': total_number_of_tokens,
+            'seconds': elapsed,
+            'mb_per_second': mb_per_second,
+            'ns_per_token': ns_per_token,
+        })
+
+    return result_list
+
+
+def benchmark_encoder(
+    dataset_name: str,
+    section_list: list,
+    effort_list: list,
+    repeat: int,
+):
+    # encode the decoded sections again and compare with the original compressed size
+    decoded_section_list = [lzss.decode_bytes(section_content_bs, original_length) for section_content_bs, original_length in section_list]
+    total_original_length = sum(len(decoded_bs) for decoded_bs in decoded_section_list)
+    total_source_length = sum(len(section_content_bs) for section_content_bs, _ in section_list)
+    print(f'{shared.FG_BLUE}{dataset_name}{shared.RESET_COLOR} sections={len(section_list)} original={total_original_length}')
+    source_ratio = (total_source_length / total_original_length) if total_original_length > 0 else 0.0
+    print(f'    {"source":<16} {total_source_length:12d} bytes {source_ratio:8.4f} ratio')
+
+    result_list = []
+    for effort in effort_list:
+        encoded_section_list = []
+
+        def run_encoder():
+            encoded_section_list.clear()
+            for decoded_bs in decoded_section_list:
+                encoded_section_list.append(lzss.encode(decoded_bs, effort=effort))
+
+        elapsed = time_function(run_encoder, repeat)
+
+        for encoded_bs, decoded_bs in zip(encoded_section_list, decoded_section_list):
+            if lzss.decode_bytes(encoded_bs, len(decoded_bs)) != decoded_bs:
+                raise Exception(f'effort {effort} output does not decode to the input')
+
+        total_encoded_length = sum(len(encoded_bs) for encoded_bs in encoded_section_list)
+        mb_per_second = (total_original_length / elapsed / 1e6) if elapsed > 0 else 0.0
+        ratio = (total_encoded_length / total_original_length) if total_original_length > 0 else 0.0
+        print(f'    {shared.FG_GREEN}{f"effort {effort}":<16}{shared.RESET_COLOR} {total_encoded_length:12d} bytes {ratio:8.4f} ratio {elapsed:10.4f} s {mb_per_second:10.2f} MB/s')
+
+        result_list.append({
+            'dataset': dataset_name,
+            'encoder': f'effort {effort}',
+            'number_of_sections': len(section_list),
+            'original_length': total_original_length,
+            'source_compressed_length': total_source_length,
+            'compressed_length': total_encoded_length,
+            'ratio': ratio,
+            'seconds': elapsed,
+            'mb_per_second': mb_per_second,
+        })
+
+    return result_list
+
+
+def get_environment_info():
+    environment_info = {
+        'datetime': datetime.datetime.now().isoformat(),
+        'python': sys.version,
+        'platform': platform.platform(),
+        'processor': platform.processor(),
+        'lzss_backend_list': lzss.find_available_backends(),
+    }
+
+    for module_name in ['numpy', 'numba']:
+        try:
+            module = __import__(module_name)
+            environment_info[module_name] = module.__version__
+        except ImportError:
+            environment_info[module_name] = None
+
+    return environment_info
+
+
+def print_comparison(result_list: list, previous_result_list: list):
+    # speed of this run relative to a previous JSON report
+    def get_result_key(result):
+        return (result['dataset'], result.get('decoder', result.get('encoder')))
+
+    previous_result_dict = {get_result_key(result): result for result in previous_result_list}
+    print(f'{shared.FG_BLUE}comparison with the previous run{shared.RESET_COLOR}')
+    for result in result_list:
+        result_key = get_result_key(result)
+        previous_result = previous_result_dict.get(result_key)
+        if previous_result is None:
+            continue
+
+        speedup = previous_result['seconds'] / result['seconds']
+        color = shared.FG_GREEN if speedup >= 1 else shared.FG_RED
+        print(f'    {result_key[0]:<48} {result_key[1]:<16} {color}{speedup:8.2f}x{shared.RESET_COLOR}')
+
+
+DEFAULT_LITERAL_RATIO_LIST = [0.05, 0.3, 0.7]
+DEFAULT_SECTION_SIZE_LIST = [64 * 1024, 1024 * 1024]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the LZSS decoders and encoder on synthetic and real data.')
+    parser.add_argument('inpath', nargs='*', help='AGF files to take the compressed sections from')
+    parser.add_argument('--alf', default=None, help='ALF file to sample AGF entries from (requires --metadata)')
+    parser.add_argument('--metadata', default=None, help='metadata store or pickle log generated by process_metadata_file.py that lists the entries of --alf')
+    parser.add_argument('--sample', type=int, default=50, help='number of AGF entries sampled from --alf (0 for all)')
+    parser.add_argument('--synthetic', action='store_true', help='also run the synthetic streams when real data is given')
+    parser.add_argument('--literal-ratio', type=float, action='append', help=f'ratio of literal tokens in the synthetic streams (default: {DEFAULT_LITERAL_RATIO_LIST})')
+    parser.add_argument('--section-size', type=int, action='append', help=f'decoded size of the synthetic sections in bytes (default: {DEFAULT_SECTION_SIZE_LIST})')
+    parser.add_argument('--max-distance', type=int, default=None, help='only generate matches copying from the last MAX_DISTANCE bytes (flat colour)')
+    parser.add_argument('--seed', type=int, default=0, help='seed for the synthetic streams and the ALF sampling')
+    parser.add_argument('--repeat', type=int, default=3, help='number of timing runs (the best one is reported)')
+    parser.add_argument('--encode', action='store_true', help='benchmark the encoder instead of the decoders')
+    parser.add_argument('--effort', type=int, action='append', choices=range(lzss.MIN_EFFORT, lzss.MAX_EFFORT + 1), help='encoder effort level to benchmark (default: all)')
+    parser.add_argument('--backend', action='append', choices=lzss.BACKEND_LIST, help='decoder backend to benchmark (default: all available backends)')
+    parser.add_argument('--no-reference', action='store_true', help='do not time the original byte by byte lzss.decode')
+    parser.add_argument('--json', default=None, help='write the results to this JSON file')
+    parser.add_argument('--compare', default=None, help='JSON file of a previous run to compare the results with')
+
+    args = parser.parse_args()
+    print('args', args)
+
+    if (args.alf is None) != (args.metadata is None):
+        print(f'{shared.FG_RED}ERROR: --alf and --metadata must be given together{shared.RESET_COLOR}')
+        return
+
+    # list of (dataset name, section list)
+    dataset_list = []
+
+    agf_section_list = []
+    for inpath in args.inpath:
+        if not os.path.isfile(inpath):
+            print(f'{shared.FG_RED}ERROR: File does not exist: {inpath}{shared.RESET_COLOR}')
+            continue
+        with open(inpath, mode='rb') as infile:
+            agf_section_list.extend(read_lzss_section_list_from_agf_data(infile.read()))
+
+    if len(agf_section_list) > 0:
+        dataset_list.append(('agf-files', agf_section_list))
+
+    if args.alf is not None:
+        alf_section_list = read_lzss_section_list_from_alf_file(
+            alf_filepath=args.alf,
+            metadata_filepath=args.metadata,
+            sample_count=args.sample,
+            seed=args.seed,
+        )
+        dataset_list.append((f'alf:{os.path.basename(args.alf)}', alf_section_list))
+
+    if len(dataset_list) == 0 or args.synthetic:
+        literal_ratio_list = args.literal_ratio or DEFAULT_LITERAL_RATIO_LIST
+        section_size_list = args.section_size or DEFAULT_SECTION_SIZE_LIST
+        for section_size in section_size_list:
+            for literal_ratio in literal_ratio_list:
+                dataset_name = f'synthetic:size={section_size}:literal={literal_ratio}'
+                if args.max_distance is not None:
+                    dataset_name += f':max_distance={args.max_distance}'
+                section = generate_lzss_stream(section_size, literal_ratio, args.max_distance, seed=args.seed)
+                dataset_list.append((dataset_name, [section]))
+
+    result_list = []
+    if args.encode:
+        effort_list = args.effort
+        if effort_list is None:
+            effort_list = list(range(lzss.MIN_EFFORT, lzss.MAX_EFFORT + 1))
+
+        for dataset_name, section_list in dataset_list:
+            result_list.extend(benchmark_encoder(dataset_name, section_list, effort_list, args.repeat))
+    else:
+        backend_list = args.backend
+        if backend_list is None:
+            backend_list = lzss.find_available_backends()
+        print('backend_list', backend_list)
+
+        decoder_dict = create_decoder_dict(backend_list, include_reference=not args.no_reference)
+        for dataset_name, section_list in dataset_list:
+            if len(section_list) == 0:
+                print(f'{shared.FG_YELLOW}WARNING: No LZSS section in {dataset_name}{shared.RESET_COLOR}')
+                continue
+            result_list.extend(benchmark_decoders(dataset_name, section_list, decoder_dict, args.repeat))
+
+    if args.compare is not None:
+        with open(args.compare, mode='r', encoding='utf-8') as infile:
+            previous_report = json.load(infile)
+        print_comparison(result_list, previous_report['result_list'])
+
+    if args.json is not None:
+        report = {
+            'environment': get_environment_info(),
+            'args': vars(args),
+            'result_list': result_list,
+        }
+        with open(args.json, mode='w', encoding='utf-8') as outfile:
+            json.dump(report, outfile, indent=4)
+        print('json', os.path.abspath(args.json))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,221 @@
+# benchmark the parsing of SYS4INI.BIN and *.AAI metadata files
+import os
+import sys
+import json
+import time
+import random
+import struct
+import argparse
+import platform
+import datetime
+import tempfile
+
+import shared
+import lzss
+import process_metadata_file
+
+DEFAULT_NUMBER_OF_ENTRIES = 200000
+DEFAULT_NUMBER_OF_FILES = 4
+DEFAULT_NUMBER_OF_ALF_FILES = 8
+
+
+def generate_metadata_file(
+    filepath: str,
+    number_of_archive_entries: int,
+    number_of_alf_files: int = DEFAULT_NUMBER_OF_ALF_FILES,
+    seed=0,
+):
+    # write a SYS4INI.BIN like file that process_metadata_file can parse
+    # the names have random bytes after the null terminator like the real ones
+    rng = random.Random(seed)
+    body_data_bs = bytearray()
+    body_data_bs += struct.pack('<I', number_of_alf_files)
+    for alf_index in range(number_of_alf_files):
+        body_data_bs += f'DATA{alf_index + 1}.ALF'.encode('ascii').ljust(256, b'\x00')
+
+    body_data_bs += struct.pack('<I', number_of_archive_entries)
+    alf_offset_list = [0] * number_of_alf_files
+    for file_index in range(number_of_archive_entries):
+        archive_index = rng.randrange(number_of_alf_files)
+        length = rng.randint(256, 1 << 16)
+        filename_bs = f'IMG{file_index:06d}.AGF'.encode('ascii') + b'\x00'
+        filename_bs += bytes(rng.getrandbits(8) for _ in range(rng.randint(0, 8)))
+        body_data_bs += shared.ARCHIVE_ENTRY_STRUCT.pack(filename_bs, archive_index, file_index, alf_offset_list[archive_index], length)
+        alf_offset_list[archive_index] += length
+
+    with open(filepath, mode='wb') as outfile:
+        outfile.write(b'S4IC'.ljust(240, b'\x00'))
+        outfile.write(bytes(60))
+        shared.write_lzss_section(outfile, bytes(body_data_bs), effort=lzss.MIN_EFFORT)
+
+
+def parse_metadata_body_reference(body_data_bs: bytes):
+    # the original parser, one unpack and a byte by byte name per entry
+    def trim_filename_data(filename_data_bs: bytes):
+        result = b''
+        for value in filename_data_bs:
+            if value == 0:
+                break
+            result += bytes([value])
+
+        return result
+
+    offset = 4 + struct.unpack_from('<I', body_data_bs, 0)[0] * 256
+    number_of_archive_entries = struct.unpack_from('<I', body_data_bs, offset)[0]
+    offset += 4
+    archive_entry_info_list = []
+    for i in range(number_of_archive_entries):
+        filename_data_bs, archive_index, file_index, entry_offset, entry_length = shared.ARCHIVE_ENTRY_STRUCT.unpack_from(body_data_bs, offset)
+        offset += shared.ARCHIVE_ENTRY_STRUCT.size
+        archive_entry_info_list.append(shared.ArchiveEntryInfo(
+            trim_filename_data(filename_data_bs),
+            archive_index,
+            file_index,
+            entry_offset,
+            entry_length,
+        ))
+
+    return archive_entry_info_list
+
+
+def time_best(function, repeat: int):
+    # returns (best seconds, result of the last run)
+    best_elapsed = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = function()
+        elapsed = time.perf_counter() - start
+        if best_elapsed is None or elapsed < best_elapsed:
+            best_elapsed = elapsed
+
+    return best_elapsed, result
+
+
+def benchmark_metadata_file(
+    metadata_filepath: str,
+    repeat: int,
+    reference: bool,
+):
+    read_seconds, (_, _, body_data_bs) = time_best(lambda: process_metadata_file.read_metadata_file(metadata_filepath), repeat)
+    parse_seconds, (_, archive_entry_info_list) = time_best(lambda: process_metadata_file.parse_metadata_body(body_data_bs), repeat)
+    number_of_entries = len(archive_entry_info_list)
+
+    result = {
+        'path': os.path.abspath(metadata_filepath),
+        'number_of_entries': number_of_entries,
+        'body_size': len(body_data_bs),
+        'read_seconds': read_seconds,
+        'parse_seconds': parse_seconds,
+        'entries_per_second': number_of_entries / parse_seconds if parse_seconds > 0 else float('inf'),
+    }
+    print(f'    {os.path.basename(metadata_filepath):<16} {number_of_entries:9d} entries  read+LZSS {read_seconds:8.3f} s  parse {parse_seconds:8.3f} s {result["entries_per_second"] / 1e6:8.2f} M entries/s')
+
+    if reference:
+        reference_seconds, reference_archive_entry_info_list = time_best(lambda: parse_metadata_body_reference(body_data_bs), 1)
+        if reference_archive_entry_info_list != archive_entry_info_list:
+            raise Exception(f'the entries of {metadata_filepath} differ from the reference parser')
+        result['reference_parse_seconds'] = reference_seconds
+        print(f'    {"":<16} {"":9} reference parse {reference_seconds:8.3f} s  speedup {reference_seconds / parse_seconds:6.1f}x')
+
+    return result
+
+
+def benchmark_jobs(
+    metadata_filepath_list: list,
+    jobs: int,
+    repeat: int,
+):
+    def process_all():
+        for metadata_filepath, _, _, ex in process_metadata_file.iter_processed_metadata_files(metadata_filepath_list, jobs):
+            if ex is not None:
+                raise Exception(f'failed to process metadata file {metadata_filepath} - {ex}')
+
+    seconds, _ = time_best(process_all, repeat)
+    print(f'    jobs {jobs:<3} {len(metadata_filepath_list)} files {seconds:8.3f} s')
+    return {
+        'jobs': jobs,
+        'number_of_files': len(metadata_filepath_list),
+        'seconds': seconds,
+    }
+
+
+def get_environment_info():
+    return {
+        'datetime': datetime.datetime.now().isoformat(),
+        'python': sys.version,
+        'platform': platform.platform(),
+        'processor': platform.processor(),
+        'cpu_count': os.cpu_count(),
+        'lzss_backend': lzss.get_backend(),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the parsing of SYS4INI.BIN and *.AAI metadata files.')
+    parser.add_argument('inpath', nargs='*', help='metadata files or directories to search for sys4ini.bin or *.aai files')
+    parser.add_argument('--synthetic-dir', default=None, help='directory for the generated metadata files, existing ones are reused (default: a temporary directory)')
+    parser.add_argument('--entries', type=int, default=DEFAULT_NUMBER_OF_ENTRIES, help='number of archive entries per generated metadata file')
+    parser.add_argument('--files', type=int, default=DEFAULT_NUMBER_OF_FILES, help='number of generated metadata files')
+    parser.add_argument('--seed', type=int, default=0, help='seed for the generated metadata files')
+    parser.add_argument('--jobs', type=int, action='append', help=f'number of worker processes to parse all files with (default: 1 and {os.cpu_count()})')
+    parser.add_argument('--repeat', type=int, default=3, help='number of timing runs (the best one is reported)')
+    parser.add_argument('--no-reference', action='store_true', help='do not time the original entry by entry parser')
+    parser.add_argument('--json', default=None, help='write the results to this JSON file')
+
+    args = parser.parse_args()
+    print('args', args)
+
+    metadata_filepath_list = []
+    for inpath in args.inpath:
+        process_metadata_file.find_metadata_files(inpath, metadata_filepath_list)
+
+    temporary_dir = None
+    if len(args.inpath) == 0:
+        synthetic_dir = args.synthetic_dir
+        if synthetic_dir is None:
+            temporary_dir = tempfile.TemporaryDirectory()
+            synthetic_dir = temporary_dir.name
+        elif not os.path.exists(synthetic_dir):
+            os.makedirs(synthetic_dir)
+
+        for file_index in range(args.files):
+            filename = 'SYS4INI.BIN' if file_index == 0 else f'APPEND{file_index:02d}.AAI'
+            metadata_filepath = os.path.join(synthetic_dir, filename)
+            if not os.path.exists(metadata_filepath):
+                print(f'generating {metadata_filepath}')
+                generate_metadata_file(metadata_filepath, args.entries, seed=args.seed + file_index)
+            metadata_filepath_list.append(metadata_filepath)
+
+    print('len(metadata_filepath_list)', len(metadata_filepath_list))
+    if len(metadata_filepath_list) == 0:
+        print(f'{shared.FG_RED}ERROR: No metadata file to parse{shared.RESET_COLOR}')
+        return
+
+    try:
+        print('parse')
+        file_result_list = [
+            benchmark_metadata_file(metadata_filepath, args.repeat, not args.no_reference)
+            for metadata_filepath in metadata_filepath_list
+        ]
+
+        print('process_metadata_file')
+        jobs_list = args.jobs or sorted({1, os.cpu_count() or 1})
+        jobs_result_list = [benchmark_jobs(metadata_filepath_list, jobs, args.repeat) for jobs in jobs_list]
+    finally:
+        if temporary_dir is not None:
+            temporary_dir.cleanup()
+
+    if args.json is not None:
+        report = {
+            'environment': get_environment_info(),
+            'args': vars(args),
+            'file_result_list': file_result_list,
+            'jobs_result_list': jobs_result_list,
+        }
+        with open(args.json, mode='w', encoding='utf-8') as outfile:
+            json.dump(report, outfile, indent=4)
+        print('json', os.path.abspath(args.json))
+
+
+if __name__ == '__main__':
+    main()
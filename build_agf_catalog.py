@@ -0,0 +1,173 @@
+# build a table of the image metadata of every AGF entry listed in a metadata log
+import os
+import csv
+import mmap
+import time
+import argparse
+import traceback
+import concurrent.futures
+
+import tqdm
+
+import shared
+import metadata_store
+
+import convert_agf_to_png
+
+CATALOG_COLUMN_LIST = [
+    'metadata_path',
+    'alf_filename',
+    'name',
+    'file_index',
+    'offset',
+    'length',
+    'agf_type',
+    'width',
+    'height',
+    'bit_count',
+    'clr_used',
+    'compression',
+    'is_paletted',
+    'compressed_length',
+    'original_length',
+    'error',
+]
+
+
+def probe_archive_entry_list(
+    alf_filepath: str,
+    archive_list: list,
+):
+    # runs in a worker process
+    # returns one row (dict) per archive entry, errors are reported in the `error` column
+    row_list = []
+    with open(alf_filepath, mode='rb') as alf_infile:
+        alf_size = os.fstat(alf_infile.fileno()).st_size
+        alf_mmap = mmap.mmap(alf_infile.fileno(), 0, access=mmap.ACCESS_READ) if alf_size > 0 else b''
+        try:
+            alf_view = memoryview(alf_mmap)
+            for archive_info in archive_list:
+                offset = archive_info['offset']
+                length = archive_info['length']
+                row = {
+                    'name': archive_info['name'].decode('ascii'),
+                    'file_index': archive_info['file_index'],
+                    'offset': offset,
+                    'length': length,
+                    'error': '',
+                }
+
+                try:
+                    if (offset + length) > alf_size:
+                        raise Exception(f'entry ends at {offset + length} after the end of the ALF file {alf_size}')
+
+                    row.update(convert_agf_to_png.probe_agf_data(alf_view[offset:offset + length]))
+                except Exception as ex:
+                    row['error'] = repr(ex)
+
+                row_list.append(row)
+
+            alf_view.release()
+        finally:
+            if alf_size > 0:
+                alf_mmap.close()
+
+    return row_list
+
+
+def create_probe_task_list(
+    log_list: list,
+    chunk_size: int,
+):
+    # one task per `chunk_size` AGF entries of an ALF file
+    task_list = []
+    for metadata_info in log_list:
+        metadata_filepath = metadata_info['path']
+        metadata_parent = os.path.dirname(metadata_filepath)
+        alf_filename_list = [entry['name'].decode('ascii') for entry in metadata_info['alf_file_info_list']]
+
+        for alf_filename_index, number_of_entries in sorted(metadata_store.get_archive_index_count_dict(metadata_info).items()):
+            if alf_filename_index >= len(alf_filename_list):
+                print(f'{shared.FG_RED}ERROR: archive_index {alf_filename_index} out of range in {metadata_filepath} ({number_of_entries} entries){shared.RESET_COLOR}')
+
+        for alf_filename_index, alf_filename in enumerate(alf_filename_list):
+            archive_list = [
+                entry
+                for entry in metadata_store.get_alf_archive_entry_info_list(metadata_info, alf_filename_index)
+                if os.path.splitext(entry['name'])[1].lower() == b'.agf'
+            ]
+            alf_filepath = os.path.join(metadata_parent, alf_filename)
+            for start in range(0, len(archive_list), chunk_size):
+                task_list.append({
+                    'metadata_path': metadata_filepath,
+                    'alf_filename': alf_filename,
+                    'alf_filepath': alf_filepath,
+                    'archive_list': archive_list[start:start + chunk_size],
+                })
+
+    return task_list
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Build a catalog of the image metadata of every AGF entry without decoding the pixels.')
+    parser.add_argument('inpath', help='path to the metadata store or pickle log from process_metadata_file.py')
+    parser.add_argument('outpath', nargs='?', default=None, help='path to the output CSV file')
+    parser.add_argument('--jobs', type=int, default=os.cpu_count(), help='number of worker processes')
+    parser.add_argument('--chunk-size', type=int, default=1000, help='number of entries probed per task')
+
+    args = parser.parse_args()
+    print('args', args)
+
+    pickle_filepath = args.inpath
+    outpath = args.outpath
+    if outpath is None:
+        outpath = f'agf-catalog-{time.time_ns()}.csv'
+
+    if not os.path.exists(pickle_filepath):
+        print(f'{shared.FG_RED}ERROR: Metadata file does not exist: {pickle_filepath}{shared.RESET_COLOR}')
+        return
+
+    log_list = metadata_store.load_metadata_file_list(pickle_filepath)
+
+    task_list = create_probe_task_list(log_list, args.chunk_size)
+    print('len(task_list)', len(task_list))
+
+    row_list = []
+    with concurrent.futures.ProcessPoolExecutor(max_workers=args.jobs) as executor:
+        future_dict = {
+            executor.submit(probe_archive_entry_list, task_info['alf_filepath'], task_info['archive_list']): task_info
+            for task_info in task_list
+        }
+
+        for future in tqdm.tqdm(concurrent.futures.as_completed(future_dict), total=len(future_dict)):
+            task_info = future_dict[future]
+            try:
+                task_row_list = future.result()
+            except Exception as ex:
+                stack_trace = traceback.format_exc()
+                print(f'{shared.FG_RED}ERROR: Error occurs while probing {task_info["alf_filepath"]}{shared.RESET_COLOR}')
+                print(stack_trace)
+                print(ex)
+                continue
+
+            for row in task_row_list:
+                row['metadata_path'] = task_info['metadata_path']
+                row['alf_filename'] = task_info['alf_filename']
+                row_list.append(row)
+
+    # keep the output stable regardless of the order the tasks finish in
+    row_list.sort(key=lambda row: (row['metadata_path'], row['alf_filename'], row['offset']))
+
+    with open(outpath, mode='w', encoding='utf-8', newline='') as outfile:
+        writer = csv.DictWriter(outfile, fieldnames=CATALOG_COLUMN_LIST)
+        writer.writeheader()
+        writer.writerows(row_list)
+
+    number_of_errors = sum(1 for row in row_list if row['error'])
+    print('len(row_list)', len(row_list))
+    print('number_of_errors', number_of_errors)
+    print(f'catalog_filepath = {os.path.abspath(outpath)}')
+
+
+if __name__ == '__main__':
+    main()
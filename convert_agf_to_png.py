@@ -11,80 +11,102 @@ from tqdm import tqdm
 
 import numpy as np
 import cv2
+import PIL.Image
 
 import tqdm
 
 import shared
 
 
-def convert_rgb_to_opencv_format(
-    rgb_image: np.ndarray,
+def get_pooled_array(
+    buffer_pool: dict,
+    name: str,
+    shape: tuple,
 ):
-    image_shape = rgb_image.shape
-    if len(image_shape) == 2:
-        # grayscale image
-        return rgb_image
-    elif len(image_shape) == 3:
-        if image_shape[2] == 2:
-            # grayscale with alpha
-            grayscale_image = rgb_image[:, :, 0]
-            alpha_image = rgb_image[:, :, 1]
-            bgra_image = np.zeros((image_shape[0], image_shape[1], 4), dtype=np.uint8)
-            bgra_image[:, :, 0] = grayscale_image
-            bgra_image[:, :, 1] = grayscale_image
-            bgra_image[:, :, 2] = grayscale_image
-            bgra_image[:, :, 3] = alpha_image
-            return bgra_image
-        elif image_shape[2] == 3:
-            # RGB image
-            return cv2.cvtColor(rgb_image, cv2.COLOR_RGB2BGR)
-        elif image_shape[2] == 4:
-            # RGBA image
-            return cv2.cvtColor(rgb_image, cv2.COLOR_RGBA2BGRA)
-        else:
-            raise Exception(f'Unsupported image shape {image_shape}')
+    # reuse the array stored under `name` if it has the same shape
+    # only one array per name is kept so the pool does not grow with every image size
+    if buffer_pool is None:
+        return np.empty(shape, dtype=np.uint8)
 
+    array = buffer_pool.get(name)
+    if array is None or array.shape != shape:
+        array = np.empty(shape, dtype=np.uint8)
+        buffer_pool[name] = array
 
-def convert_agf_data_to_numpy_array(
-    agf_content_bs: bytes,
-    force_rgb=False
+    return array
+
+
+def get_palette_array(rgb_quad_bs: bytes):
+    # RGBQUAD entries are (blue, green, red, reserved)
+    # the palette is padded with black to 256 entries so every 8 bits index
+    # is valid and the lookup does not need bounds checks
+    palette_array = np.zeros((256, 4), dtype=np.uint8)
+    rgb_quad_array = np.frombuffer(rgb_quad_bs, dtype=np.uint8)
+    number_of_colors = min(len(rgb_quad_array) // 4, 256)
+    palette_array[:number_of_colors] = rgb_quad_array[:number_of_colors * 4].reshape((-1, 4))
+    return palette_array
+
+
+def find_pixel_data_layout(
+    original_length: int,
+    width: int,
+    height: int,
+    bytes_per_pixel: int,
 ):
-    stream = io.BytesIO(agf_content_bs)
+    # returns (is_paletted, row_stride) or None if `original_length` does not
+    # match any known layout
+    # the pixel section holds either the pixels or one palette index per
+    # pixel, the rows are either packed or padded to 4 bytes like DIB rows
+    for is_paletted, row_size in [(False, width * bytes_per_pixel), (True, width)]:
+        padded_row_size = (row_size + 3) & ~3
+        for row_stride in [row_size, padded_row_size]:
+            if original_length == height * row_stride:
+                return is_paletted, row_stride
+
+    return None
+
+
+def read_agf_header(agf_content_bs: bytes):
+    # decode the AGF header and the bitmap header section and locate the other
+    # sections by their length fields without decoding them
+    # returns a dict, `height` is biHeight (negative for top-down rows)
+    agf_content_view = memoryview(agf_content_bs)
     # AGF header
     # 4 bytes: signature
     # 4 bytes: type
     # 4 bytes: unknown
-    bs = stream.read(12)
+    bs = agf_content_view[0:12]
     if len(bs) != 12:
         raise Exception(f'AGF header is not 12 bytes long - {len(bs)}')
 
-    signature_bs = bs[0:4]
     agf_type = struct.unpack('<I', bs[4:8])[0]
     if agf_type not in [shared.AGF_TYPE_24BIT, shared.AGF_TYPE_32BIT]:
         raise Exception(f'AGF unknown type {agf_type}')
 
-    bitmap_header_bs = shared.read_lzss_section(stream)
-    bitmap_header = shared.parse_agf_bitmap_header_bs(bitmap_header_bs)
-    image_data_bs = shared.read_lzss_section(stream)
+    offset = 12
+    compressed_length = 0
+    original_length = 0
+
+    bitmap_header_original_length, _, bitmap_header_length = shared.unpack_lzss_section_header(agf_content_view, offset)
+    bitmap_header_bs, offset = shared.read_lzss_section_from_buffer(agf_content_view, offset)
+    # copied (at most a few KB) so the header does not keep the buffer alive
+    bitmap_header = shared.parse_agf_bitmap_header_bs(bytes(bitmap_header_bs))
+    compressed_length += bitmap_header_length
+    original_length += bitmap_header_original_length
 
     bitmap_info_header = bitmap_header['BITMAPINFOHEADER']
     biWidth = bitmap_info_header['biWidth']
     biHeight = bitmap_info_header['biHeight']
     biBitCount = bitmap_info_header['biBitCount']
 
-    if biHeight < 0:
-        raise Exception(f'Unsupported bitmap order TODO biHeight < 0')
-
-    if biBitCount % 8 != 0:
-        raise Exception(f'biBitCount={biBitCount} is not multiple of 8')
-
-    bytes_per_pixel = biBitCount // 8
-    biClrUsed = bitmap_info_header['biClrUsed']
-
-    biCompression = bitmap_info_header['biCompression']
-    if biCompression != 0:
-        raise Exception(f'unsupported biCompression value {biCompression}')
+    pixel_section_offset = offset
+    image_data_original_length, _, image_data_length = shared.unpack_lzss_section_header(agf_content_view, offset)
+    offset += 12 + image_data_length
+    compressed_length += image_data_length
+    original_length += image_data_original_length
 
+    acif_header_bs = None
+    transparency_section_offset = None
     if agf_type == shared.AGF_TYPE_32BIT:
         # ACIF header format
         # 4 bytes: signature
@@ -93,78 +115,218 @@ def convert_agf_data_to_numpy_array(
         # 4 bytes: original_length
         # 4 bytes: width
         # 4 bytes: height
-        acif_header_bs = stream.read(24)
+        acif_header_bs = bytes(agf_content_view[offset:offset + 24])
         if len(acif_header_bs) != 24:
             raise Exception(f'ACIF header is not 24 bytes long - {len(acif_header_bs)}')
-        {
-            'signature': acif_header_bs[0:4],
-            'type': acif_header_bs[4:8],
-            'unknown': acif_header_bs[8:12],
-            'original_length': acif_header_bs[12:16],
-            'width': acif_header_bs[16:20],
-            'height': acif_header_bs[20:24],
-        }
-
-        transparency_data_bs = shared.read_lzss_section(stream)
-
-        ################################################################
-        # I am not sure if the image_data_bs contains only the indexes of the palette
-        # or if it contains the actual image data
-        # if it contains the actual image data, then the image_data_bs_len should be
-        # biWidth * biHeight * bytes_per_pixel
-        # The biClrUsed value should be used to determine that the image_data_bs contains
-        # the actual image data or not. However I am not sure if the biClrUsed value
-        # is always correct.
-        # if biClrUsed == 0, I think it means that the image_data_bs contains the actual image data
-        # However, I found an example where biClrUsed == 0 but the image_data_bs_len is not
-        # biWidth * biHeight * bytes_per_pixel
-
-        image_data_bs_len = len(image_data_bs)
-        if image_data_bs_len == int(biWidth * biHeight * bytes_per_pixel):
-            tmp_np_array = np.frombuffer(image_data_bs, dtype=np.uint8)
-            bgr_image = tmp_np_array.reshape((biHeight, biWidth, bytes_per_pixel))
-            reorder_bgr_image = np.flipud(bgr_image)
+        offset += 24
+
+        transparency_section_offset = offset
+        transparency_data_original_length, _, transparency_data_length = shared.unpack_lzss_section_header(agf_content_view, offset)
+        offset += 12 + transparency_data_length
+        compressed_length += transparency_data_length
+        original_length += transparency_data_original_length
+
+    if offset > len(agf_content_view):
+        raise Exception(f'AGF sections end at offset {offset} after the end of the data {len(agf_content_view)}')
+
+    return {
+        'agf_type': agf_type,
+        'bitmap_header': bitmap_header,
+        'width': biWidth,
+        'height': biHeight,
+        'bit_count': biBitCount,
+        'clr_used': bitmap_info_header['biClrUsed'],
+        'compression': bitmap_info_header['biCompression'],
+        # (is_paletted, row_stride) or None
+        'pixel_data_layout': find_pixel_data_layout(image_data_original_length, biWidth, abs(biHeight), biBitCount // 8),
+        'pixel_section_offset': pixel_section_offset,
+        'acif_header': acif_header_bs,
+        'transparency_section_offset': transparency_section_offset,
+        # sum of the section contents, without the section headers
+        'compressed_length': compressed_length,
+        'original_length': original_length,
+    }
+
+
+def read_agf_pixel_section(
+    agf_content_bs: bytes,
+    agf_header: dict,
+    buffer_pool: dict = None,
+):
+    # decode the pixel section straight into a NumPy array when its length
+    # matches biWidth * height pixels or palette indexes, with or without rows
+    # padded to 4 bytes (see find_pixel_data_layout)
+    # returns the pixels, (height, width[, bytes_per_pixel]), or the palette
+    # indexes, (height, width), with the rows bottom-up
+    # or None if the length does not match
+    pixel_data_layout = agf_header['pixel_data_layout']
+    if pixel_data_layout is None:
+        return None
+
+    ################################################################
+    # I am not sure if the image_data_bs contains only the indexes of the palette
+    # or if it contains the actual image data
+    # if it contains the actual image data, then the image_data_bs_len should be
+    # biWidth * biHeight * bytes_per_pixel
+    # The biClrUsed value should be used to determine that the image_data_bs contains
+    # the actual image data or not. However I am not sure if the biClrUsed value
+    # is always correct.
+    # if biClrUsed == 0, I think it means that the image_data_bs contains the actual image data
+    # However, I found an example where biClrUsed == 0 but the image_data_bs_len is not
+    # biWidth * biHeight * bytes_per_pixel
+    is_paletted, row_stride = pixel_data_layout
+    biWidth = agf_header['width']
+    biHeight = agf_header['height']
+    image_height = abs(biHeight)
+    bytes_per_pixel = agf_header['bit_count'] // 8
+    if is_paletted:
+        row_size = biWidth
+        pixel_shape = (image_height, biWidth)
+    else:
+        row_size = biWidth * bytes_per_pixel
+        if bytes_per_pixel == 1:
+            pixel_shape = (image_height, biWidth)
+        else:
+            pixel_shape = (image_height, biWidth, bytes_per_pixel)
+
+    row_array = get_pooled_array(buffer_pool, 'palette_index' if is_paletted else 'image_data', (image_height, row_stride))
+    shared.read_lzss_section_from_buffer_into(agf_content_bs, agf_header['pixel_section_offset'], row_array)
+
+    # drop the row padding without copying
+    pixel_array = row_array[:, :row_size].reshape(pixel_shape)
+    if biHeight < 0:
+        # the callers expect bottom-up rows like in a BMP file
+        pixel_array = pixel_array[::-1]
+
+    return pixel_array
+
+
+def read_agf_transparency_section(
+    agf_content_bs: bytes,
+    agf_header: dict,
+    buffer_pool: dict = None,
+):
+    # returns the transparency (alpha) values of a 32 bits AGF, (height, width)
+    transparency_array = get_pooled_array(buffer_pool, 'transparency_data', (abs(agf_header['height']), agf_header['width']))
+    shared.read_lzss_section_from_buffer_into(agf_content_bs, agf_header['transparency_section_offset'], transparency_array)
+    return transparency_array
+
+
+def convert_agf_data_to_numpy_array(
+    agf_content_bs: bytes,
+    force_rgb=False,
+    buffer_pool: dict = None,
+):
+    # returns the pixels in the layout of the AGF data (grayscale, BGR or BGRA)
+    # which is also what OpenCV consumes, or RGB / RGBA with `force_rgb`
+    # for writers such as Pillow. Where possible the channels are reordered
+    # while the pixels are copied anyway so there is at most one conversion.
+    # `agf_content_bs` can be any buffer (bytes, memoryview, mmap slice), the
+    # sections are read from it by offset without intermediate copies
+    # if `buffer_pool` (a dict) is given, the pixel storage is reused across
+    # calls for images of the same size. The returned array may then be a view
+    # of that storage so it has to be consumed before the next call.
+    agf_content_view = memoryview(agf_content_bs)
+    agf_header = read_agf_header(agf_content_view)
+    agf_type = agf_header['agf_type']
+    bitmap_header = agf_header['bitmap_header']
+
+    biWidth = agf_header['width']
+    biHeight = agf_header['height']
+    biBitCount = agf_header['bit_count']
+
+    if biBitCount % 8 != 0:
+        raise Exception(f'biBitCount={biBitCount} is not multiple of 8')
+
+    bytes_per_pixel = biBitCount // 8
+
+    biCompression = agf_header['compression']
+    if biCompression != 0:
+        raise Exception(f'unsupported biCompression value {biCompression}')
+
+    # biHeight < 0 means the rows are stored top-down
+    image_height = abs(biHeight)
+
+    # the pixels or the palette indexes, otherwise keep the raw bytes
+    image_data_array = None
+    palette_index_array = None
+    image_data_bs = None
+    pixel_array = read_agf_pixel_section(agf_content_view, agf_header, buffer_pool)
+    if pixel_array is None:
+        image_data_bs, _ = shared.read_lzss_section_from_buffer(agf_content_view, agf_header['pixel_section_offset'])
+    elif agf_header['pixel_data_layout'][0]:
+        palette_index_array = pixel_array
+    else:
+        image_data_array = pixel_array
+
+    if agf_type == shared.AGF_TYPE_32BIT:
+        if image_data_array is not None:
+            transparency_array = read_agf_transparency_section(agf_content_view, agf_header, buffer_pool)
 
             # merge the transparency array with the image data
-            tmp_np_array = np.frombuffer(transparency_data_bs, dtype=np.uint8)
-            transparency_array = tmp_np_array.reshape((biHeight, biWidth, 1))
-            bgra_image = np.concatenate((reorder_bgr_image, transparency_array), axis=2)
+            # the pixel rows are stored bottom-up
+            if bytes_per_pixel == 1:
+                # grayscale with transparency is expanded to BGRA
+                bgra_image = get_pooled_array(buffer_pool, 'bgra_image', (image_height, biWidth, 4))
+                bgra_image[:, :, :3] = image_data_array[::-1, :, None]
+            else:
+                bgra_image = get_pooled_array(buffer_pool, 'bgra_image', (image_height, biWidth, bytes_per_pixel + 1))
+                if force_rgb and bytes_per_pixel == 3:
+                    # RGBA, the channels are swapped while merging
+                    bgra_image[:, :, :bytes_per_pixel] = image_data_array[::-1, :, ::-1]
+                else:
+                    bgra_image[:, :, :bytes_per_pixel] = image_data_array[::-1]
+            bgra_image[:, :, -1] = transparency_array
             return bgra_image
+        elif palette_index_array is not None:
+            transparency_array = read_agf_transparency_section(agf_content_view, agf_header, buffer_pool)
 
-        ################################################################
+            # the image_data_bs is a list of indexes into the palette (RGBQUAD)
+            # every pixel is looked up as one 32 bits BGRX value then the
+            # reserved byte is overwritten with the transparency data
+            # the index rows are stored bottom-up like the pixel rows
+            palette_array = get_palette_array(bitmap_header['RGBQUAD'])
+            if force_rgb:
+                # RGBA, looked up from a reordered palette
+                palette_array = np.ascontiguousarray(palette_array[:, [2, 1, 0, 3]])
+            bgra_image = get_pooled_array(buffer_pool, 'bgra_image', (image_height, biWidth, 4))
+            np.take(
+                palette_array.view(np.uint32)[:, 0],
+                palette_index_array[::-1],
+                out=bgra_image.view(np.uint32)[:, :, 0],
+                mode='clip',
+            )
+            bgra_image[:, :, 3] = transparency_array
+            return bgra_image
         else:
-            # generate dictionary of RGBQUAD - which is a palette containing the colors
-            # the image_data_bs is now a list of indexes into the palette
-            rgb_quad_array_bs = bitmap_header['RGBQUAD']
-            tmp_np_array = np.frombuffer(rgb_quad_array_bs, dtype=np.uint8)
-            rgb_quad_array = tmp_np_array.reshape((-1, 4))
-
-            tmp_np_array = np.frombuffer(image_data_bs, dtype=np.uint8)
-            image_index_array = tmp_np_array.reshape(biHeight, biWidth)
-            # map the indexes into the palette to the RGBQUAD
-            image_data_array = np.array([rgb_quad_array[i] for i in image_index_array])
+            raise Exception(f'pixel data length {len(image_data_bs)} does not match biWidth={biWidth} height={image_height} biBitCount={biBitCount}')
     else:
         # TODO this is the place where we want to transform the image data into what we want either as a BMP image with minimal processing with Windows API or as PNG/JPEG image
 
-        # bgr_image = np.zeros(
-        #     (biHeight, biWidth, bytes_per_pixel),
-        #     dtype=np.uint8,
-        # )
-
-        # for y in tqdm(range(biHeight)):
-        #     for x in range(biWidth):
-        #         current_pixel_index = ((y * biWidth) + x) * bytes_per_pixel
-        #         for z in range(bytes_per_pixel):
-        #             value = image_data_bs[current_pixel_index + z]
-        #             bgr_image[y,x,z] = value
+        if palette_index_array is not None:
+            palette_array = get_palette_array(bitmap_header['RGBQUAD'])
+            if force_rgb:
+                # RGB, looked up from a reordered palette
+                palette_array = palette_array[:, [2, 1, 0]]
+            else:
+                palette_array = palette_array[:, :3]
+            bgr_image = get_pooled_array(buffer_pool, 'bgr_image', (image_height, biWidth, 3))
+            np.take(palette_array, palette_index_array, axis=0, out=bgr_image, mode='clip')
+            return bgr_image
 
-        tmp_np_array = np.frombuffer(image_data_bs, dtype=np.uint8)
+        if image_data_array is None:
+            # this raises the same error as before for sections with an unexpected length
+            tmp_np_array = np.frombuffer(image_data_bs, dtype=np.uint8)
+            if bytes_per_pixel == 1:
+                image_data_array = tmp_np_array.reshape(image_height, biWidth)
+            else:
+                image_data_array = tmp_np_array.reshape((image_height, biWidth, bytes_per_pixel))
 
         if bytes_per_pixel == 1:
-            gray_image = tmp_np_array.reshape(biHeight, biWidth)
+            gray_image = image_data_array
             return gray_image
 
-        bgr_image = tmp_np_array.reshape((biHeight, biWidth, bytes_per_pixel))
+        bgr_image = image_data_array
         if force_rgb:
             rgb_image = cv2.cvtColor(bgr_image, cv2.COLOR_BGR2RGB)
             return rgb_image
@@ -172,6 +334,613 @@ def convert_agf_data_to_numpy_array(
             return bgr_image
 
 
+def probe_agf_data(agf_content_bs: bytes):
+    # read the image metadata without decoding the pixel and transparency sections
+    # only the 12 bytes AGF header and the small bitmap header section are
+    # decoded, the other sections are skipped with their length fields.
+    # With a memoryview over an mmap only the touched pages are read from disk.
+    agf_header = read_agf_header(agf_content_bs)
+    pixel_data_layout = agf_header['pixel_data_layout']
+    return {
+        'agf_type': agf_header['agf_type'],
+        'width': agf_header['width'],
+        'height': agf_header['height'],
+        'bit_count': agf_header['bit_count'],
+        'clr_used': agf_header['clr_used'],
+        'compression': agf_header['compression'],
+        'is_paletted': pixel_data_layout is not None and pixel_data_layout[0],
+        'compressed_length': agf_header['compressed_length'],
+        'original_length': agf_header['original_length'],
+    }
+
+
+class AgfImage:
+    # AGF image decoded on demand
+    # `agf_content_bs` can be any buffer (bytes, memoryview, mmap slice)
+    # - `header` and the attributes built on it (`size`, `bit_count`,
+    #   `is_paletted`, ...) only decode the AGF header and the bitmap header
+    #   section so filtering by size or type never touches the pixels
+    # - `pixels` and `alpha` decode their section on first access and keep it
+    # - `to_numpy_array` gives the same image as convert_agf_data_to_numpy_array
+    #   from the kept sections
+    def __init__(self, agf_content_bs: bytes):
+        self.agf_content_view = memoryview(agf_content_bs)
+        self._header = None
+        self._pixels = None
+        self._alpha = None
+
+    @property
+    def header(self):
+        if self._header is None:
+            self._header = read_agf_header(self.agf_content_view)
+        return self._header
+
+    @property
+    def agf_type(self):
+        return self.header['agf_type']
+
+    @property
+    def width(self):
+        return self.header['width']
+
+    @property
+    def height(self):
+        # number of rows, the sign of biHeight only gives the row order
+        return abs(self.header['height'])
+
+    @property
+    def size(self):
+        # (width, height) like PIL.Image.Image.size
+        return (self.width, self.height)
+
+    @property
+    def bit_count(self):
+        return self.header['bit_count']
+
+    @property
+    def is_paletted(self):
+        pixel_data_layout = self.header['pixel_data_layout']
+        return pixel_data_layout is not None and pixel_data_layout[0]
+
+    @property
+    def has_alpha(self):
+        return self.agf_type == shared.AGF_TYPE_32BIT
+
+    @property
+    def pixels(self):
+        # grayscale (height, width) or BGR (height, width, 3) pixels, paletted
+        # images are looked up in the palette
+        # the rows are in the order of convert_agf_data_to_numpy_array
+        if self._pixels is None:
+            header = self.header
+            if header['bit_count'] % 8 != 0:
+                raise Exception(f'biBitCount={header["bit_count"]} is not multiple of 8')
+            if header['compression'] != 0:
+                raise Exception(f'unsupported biCompression value {header["compression"]}')
+
+            pixel_array = read_agf_pixel_section(self.agf_content_view, header)
+            if pixel_array is None:
+                raise Exception(f'pixel data length does not match biWidth={header["width"]} height={self.height} biBitCount={header["bit_count"]}')
+
+            if self.is_paletted:
+                palette_array = get_palette_array(header['bitmap_header']['RGBQUAD'])[:, :3]
+                pixel_array = np.take(palette_array, pixel_array, axis=0, mode='clip')
+
+            if self.has_alpha:
+                # only the pixel rows of 32 bits images are flipped
+                pixel_array = pixel_array[::-1]
+
+            self._pixels = pixel_array
+        return self._pixels
+
+    @property
+    def alpha(self):
+        # transparency (height, width) or None for 24 bits images
+        if self._alpha is None and self.has_alpha:
+            self._alpha = read_agf_transparency_section(self.agf_content_view, self.header)
+        return self._alpha
+
+    def to_numpy_array(self, force_rgb=False):
+        # grayscale, BGR or BGRA (RGB / RGBA with `force_rgb`)
+        pixels = self.pixels
+        alpha = self.alpha
+        if alpha is None:
+            if force_rgb and pixels.ndim == 3:
+                return cv2.cvtColor(pixels, cv2.COLOR_BGR2RGB)
+            return pixels
+
+        if pixels.ndim == 2:
+            # grayscale with transparency is expanded to BGRA
+            bgra_image = np.empty((self.height, self.width, 4), dtype=np.uint8)
+            bgra_image[:, :, :3] = pixels[:, :, None]
+        else:
+            bgra_image = np.empty((self.height, self.width, pixels.shape[2] + 1), dtype=np.uint8)
+            if force_rgb and pixels.shape[2] == 3:
+                bgra_image[:, :, :3] = pixels[:, :, ::-1]
+            else:
+                bgra_image[:, :, :-1] = pixels
+        bgra_image[:, :, -1] = alpha
+        return bgra_image
+
+    def release(self):
+        # drop the reference to the buffer (e.g. before closing an mmap)
+        # the header is parsed first, the attributes and the already decoded
+        # sections keep working
+        self.header
+        self.agf_content_view.release()
+
+
+def decompress_agf_data(agf_content_bs: bytes):
+    # returns the same AGF with every LZSS section stored uncompressed
+    # (original_length == length) so it can be cached and parsed again
+    # without decoding
+    agf_content_view = memoryview(agf_content_bs)
+    bs = agf_content_view[0:12]
+    if len(bs) != 12:
+        raise Exception(f'AGF header is not 12 bytes long - {len(bs)}')
+
+    agf_type = struct.unpack('<I', bs[4:8])[0]
+    if agf_type not in [shared.AGF_TYPE_24BIT, shared.AGF_TYPE_32BIT]:
+        raise Exception(f'AGF unknown type {agf_type}')
+
+    chunk_list = [bs]
+    offset = 12
+
+    # bitmap header and pixel sections
+    for _ in range(2):
+        original_length, original_length2, length = shared.unpack_lzss_section_header(agf_content_view, offset)
+        section_view, offset = shared.read_lzss_section_from_buffer(agf_content_view, offset)
+        chunk_list.append(struct.pack('<3I', original_length, original_length2, original_length))
+        chunk_list.append(section_view)
+
+    if agf_type == shared.AGF_TYPE_32BIT:
+        # ACIF header and transparency section
+        acif_header_bs = agf_content_view[offset:offset + 24]
+        if len(acif_header_bs) != 24:
+            raise Exception(f'ACIF header is not 24 bytes long - {len(acif_header_bs)}')
+        offset += 24
+        chunk_list.append(acif_header_bs)
+
+        original_length, original_length2, length = shared.unpack_lzss_section_header(agf_content_view, offset)
+        section_view, offset = shared.read_lzss_section_from_buffer(agf_content_view, offset)
+        chunk_list.append(struct.pack('<3I', original_length, original_length2, original_length))
+        chunk_list.append(section_view)
+
+    # keep anything after the known sections as is
+    chunk_list.append(agf_content_view[offset:])
+
+    return b''.join(chunk_list)
+
+
+BMP_FILE_HEADER_SIZE = 14
+BMP_INFO_HEADER_SIZE = 40
+# BITMAPV4HEADER, used for 32 bits images to declare the alpha mask
+BMP_V4_HEADER_SIZE = 108
+BI_RGB = 0
+BI_BITFIELDS = 3
+# 'Win ' - LCS_WINDOWS_COLOR_SPACE
+BMP_V4_COLOR_SPACE_TYPE = 0x57696e20
+
+
+def create_bmp_header_bs(
+    width: int,
+    height: int,
+    bit_count: int,
+    row_stride: int,
+    palette_bs: bytes = b'',
+):
+    # returns BITMAPFILEHEADER + BITMAPINFOHEADER (or BITMAPV4HEADER for 32 bits)
+    # + palette, the pixel rows have to follow right after
+    # height < 0 means the rows are written top-down
+    image_size = row_stride * abs(height)
+    number_of_colors = len(palette_bs) // 4
+
+    if bit_count == 32:
+        info_header_size = BMP_V4_HEADER_SIZE
+        info_header_bs = struct.pack(
+            '<I2i2H2I2i2I5I36s3I',
+            BMP_V4_HEADER_SIZE,
+            width,
+            height,
+            1,
+            bit_count,
+            BI_BITFIELDS,
+            image_size,
+            0,
+            0,
+            0,
+            0,
+            # red, green, blue and alpha masks of the BGRA pixels
+            0x00ff0000,
+            0x0000ff00,
+            0x000000ff,
+            0xff000000,
+            BMP_V4_COLOR_SPACE_TYPE,
+            # CIEXYZTRIPLE end points (unused) and gamma
+            b'\0' * 36,
+            0,
+            0,
+            0,
+        )
+    else:
+        info_header_size = BMP_INFO_HEADER_SIZE
+        info_header_bs = shared.BITMAP_INFO_HEADER_STRUCT.pack(
+            BMP_INFO_HEADER_SIZE,
+            width,
+            height,
+            1,
+            bit_count,
+            BI_RGB,
+            image_size,
+            0,
+            0,
+            number_of_colors,
+            0,
+        )
+
+    pixel_offset = BMP_FILE_HEADER_SIZE + info_header_size + len(palette_bs)
+    file_header_bs = shared.BITMAP_FILE_HEADER_STRUCT.pack(
+        0x4d42,  # 'BM'
+        pixel_offset + image_size,
+        0,
+        0,
+        pixel_offset,
+    )
+
+    return file_header_bs + info_header_bs + bytes(palette_bs)
+
+
+def pad_bmp_rows(
+    row_array: np.ndarray,
+    buffer_pool: dict = None,
+):
+    # BMP rows have to be padded to 4 bytes
+    # returns the (height, row_stride) array to write
+    height, row_size = row_array.shape
+    row_stride = (row_size + 3) & ~3
+    if row_stride == row_size:
+        return row_array
+
+    padded_row_array = get_pooled_array(buffer_pool, 'bmp_rows', (height, row_stride))
+    padded_row_array[:, :row_size] = row_array
+    padded_row_array[:, row_size:] = 0
+    return padded_row_array
+
+
+# grayscale images are written as 8 bits BMP with this palette
+GRAYSCALE_PALETTE_BS = b''.join(bytes([i, i, i, 0]) for i in range(256))
+
+
+def convert_numpy_array_to_bmp_chunk_list(
+    image: np.ndarray,
+    buffer_pool: dict = None,
+):
+    # `image` is an array returned by convert_agf_data_to_numpy_array with
+    # force_rgb=False: grayscale, BGR or BGRA with the top row first
+    height, width = image.shape[:2]
+    if len(image.shape) == 2:
+        bit_count = 8
+        palette_bs = GRAYSCALE_PALETTE_BS
+    elif image.shape[2] in [3, 4]:
+        bit_count = 8 * image.shape[2]
+        palette_bs = b''
+    else:
+        raise Exception(f'Unsupported image shape {image.shape}')
+
+    row_array = pad_bmp_rows(np.ascontiguousarray(image).reshape((height, -1)), buffer_pool)
+    header_bs = create_bmp_header_bs(width, -height, bit_count, row_array.shape[1], palette_bs)
+    return [header_bs, row_array]
+
+
+def convert_agf_data_to_bmp_chunk_list(
+    agf_content_bs: bytes,
+    buffer_pool: dict = None,
+):
+    # returns a list of buffers which form a BMP file when written one after
+    # the other, the image looks the same as the one from the NumPy path
+    #
+    # the pixel section of 24 bits AGF files is already in the BMP layout so
+    # it is written as is after repaired headers without going through NumPy.
+    # The BMP is marked top-down (negated biHeight) because the NumPy path
+    # keeps the stored row order. Other images (32 bits with transparency,
+    # paletted, grayscale) are built from the NumPy array.
+    agf_content_view = memoryview(agf_content_bs)
+    bs = agf_content_view[0:12]
+    if len(bs) != 12:
+        raise Exception(f'AGF header is not 12 bytes long - {len(bs)}')
+
+    agf_type = struct.unpack('<I', bs[4:8])[0]
+    if agf_type == shared.AGF_TYPE_24BIT:
+        bitmap_header_bs, offset = shared.read_lzss_section_from_buffer(agf_content_view, 12)
+        bitmap_info_header = shared.parse_agf_bitmap_header_bs(bitmap_header_bs)['BITMAPINFOHEADER']
+        biWidth = bitmap_info_header['biWidth']
+        biHeight = bitmap_info_header['biHeight']
+        biBitCount = bitmap_info_header['biBitCount']
+
+        if biBitCount == 24 and bitmap_info_header['biCompression'] == 0:
+            image_data_original_length = shared.unpack_lzss_section_header(agf_content_view, offset)[0]
+            pixel_data_layout = find_pixel_data_layout(image_data_original_length, biWidth, abs(biHeight), 3)
+            if pixel_data_layout is not None and not pixel_data_layout[0]:
+                row_stride = pixel_data_layout[1]
+                image_data_bs, offset = shared.read_lzss_section_from_buffer(agf_content_view, offset)
+                if (row_stride % 4) != 0:
+                    image_data_bs = pad_bmp_rows(np.frombuffer(image_data_bs, dtype=np.uint8).reshape((abs(biHeight), row_stride)), buffer_pool)
+                    row_stride = image_data_bs.shape[1]
+
+                header_bs = create_bmp_header_bs(biWidth, -biHeight, 24, row_stride)
+                return [header_bs, image_data_bs]
+
+    image = convert_agf_data_to_numpy_array(
+        agf_content_bs=agf_content_view,
+        force_rgb=False,
+        buffer_pool=buffer_pool,
+    )
+
+    return convert_numpy_array_to_bmp_chunk_list(image, buffer_pool)
+
+
+def write_chunk_list(filepath: str, chunk_list: list):
+    with open(filepath, mode='wb') as outfile:
+        for chunk in chunk_list:
+            outfile.write(chunk)
+
+
+# image encoders
+# each encoder takes the pixels in one channel order and the decoder is
+# asked for that order (see convert_agf_data_to_numpy_array) so the pixels
+# are converted at most once
+ENCODER_OPENCV_PNG = 'opencv-png'
+ENCODER_PILLOW_PNG = 'pillow-png'
+ENCODER_PILLOW_WEBP = 'pillow-webp'
+ENCODER_OPENCV_JPG = 'opencv-jpg'
+ENCODER_BMP = 'bmp'
+
+PROFILE_FAST = 'fast'
+PROFILE_BALANCED = 'balanced'
+PROFILE_ARCHIVAL = 'archival'
+PROFILE_LIST = [PROFILE_FAST, PROFILE_BALANCED, PROFILE_ARCHIVAL]
+# the PNG files were always written with the highest compression level
+DEFAULT_PROFILE = PROFILE_ARCHIVAL
+
+# - format: file extension
+# - force_rgb: the encoder takes RGB / RGBA instead of BGR / BGRA
+# - profile_dict: encoder parameters of every profile
+ENCODER_CONFIG_DICT = {
+    ENCODER_OPENCV_PNG: {
+        'format': 'png',
+        'force_rgb': False,
+        'profile_dict': {
+            PROFILE_FAST: [cv2.IMWRITE_PNG_COMPRESSION, 1],
+            PROFILE_BALANCED: [cv2.IMWRITE_PNG_COMPRESSION, 6],
+            PROFILE_ARCHIVAL: [cv2.IMWRITE_PNG_COMPRESSION, 9],
+        },
+    },
+    ENCODER_PILLOW_PNG: {
+        'format': 'png',
+        'force_rgb': True,
+        'profile_dict': {
+            PROFILE_FAST: {'compress_level': 1},
+            PROFILE_BALANCED: {'compress_level': 6},
+            PROFILE_ARCHIVAL: {'compress_level': 9, 'optimize': True},
+        },
+    },
+    ENCODER_PILLOW_WEBP: {
+        # lossless, `quality` is the compression effort
+        # `exact` keeps the colour of fully transparent pixels
+        'format': 'webp',
+        'force_rgb': True,
+        'profile_dict': {
+            PROFILE_FAST: {'lossless': True, 'exact': True, 'quality': 0, 'method': 0},
+            PROFILE_BALANCED: {'lossless': True, 'exact': True, 'quality': 75, 'method': 4},
+            PROFILE_ARCHIVAL: {'lossless': True, 'exact': True, 'quality': 90, 'method': 6},
+        },
+    },
+    ENCODER_OPENCV_JPG: {
+        # lossy, the profiles only matter for the lossless formats
+        'format': 'jpg',
+        'force_rgb': False,
+        'profile_dict': {
+            PROFILE_FAST: [cv2.IMWRITE_JPEG_QUALITY, 95],
+            PROFILE_BALANCED: [cv2.IMWRITE_JPEG_QUALITY, 95],
+            PROFILE_ARCHIVAL: [cv2.IMWRITE_JPEG_QUALITY, 95],
+        },
+    },
+    ENCODER_BMP: {
+        # uncompressed, see convert_agf_data_to_bmp_chunk_list
+        'format': 'bmp',
+        'force_rgb': False,
+        'profile_dict': {
+            PROFILE_FAST: None,
+            PROFILE_BALANCED: None,
+            PROFILE_ARCHIVAL: None,
+        },
+    },
+}
+ENCODER_LIST = list(ENCODER_CONFIG_DICT.keys())
+
+# encoder used for an output format when no encoder is given
+DEFAULT_ENCODER_DICT = {
+    'png': ENCODER_OPENCV_PNG,
+    'webp': ENCODER_PILLOW_WEBP,
+    'jpg': ENCODER_OPENCV_JPG,
+    'bmp': ENCODER_BMP,
+}
+OUTPUT_FORMAT_LIST = list(DEFAULT_ENCODER_DICT.keys())
+
+
+def resolve_encoder(output_format: str = None, encoder: str = None):
+    # returns the encoder to use, `output_format` and `encoder` may be None
+    if encoder is None:
+        if output_format is None:
+            output_format = 'png'
+        return DEFAULT_ENCODER_DICT[output_format]
+
+    encoder_format = ENCODER_CONFIG_DICT[encoder]['format']
+    if output_format is not None and output_format != encoder_format:
+        raise Exception(f'encoder {encoder} writes {encoder_format} files not {output_format} files')
+
+    return encoder
+
+
+def encode_image(
+    image: np.ndarray,
+    encoder: str,
+    profile: str = DEFAULT_PROFILE,
+):
+    # `image` has to be in the channel order of the encoder (see force_rgb in ENCODER_CONFIG_DICT)
+    # returns the content of the image file as a buffer
+    encoder_config = ENCODER_CONFIG_DICT[encoder]
+    encoder_params = encoder_config['profile_dict'][profile]
+
+    if encoder == ENCODER_BMP:
+        return b''.join(convert_numpy_array_to_bmp_chunk_list(image))
+    elif encoder in [ENCODER_OPENCV_PNG, ENCODER_OPENCV_JPG]:
+        is_success, encoded_array = cv2.imencode('.' + encoder_config['format'], image, encoder_params)
+        if not is_success:
+            raise Exception(f'{encoder} failed to encode the image {image.shape}')
+        return encoded_array
+    else:
+        outfile = io.BytesIO()
+        PIL.Image.fromarray(image).save(outfile, format=encoder_config['format'], **encoder_params)
+        return outfile.getbuffer()
+
+
+# thumbnails and contact sheets
+# the gap around the tiles and the height of the label under each tile
+CONTACT_SHEET_MARGIN = 4
+CONTACT_SHEET_LABEL_HEIGHT = 14
+CONTACT_SHEET_BACKGROUND_COLOR = (48, 48, 48)
+CONTACT_SHEET_LABEL_COLOR = (224, 224, 224)
+
+
+def resize_to_thumbnail(
+    image: np.ndarray,
+    max_edge: int,
+):
+    # shrink `image` so that its longest edge is at most `max_edge` pixels
+    # INTER_AREA averages all the pixels covered by each thumbnail pixel
+    # smaller images are returned as they are
+    height, width = image.shape[:2]
+    scale = max_edge / max(width, height)
+    if scale >= 1:
+        return image
+
+    thumbnail_width = max(1, round(width * scale))
+    thumbnail_height = max(1, round(height * scale))
+    return cv2.resize(image, (thumbnail_width, thumbnail_height), interpolation=cv2.INTER_AREA)
+
+
+def create_contact_sheet(
+    tile_list: list,
+    tile_size: int,
+    columns: int,
+):
+    # `tile_list` is a list of (label, image) with the images from
+    # resize_to_thumbnail (grayscale, BGR or BGRA)
+    # returns a BGR image with the tiles left to right, top to bottom and the
+    # label under each tile, transparent pixels are blended over the background
+    columns = max(1, min(columns, len(tile_list)))
+    rows = (len(tile_list) + columns - 1) // columns
+    cell_width = tile_size + CONTACT_SHEET_MARGIN
+    cell_height = tile_size + CONTACT_SHEET_LABEL_HEIGHT + CONTACT_SHEET_MARGIN
+
+    sheet_image = np.empty((rows * cell_height + CONTACT_SHEET_MARGIN, columns * cell_width + CONTACT_SHEET_MARGIN, 3), dtype=np.uint8)
+    sheet_image[:, :] = CONTACT_SHEET_BACKGROUND_COLOR
+    background_array = np.array(CONTACT_SHEET_BACKGROUND_COLOR, dtype=np.float32)
+    # about 6 pixels per character with the font below
+    max_label_length = max(1, tile_size // 6)
+
+    for tile_index, (label, image) in enumerate(tile_list):
+        top = (tile_index // columns) * cell_height + CONTACT_SHEET_MARGIN
+        left = (tile_index % columns) * cell_width + CONTACT_SHEET_MARGIN
+
+        height, width = image.shape[:2]
+        if len(image.shape) == 2:
+            tile_image = image[:, :, None]
+        elif image.shape[2] > 3:
+            alpha_array = image[:, :, -1:].astype(np.float32) / 255
+            tile_image = (image[:, :, :3] * alpha_array + background_array * (1 - alpha_array) + 0.5).astype(np.uint8)
+        else:
+            tile_image = image
+
+        # center the thumbnail in its tile
+        tile_top = top + (tile_size - height) // 2
+        tile_left = left + (tile_size - width) // 2
+        sheet_image[tile_top:tile_top + height, tile_left:tile_left + width] = tile_image
+
+        cv2.putText(
+            sheet_image,
+            label[:max_label_length],
+            (left, top + tile_size + CONTACT_SHEET_LABEL_HEIGHT - 3),
+            cv2.FONT_HERSHEY_SIMPLEX,
+            0.35,
+            CONTACT_SHEET_LABEL_COLOR,
+            1,
+            cv2.LINE_AA,
+        )
+
+    return sheet_image
+
+
+def decode_agf_data_for_encoder(
+    agf_content_bs: bytes,
+    encoder: str,
+    buffer_pool: dict = None,
+    thumbnail_size: int = None,
+):
+    # first half of write_agf_data_as_image
+    # returns the image array in the channel order of `encoder` or, for
+    # ENCODER_BMP, the list of buffers of the BMP file
+    # with `thumbnail_size` the image is shrunk with resize_to_thumbnail first
+    if thumbnail_size is not None:
+        image = convert_agf_data_to_numpy_array(
+            agf_content_bs=agf_content_bs,
+            force_rgb=ENCODER_CONFIG_DICT[encoder]['force_rgb'],
+            buffer_pool=buffer_pool,
+        )
+        image = resize_to_thumbnail(image, thumbnail_size)
+        if encoder == ENCODER_BMP:
+            return convert_numpy_array_to_bmp_chunk_list(image)
+        return image
+
+    if encoder == ENCODER_BMP:
+        return convert_agf_data_to_bmp_chunk_list(
+            agf_content_bs=agf_content_bs,
+            buffer_pool=buffer_pool,
+        )
+
+    return convert_agf_data_to_numpy_array(
+        agf_content_bs=agf_content_bs,
+        force_rgb=ENCODER_CONFIG_DICT[encoder]['force_rgb'],
+        buffer_pool=buffer_pool,
+    )
+
+
+def encode_decoded_agf_data(
+    decoded_agf_data,
+    encoder: str,
+    profile: str = DEFAULT_PROFILE,
+):
+    # second half of write_agf_data_as_image
+    # returns the list of buffers of the image file
+    if encoder == ENCODER_BMP:
+        return decoded_agf_data
+
+    return [encode_image(decoded_agf_data, encoder, profile)]
+
+
+def write_agf_data_as_image(
+    agf_content_bs: bytes,
+    output_filepath: str,
+    encoder: str,
+    profile: str = DEFAULT_PROFILE,
+    buffer_pool: dict = None,
+    thumbnail_size: int = None,
+):
+    decoded_agf_data = decode_agf_data_for_encoder(agf_content_bs, encoder, buffer_pool, thumbnail_size)
+    write_chunk_list(output_filepath, encode_decoded_agf_data(decoded_agf_data, encoder, profile))
+
+
 def find_agf_files(inpath: str, log_list: list):
     file_stat = os.stat(inpath)
     if stat.S_ISREG(file_stat.st_mode):
@@ -191,6 +960,7 @@ def create_converting_task_list(
     input_filepath_list: list,
     input_dir: str,
     output_dir: str,
+    output_format: str = 'png',
 ):
     task_list = []
 
@@ -201,7 +971,7 @@ def create_converting_task_list(
             if ext.lower() == '.png':
                 raise Exception(f'{input_filepath} has already been converted to PNG!')
 
-            output_filename = basename + '.png'
+            output_filename = basename + '.' + output_format
 
             parent_dir = os.path.dirname(input_filepath)
             output_filepath = os.path.join(parent_dir, output_filename)
@@ -218,7 +988,7 @@ def create_converting_task_list(
             if ext.lower() == '.png':
                 raise Exception(f'{input_filepath} has already been converted to PNG!')
 
-            output_filename = base_filename + '.png'
+            output_filename = base_filename + '.' + output_format
             output_parent_dir = os.path.join(output_dir, rel_parent)
             output_filepath = os.path.join(output_parent_dir, output_filename)
 
@@ -237,6 +1007,9 @@ def main():
     parser.add_argument('--force', action='store_true', help='overwrite existing files')
     parser.add_argument('-r', '--run', action='store_true', help='actually destroying your files')
     parser.add_argument('--clean', action='store_true', help='remove PNG files')
+    parser.add_argument('--output-format', default=None, choices=OUTPUT_FORMAT_LIST, help='output format (default: the format of --encoder or png)')
+    parser.add_argument('--encoder', default=None, choices=ENCODER_LIST, help=f'image encoder (default: {DEFAULT_ENCODER_DICT})')
+    parser.add_argument('--profile', default=DEFAULT_PROFILE, choices=PROFILE_LIST, help='encoding speed / file size trade-off')
 
     args = parser.parse_args()
     print('args', args)
@@ -246,6 +1019,13 @@ def main():
     force = args.force
     run = args.run
     clean = args.clean
+    profile = args.profile
+    try:
+        encoder = resolve_encoder(args.output_format, args.encoder)
+    except Exception as ex:
+        print(f'{shared.FG_RED}ERROR: {ex}{shared.RESET_COLOR}')
+        return
+    output_format = ENCODER_CONFIG_DICT[encoder]['format']
 
     if not os.path.exists(inpath):
         raise Exception(f'path {inpath} does not exist')
@@ -254,9 +1034,11 @@ def main():
     find_agf_files(inpath, agf_filepath_list)
     print('len(agf_filepath_list)', len(agf_filepath_list))
 
-    task_list = create_converting_task_list(agf_filepath_list, inpath, outpath)
+    task_list = create_converting_task_list(agf_filepath_list, inpath, outpath, output_format)
 
     error_log = []
+    # pixel storage reused between images of the same size
+    buffer_pool = {}
 
     pbar = tqdm.tqdm(task_list)
     for task_info in pbar:
@@ -281,17 +1063,17 @@ def main():
         agf_content_bs = open(input_filepath, 'rb').read()
 
         try:
-            # TODO handle BMP format with minimal processing to reduce execution time
-            rgb_image = convert_agf_data_to_numpy_array(
-                agf_content_bs=agf_content_bs,
-                force_rgb=True,
-            )
-
-            cv2_image = convert_rgb_to_opencv_format(rgb_image)
             parent_dir, filename = os.path.split(output_filepath)
             if not os.path.exists(parent_dir):
                 os.makedirs(parent_dir)
-            cv2.imwrite(output_filepath, cv2_image, [cv2.IMWRITE_PNG_COMPRESSION, 9])
+
+            write_agf_data_as_image(
+                agf_content_bs=agf_content_bs,
+                output_filepath=output_filepath,
+                encoder=encoder,
+                profile=profile,
+                buffer_pool=buffer_pool,
+            )
         except Exception as ex:
             stack_trace = traceback.format_exc()
             print(ex)
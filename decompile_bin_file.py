@@ -7,6 +7,8 @@ import pickle
 
 from tqdm import tqdm
 
+import shared
+
 
 def find_all_bin_files(
     inpath: str,
@@ -616,23 +618,7 @@ def decompile_bin_file(
         raise Exception(f'Invalid BIN file! header size: {real_header_size}')
 
     # unpacking header
-    header_content_unpack = struct.unpack('<8s13I', header_content_bs)
-    header_content = {
-        'signature_bs': header_content_unpack[0],
-        'int1': header_content_unpack[1],
-        'float1': header_content_unpack[2],
-        'string1': header_content_unpack[3],
-        'int2': header_content_unpack[4],
-        'unknown': header_content_unpack[5],
-        'string2': header_content_unpack[6],
-        'sub_header_size': header_content_unpack[7],
-        'table1_size': header_content_unpack[8],
-        'table1_offset': header_content_unpack[9],
-        'table2_size': header_content_unpack[10],
-        'table2_offset': header_content_unpack[11],
-        'table3_size': header_content_unpack[12],
-        'table3_offset': header_content_unpack[13],
-    }
+    header_content = shared.BinFileHeader._make(shared.BIN_FILE_HEADER_STRUCT.unpack(header_content_bs))
 
     smallest_table_offset = min(
         header_content['table1_offset'],
@@ -809,7 +795,7 @@ def make_obj_json_friendly(obj):
         return obj
     elif isinstance(obj, list):
         return [make_obj_json_friendly(x) for x in obj]
-    elif isinstance(obj, dict):
+    elif isinstance(obj, (dict, shared.RecordKeyAccessMixin)):
         return {
             make_obj_json_friendly(k): make_obj_json_friendly(v) for k, v in obj.items()
         }
@@ -1,5 +1,7 @@
 # decode lzss stream
+import os
 import io
+import array
 
 SIZE_OF_RING_BUFFER = 4096
 UPPER_LIMIT_OF_MATCH_LENGTH = 18
@@ -47,3 +49,435 @@ def decode(infile: io.BufferedReader):
                 r = (r + 1) % SIZE_OF_RING_BUFFER
 
     return outfile.getvalue()
+
+
+# r value of the ring buffer before any byte is decoded
+INITIAL_RING_POSITION = SIZE_OF_RING_BUFFER - UPPER_LIMIT_OF_MATCH_LENGTH
+RING_BUFFER_MASK = SIZE_OF_RING_BUFFER - 1
+
+
+def _split_flag_byte(flag_byte: int):
+    # split the 8 bits of a flag byte (LSB first) into runs of (is_literal, count)
+    segment_list = []
+    bit = 0
+    while bit < 8:
+        is_literal = (flag_byte >> bit) & 1
+        count = 1
+        while (bit + count) < 8 and ((flag_byte >> (bit + count)) & 1) == is_literal:
+            count += 1
+        segment_list.append((is_literal == 1, count))
+        bit += count
+    return tuple(segment_list)
+
+
+# precomputed runs for every possible flag byte so the decoder does not test bit by bit
+FLAG_SEGMENT_TABLE = tuple(_split_flag_byte(flag_byte) for flag_byte in range(256))
+
+
+def decode_into(src, dst):
+    # same stream format as `decode` but works on a bytes-like object and
+    # writes straight into the writable, C-contiguous buffer `dst`
+    # (bytearray, mmap, NumPy array, ...). The decoded length must be
+    # exactly the size of `dst` in bytes.
+    #
+    # the ring buffer is not kept separately. Ring position r always maps to
+    # output position o by r = (INITIAL_RING_POSITION + o) % SIZE_OF_RING_BUFFER
+    # so a back-reference is a copy from earlier in the output itself.
+    # Positions before the start of the output are the zero-filled initial ring.
+    src = memoryview(src).cast('B')
+    src_len = len(src)
+    out = memoryview(dst).cast('B')
+    original_length = len(out)
+
+    s = 0
+    o = 0
+    while s < src_len:
+        flag_byte = src[s]
+        s += 1
+
+        for is_literal, count in FLAG_SEGMENT_TABLE[flag_byte]:
+            if is_literal:
+                # copy the whole literal run in one go
+                available = src_len - s
+                if count > available:
+                    count = available
+
+                end = o + count
+                if end > original_length:
+                    raise Exception(f'LZSS output exceeds original_length {original_length}')
+
+                out[o:end] = src[s:s + count]
+                s += count
+                o = end
+
+                if s >= src_len:
+                    break
+            else:
+                for _ in range(count):
+                    if (s + 2) > src_len:
+                        s = src_len
+                        break
+
+                    i = src[s]
+                    j = src[s + 1]
+                    s += 2
+                    i |= (j & 0xf0) << 4
+                    length = (j & 0x0f) + THRESHOLD + 1
+
+                    # distance back from the current output position (1 to SIZE_OF_RING_BUFFER)
+                    distance = ((INITIAL_RING_POSITION + o - i - 1) & RING_BUFFER_MASK) + 1
+                    p = o - distance
+                    end = o + length
+                    if end > original_length:
+                        raise Exception(f'LZSS output exceeds original_length {original_length}')
+
+                    if p >= 0:
+                        if distance >= length:
+                            out[o:end] = out[p:p + length]
+                        else:
+                            # overlapping reference repeats the last `distance` bytes
+                            pattern = out[p:o].tobytes()
+                            out[o:end] = (pattern * (length // distance + 1))[:length]
+                    else:
+                        # reference into the zero-filled initial ring buffer
+                        for k in range(length):
+                            q = p + k
+                            out[o + k] = out[q] if q >= 0 else 0
+
+                    o = end
+
+                if s >= src_len:
+                    break
+
+    if o != original_length:
+        raise Exception(f'decoded length {o} not equal to original_length {original_length}')
+
+    return o
+
+
+def decode_bytes(src, original_length: int):
+    # decode into a preallocated bytearray of `original_length` bytes
+    out = bytearray(original_length)
+    decode_into(src, out)
+    return out
+
+
+# decoder backends for `decode_section_into`
+# - python: `decode_into`, always available
+# - numba: `lzss_numba.decode_into`, only if numba is installed
+# - numpy: `lzss_numpy.decode_into`, two-phase token parse + vectorized copy
+BACKEND_PYTHON = 'python'
+BACKEND_NUMBA = 'numba'
+BACKEND_NUMPY = 'numpy'
+BACKEND_LIST = [BACKEND_PYTHON, BACKEND_NUMBA, BACKEND_NUMPY]
+# set this environment variable to one of BACKEND_LIST to force a backend
+BACKEND_ENVIRONMENT_VARIABLE = 'PYAGE_LZSS_BACKEND'
+
+# backend name -> decode_into function, filled lazily because importing numba is slow
+_backend_function_dict = {}
+_selected_backend = None
+
+
+def load_backend(backend: str):
+    # returns the decode_into function of the backend
+    # raises ImportError if the backend dependencies are not installed
+    if backend in _backend_function_dict:
+        return _backend_function_dict[backend]
+
+    if backend == BACKEND_PYTHON:
+        decode_into_function = decode_into
+    elif backend == BACKEND_NUMBA:
+        import lzss_numba
+        decode_into_function = lzss_numba.decode_into
+    elif backend == BACKEND_NUMPY:
+        import lzss_numpy
+        decode_into_function = lzss_numpy.decode_into
+    else:
+        raise Exception(f'unknown LZSS backend {backend} - expecting one of {BACKEND_LIST}')
+
+    _backend_function_dict[backend] = decode_into_function
+    return decode_into_function
+
+
+def find_available_backends():
+    available_backend_list = []
+    for backend in BACKEND_LIST:
+        try:
+            load_backend(backend)
+        except ImportError:
+            continue
+        available_backend_list.append(backend)
+
+    return available_backend_list
+
+
+def set_backend(backend: str = None):
+    # force the backend used by `decode_section_into`
+    # None goes back to automatic selection
+    global _selected_backend
+    if backend is not None:
+        load_backend(backend)
+    _selected_backend = backend
+
+
+def get_backend():
+    # the backend used by `decode_section_into`
+    # priority: set_backend, BACKEND_ENVIRONMENT_VARIABLE, numba if installed, python
+    global _selected_backend
+    if _selected_backend is not None:
+        return _selected_backend
+
+    forced_backend = os.environ.get(BACKEND_ENVIRONMENT_VARIABLE)
+    if forced_backend:
+        # fail loudly instead of silently benchmarking the wrong backend
+        load_backend(forced_backend)
+        _selected_backend = forced_backend
+        return _selected_backend
+
+    try:
+        load_backend(BACKEND_NUMBA)
+        _selected_backend = BACKEND_NUMBA
+    except ImportError:
+        _selected_backend = BACKEND_PYTHON
+
+    return _selected_backend
+
+
+def decode_section_into(src, dst):
+    # `decode_into` with the fastest available (or forced) backend
+    return load_backend(get_backend())(src, dst)
+
+
+def decode_section(src, original_length: int):
+    # `decode_bytes` with the fastest available (or forced) backend
+    out = bytearray(original_length)
+    decode_section_into(src, out)
+    return out
+
+
+# compressed bytes read from the input at a time by `decode_iter`
+READ_BLOCK_SIZE = 65536
+# the largest flag group: 1 flag byte followed by 8 match tokens of 2 bytes
+MAX_FLAG_GROUP_SIZE = 1 + 8 * 2
+
+
+def decode_iter(
+    infile: io.BufferedReader,
+    length: int = None,
+    chunk_size: int = 65536,
+):
+    # incremental version of `decode`
+    # reads at most `length` compressed bytes (or until EOF if it is None)
+    # from `infile` and yields the decoded data in chunks of `chunk_size`
+    # bytes (the last one may be shorter). Only the last SIZE_OF_RING_BUFFER
+    # decoded bytes are kept between chunks.
+    if chunk_size < 1:
+        raise Exception(f'chunk_size must be positive - {chunk_size}')
+
+    # window starts with the zero-filled initial ring buffer so back-references
+    # never point before the start of the window
+    window = bytearray(SIZE_OF_RING_BUFFER)
+    # number of bytes decoded so far, needed to map ring positions to the window
+    o = 0
+
+    remaining = length
+    data = b''
+    s = 0
+    while True:
+        # make sure a whole flag group is available unless the input has ended
+        if (len(data) - s) < MAX_FLAG_GROUP_SIZE and (remaining is None or remaining > 0):
+            read_size = READ_BLOCK_SIZE if remaining is None else min(remaining, READ_BLOCK_SIZE)
+            block = infile.read(read_size)
+            if len(block) == 0:
+                remaining = 0
+            elif remaining is not None:
+                remaining -= len(block)
+            data = data[s:] + block
+            s = 0
+            continue
+
+        data_len = len(data)
+        if s >= data_len:
+            break
+
+        flag_byte = data[s]
+        s += 1
+
+        for is_literal, count in FLAG_SEGMENT_TABLE[flag_byte]:
+            if is_literal:
+                available = data_len - s
+                if count > available:
+                    count = available
+
+                window += data[s:s + count]
+                s += count
+                o += count
+            else:
+                for _ in range(count):
+                    if (s + 2) > data_len:
+                        s = data_len
+                        break
+
+                    i = data[s]
+                    j = data[s + 1]
+                    s += 2
+                    i |= (j & 0xf0) << 4
+                    match_length = (j & 0x0f) + THRESHOLD + 1
+
+                    distance = ((INITIAL_RING_POSITION + o - i - 1) & RING_BUFFER_MASK) + 1
+                    p = len(window) - distance
+                    if distance >= match_length:
+                        window += window[p:p + match_length]
+                    else:
+                        pattern = window[p:]
+                        window += (pattern * (match_length // distance + 1))[:match_length]
+
+                    o += match_length
+
+            if s >= data_len:
+                break
+
+        while (len(window) - SIZE_OF_RING_BUFFER) >= chunk_size:
+            yield bytes(window[SIZE_OF_RING_BUFFER:SIZE_OF_RING_BUFFER + chunk_size])
+            del window[:chunk_size]
+
+    if len(window) > SIZE_OF_RING_BUFFER:
+        yield bytes(window[SIZE_OF_RING_BUFFER:])
+
+
+# shortest match worth encoding (a match token takes 2 bytes)
+MIN_MATCH_LENGTH = THRESHOLD + 1
+MIN_EFFORT = 1
+MAX_EFFORT = 9
+DEFAULT_EFFORT = 5
+# effort level -> (number of hash chain candidates to try, lazy matching)
+EFFORT_CONFIG_DICT = {
+    1: (1, False),
+    2: (2, False),
+    3: (4, False),
+    4: (8, False),
+    5: (16, True),
+    6: (32, True),
+    7: (64, True),
+    8: (128, True),
+    9: (256, True),
+}
+
+
+def _find_longest_match(
+    data: bytes,
+    position: int,
+    head_dict: dict,
+    prev_array: array.array,
+    max_chain: int,
+):
+    # walk the hash chain of the 3 bytes at `position`
+    # returns (length, distance), length is 0 if no match is found
+    data_len = len(data)
+    max_length = min(UPPER_LIMIT_OF_MATCH_LENGTH, data_len - position)
+    if max_length < MIN_MATCH_LENGTH:
+        return 0, 0
+
+    key = (data[position] << 16) | (data[position + 1] << 8) | data[position + 2]
+    candidate = head_dict.get(key, -1)
+
+    best_length = 0
+    best_distance = 0
+    chain_count = 0
+    while candidate >= 0 and chain_count < max_chain:
+        distance = position - candidate
+        if distance > SIZE_OF_RING_BUFFER:
+            break
+
+        # the byte that would make this candidate longer than the best so far
+        if data[candidate + best_length] == data[position + best_length]:
+            length = 0
+            while length < max_length and data[candidate + length] == data[position + length]:
+                length += 1
+
+            if length > best_length:
+                best_length = length
+                best_distance = distance
+                if length == max_length:
+                    break
+
+        candidate = prev_array[candidate]
+        chain_count += 1
+
+    if best_length < MIN_MATCH_LENGTH:
+        return 0, 0
+
+    return best_length, best_distance
+
+
+def encode(data, effort: int = DEFAULT_EFFORT):
+    # encode `data` into the LZSS stream format read by `decode`
+    # `effort` from MIN_EFFORT (fastest) to MAX_EFFORT (smallest output)
+    # selects how many hash chain candidates are tried per position and
+    # whether lazy matching is used
+    if effort not in EFFORT_CONFIG_DICT:
+        raise Exception(f'effort must be between {MIN_EFFORT} and {MAX_EFFORT} - {effort}')
+
+    max_chain, lazy_matching = EFFORT_CONFIG_DICT[effort]
+
+    data = bytes(data)
+    data_len = len(data)
+
+    # hash chain over the 3 byte prefix at every position
+    # head_dict: prefix -> latest position, prev_array: position -> previous position with the same prefix
+    head_dict = {}
+    prev_array = array.array('i', [-1]) * data_len
+
+    def insert_position(position: int):
+        if (position + MIN_MATCH_LENGTH) <= data_len:
+            key = (data[position] << 16) | (data[position + 1] << 8) | data[position + 2]
+            prev_array[position] = head_dict.get(key, -1)
+            head_dict[key] = position
+
+    outfile = bytearray()
+    flag_position = 0
+    flag_bit = 8
+    flag_byte = 0
+
+    o = 0
+    while o < data_len:
+        if flag_bit == 8:
+            if o > 0:
+                outfile[flag_position] = flag_byte
+            flag_position = len(outfile)
+            outfile.append(0)
+            flag_bit = 0
+            flag_byte = 0
+
+        length, distance = _find_longest_match(data, o, head_dict, prev_array, max_chain)
+
+        if lazy_matching and 0 < length < UPPER_LIMIT_OF_MATCH_LENGTH:
+            # emit a literal instead if the match starting at the next byte is longer
+            insert_position(o)
+            next_length, _ = _find_longest_match(data, o + 1, head_dict, prev_array, max_chain)
+            if next_length > length:
+                length = 0
+            inserted_count = 1
+        else:
+            inserted_count = 0
+
+        if length == 0:
+            flag_byte |= 1 << flag_bit
+            outfile.append(data[o])
+            if inserted_count == 0:
+                insert_position(o)
+            o += 1
+        else:
+            i = (INITIAL_RING_POSITION + o - distance) & RING_BUFFER_MASK
+            outfile.append(i & 0xff)
+            outfile.append(((i >> 4) & 0xf0) | (length - MIN_MATCH_LENGTH))
+            for k in range(inserted_count, length):
+                insert_position(o + k)
+            o += length
+
+        flag_bit += 1
+
+    if data_len > 0:
+        outfile[flag_position] = flag_byte
+
+    return bytes(outfile)
@@ -0,0 +1,77 @@
+# Numba compiled LZSS decoder
+# this module is only imported by `lzss` when numba is installed
+import numba
+import numpy as np
+
+import lzss
+
+SIZE_OF_RING_BUFFER = lzss.SIZE_OF_RING_BUFFER
+THRESHOLD = lzss.THRESHOLD
+INITIAL_RING_POSITION = lzss.INITIAL_RING_POSITION
+RING_BUFFER_MASK = lzss.RING_BUFFER_MASK
+
+
+@numba.njit(cache=True, nogil=True)
+def decode_into_kernel(src, dst):
+    # same algorithm as `lzss.decode` with the ring buffer mapped onto the output
+    # returns the number of decoded bytes or -1 if the output overflows `dst`
+    src_len = src.shape[0]
+    original_length = dst.shape[0]
+
+    s = 0
+    o = 0
+    flags = 0
+    while True:
+        flags >>= 1
+        if (flags & 256) == 0:
+            if s >= src_len:
+                break
+            flags = np.int64(src[s]) | 0xff00
+            s += 1
+
+        if (flags & 1):
+            if s >= src_len:
+                break
+            if o >= original_length:
+                return -1
+            dst[o] = src[s]
+            s += 1
+            o += 1
+        else:
+            if (s + 2) > src_len:
+                break
+            i = np.int64(src[s])
+            j = np.int64(src[s + 1])
+            s += 2
+            i |= (j & 0xf0) << 4
+            length = (j & 0x0f) + THRESHOLD + 1
+
+            distance = ((INITIAL_RING_POSITION + o - i - 1) & RING_BUFFER_MASK) + 1
+            if (o + length) > original_length:
+                return -1
+
+            for _ in range(length):
+                q = o - distance
+                if q >= 0:
+                    dst[o] = dst[q]
+                else:
+                    dst[o] = 0
+                o += 1
+
+    return o
+
+
+def decode_into(src, dst):
+    # same interface as `lzss.decode_into`
+    src_array = np.frombuffer(memoryview(src).cast('B'), dtype=np.uint8)
+    dst_array = np.frombuffer(memoryview(dst).cast('B'), dtype=np.uint8)
+    original_length = dst_array.shape[0]
+
+    o = decode_into_kernel(src_array, dst_array)
+    if o < 0:
+        raise Exception(f'LZSS output exceeds original_length {original_length}')
+
+    if o != original_length:
+        raise Exception(f'decoded length {o} not equal to original_length {original_length}')
+
+    return o
@@ -0,0 +1,147 @@
+# two-phase LZSS decoder using NumPy
+# phase 1: parse the flag bytes into arrays of literal and match tokens
+# phase 2: build the output from the token arrays with vectorized operations
+#
+# a match copies bytes from earlier in the output, possibly from bytes that
+# are themselves produced by a match. Every output byte is given the position
+# it is copied from and these references are followed with pointer jumping
+# (ref = ref[ref]) until all of them land on a literal byte or on the
+# zero-filled initial ring buffer. The number of passes is logarithmic in the
+# length of the longest copy chain.
+import numpy as np
+
+import lzss
+
+INITIAL_RING_POSITION = lzss.INITIAL_RING_POSITION
+RING_BUFFER_MASK = lzss.RING_BUFFER_MASK
+THRESHOLD = lzss.THRESHOLD
+
+
+def _create_flag_tables():
+    # for every flag byte
+    # - is_literal_table: whether token k (LSB first) is a literal
+    # - token_offset_table: offset of token k from the flag byte
+    # - group_size_table: total size of the flag byte and its 8 tokens
+    is_literal_table = np.zeros((256, 8), dtype=bool)
+    token_offset_table = np.zeros((256, 8), dtype=np.int64)
+    group_size_table = np.zeros(256, dtype=np.int64)
+    for flag_byte in range(256):
+        offset = 1
+        for k in range(8):
+            is_literal = ((flag_byte >> k) & 1) == 1
+            is_literal_table[flag_byte, k] = is_literal
+            token_offset_table[flag_byte, k] = offset
+            offset += 1 if is_literal else 2
+        group_size_table[flag_byte] = offset
+
+    return is_literal_table, token_offset_table, group_size_table
+
+
+IS_LITERAL_TABLE, TOKEN_OFFSET_TABLE, GROUP_SIZE_TABLE = _create_flag_tables()
+GROUP_SIZE_LIST = GROUP_SIZE_TABLE.tolist()
+
+
+def parse_tokens(src):
+    # phase 1
+    # returns (token_is_literal, token_src_position, token_length, token_distance)
+    # token_distance is how far back from its output position a match copies
+    # from (0 for literals)
+    src_bs = bytes(src)
+    src_array = np.frombuffer(src_bs, dtype=np.uint8)
+    src_len = len(src_bs)
+
+    # the only sequential part: the position of every flag byte depends on
+    # the flag bytes before it
+    group_start_list = []
+    position = 0
+    while position < src_len:
+        group_start_list.append(position)
+        position += GROUP_SIZE_LIST[src_bs[position]]
+
+    group_start_array = np.array(group_start_list, dtype=np.int64)
+    flag_array = src_array[group_start_array]
+
+    token_is_literal = IS_LITERAL_TABLE[flag_array].reshape(-1)
+    token_src_position = (group_start_array[:, None] + TOKEN_OFFSET_TABLE[flag_array]).reshape(-1)
+
+    # drop the tokens that do not fit in the input, only the last flag group
+    # can be incomplete
+    token_size = np.where(token_is_literal, 1, 2)
+    is_complete = (token_src_position + token_size) <= src_len
+    number_of_tokens = int(np.count_nonzero(is_complete))
+    token_is_literal = token_is_literal[:number_of_tokens]
+    token_src_position = token_src_position[:number_of_tokens]
+
+    token_length = np.ones(number_of_tokens, dtype=np.int64)
+    token_ring_index = np.zeros(number_of_tokens, dtype=np.int64)
+
+    match_src_position = token_src_position[~token_is_literal]
+    i = src_array[match_src_position].astype(np.int64)
+    j = src_array[match_src_position + 1].astype(np.int64)
+    token_ring_index[~token_is_literal] = i | ((j & 0xf0) << 4)
+    token_length[~token_is_literal] = (j & 0x0f) + THRESHOLD + 1
+
+    token_out_position = np.cumsum(token_length) - token_length
+    token_distance = ((INITIAL_RING_POSITION + token_out_position - token_ring_index - 1) & RING_BUFFER_MASK) + 1
+    token_distance[token_is_literal] = 0
+
+    return token_is_literal, token_src_position, token_length, token_distance
+
+
+def materialize_tokens_into(
+    src,
+    token_is_literal: np.ndarray,
+    token_src_position: np.ndarray,
+    token_length: np.ndarray,
+    token_distance: np.ndarray,
+    dst,
+):
+    # phase 2
+    src_array = np.frombuffer(memoryview(src).cast('B'), dtype=np.uint8)
+    dst_array = np.frombuffer(memoryview(dst).cast('B'), dtype=np.uint8)
+    original_length = dst_array.shape[0]
+
+    decoded_length = int(token_length.sum())
+    if decoded_length > original_length:
+        raise Exception(f'LZSS output exceeds original_length {original_length}')
+    if decoded_length != original_length:
+        raise Exception(f'decoded length {decoded_length} not equal to original_length {original_length}')
+
+    # position original_length is a sentinel for the zero-filled initial ring buffer
+    sentinel = original_length
+    value_array = np.zeros(original_length + 1, dtype=np.uint8)
+    is_resolved = np.zeros(original_length + 1, dtype=bool)
+    is_resolved[sentinel] = True
+
+    # literal bytes are scattered to their place in one go
+    token_out_position = np.cumsum(token_length) - token_length
+    literal_out_position = token_out_position[token_is_literal]
+    value_array[literal_out_position] = src_array[token_src_position[token_is_literal]]
+    is_resolved[literal_out_position] = True
+
+    # every output byte refers to the position it is copied from (itself for literals)
+    ref = np.empty(original_length + 1, dtype=np.int64)
+    ref[:original_length] = np.arange(original_length, dtype=np.int64)
+    ref[:original_length] -= np.repeat(token_distance, token_length)
+    ref[ref < 0] = sentinel
+    ref[sentinel] = sentinel
+
+    # resolved positions point to themselves so following them is a no-op
+    while not is_resolved[ref].all():
+        ref = ref[ref]
+
+    np.take(value_array, ref[:original_length], out=dst_array)
+    return original_length
+
+
+def decode_into(src, dst):
+    # same interface as `lzss.decode_into`
+    token_is_literal, token_src_position, token_length, token_distance = parse_tokens(src)
+    return materialize_tokens_into(
+        src,
+        token_is_literal,
+        token_src_position,
+        token_length,
+        token_distance,
+        dst,
+    )
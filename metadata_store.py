@@ -0,0 +1,306 @@
+# indexed on-disk store of the metadata from SYS4INI.BIN and *.AAI files
+#
+# the metadata of every processed file is kept in an SQLite database next to
+# the size and mtime of the source file, process_metadata_file.py only parses
+# the files that changed since the last run. consumers can load everything
+# in the same shape as the pickle log (see load_metadata_log) or only look up
+# what they need by entry name or by (ALF file, offset).
+import os
+import pickle
+import sqlite3
+import collections
+
+import shared
+
+METADATA_STORE_FILENAME = 'metadata.sqlite'
+# the first bytes of every SQLite database file
+SQLITE_MAGIC = b'SQLite format 3\x00'
+# bump this when the tables change, older stores are rebuilt
+METADATA_STORE_VERSION = 1
+METADATA_STORE_MMAP_SIZE = 256 * 1024 * 1024
+
+METADATA_STORE_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS metadata_file (
+    metadata_id INTEGER PRIMARY KEY,
+    path TEXT NOT NULL UNIQUE,
+    mtime_ns INTEGER NOT NULL,
+    size INTEGER NOT NULL,
+    header_signature BLOB NOT NULL,
+    header_unknown BLOB NOT NULL
+);
+CREATE TABLE IF NOT EXISTS alf_file (
+    metadata_id INTEGER NOT NULL REFERENCES metadata_file (metadata_id) ON DELETE CASCADE,
+    alf_index INTEGER NOT NULL,
+    name BLOB NOT NULL,
+    PRIMARY KEY (metadata_id, alf_index)
+);
+CREATE TABLE IF NOT EXISTS archive_entry (
+    metadata_id INTEGER NOT NULL REFERENCES metadata_file (metadata_id) ON DELETE CASCADE,
+    entry_index INTEGER NOT NULL,
+    name BLOB NOT NULL,
+    archive_index INTEGER NOT NULL,
+    file_index INTEGER NOT NULL,
+    offset INTEGER NOT NULL,
+    length INTEGER NOT NULL,
+    PRIMARY KEY (metadata_id, entry_index)
+);
+CREATE INDEX IF NOT EXISTS archive_entry_name ON archive_entry (name);
+CREATE INDEX IF NOT EXISTS archive_entry_offset ON archive_entry (metadata_id, archive_index, offset);
+'''
+
+ARCHIVE_ENTRY_COLUMNS = 'name, archive_index, file_index, offset, length'
+
+
+def is_metadata_store_file(filepath: str):
+    with open(filepath, mode='rb') as infile:
+        return infile.read(len(SQLITE_MAGIC)) == SQLITE_MAGIC
+
+
+class MetadataStore:
+    def __init__(self, filepath: str):
+        self.filepath = os.path.abspath(filepath)
+        self.connection = sqlite3.connect(self.filepath)
+        self.connection.execute('PRAGMA foreign_keys = ON')
+        # read the database through a memory map instead of read calls
+        self.connection.execute(f'PRAGMA mmap_size = {METADATA_STORE_MMAP_SIZE}')
+
+        version = self.connection.execute('PRAGMA user_version').fetchone()[0]
+        if version != METADATA_STORE_VERSION:
+            with self.connection:
+                for table_name in ['archive_entry', 'alf_file', 'metadata_file']:
+                    self.connection.execute(f'DROP TABLE IF EXISTS {table_name}')
+                self.connection.executescript(METADATA_STORE_SCHEMA)
+                self.connection.execute(f'PRAGMA user_version = {METADATA_STORE_VERSION}')
+
+    def close(self):
+        self.connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def get_metadata_file_list(self):
+        # returns [{'metadata_id', 'path', 'mtime_ns', 'size'}] without loading any entry
+        cursor = self.connection.execute('SELECT metadata_id, path, mtime_ns, size FROM metadata_file ORDER BY metadata_id')
+        return [
+            {
+                'metadata_id': metadata_id,
+                'path': path,
+                'mtime_ns': mtime_ns,
+                'size': size,
+            }
+            for metadata_id, path, mtime_ns, size in cursor
+        ]
+
+    def get_metadata_id(self, metadata_filepath: str):
+        row = self.connection.execute('SELECT metadata_id FROM metadata_file WHERE path = ?', (os.path.abspath(metadata_filepath),)).fetchone()
+        return None if row is None else row[0]
+
+    def is_current(self, metadata_filepath: str):
+        # True if the file is in the store with the same mtime and size it has now
+        metadata_filepath = os.path.abspath(metadata_filepath)
+        row = self.connection.execute('SELECT mtime_ns, size FROM metadata_file WHERE path = ?', (metadata_filepath,)).fetchone()
+        if row is None:
+            return False
+
+        try:
+            file_stat = os.stat(metadata_filepath)
+        except FileNotFoundError:
+            return False
+
+        return row == (file_stat.st_mtime_ns, file_stat.st_size)
+
+    def put(self, metadata_info: dict, file_stat: os.stat_result):
+        # replace the entries of `metadata_info` (see process_metadata_file.process_metadata_file)
+        # `file_stat` is the stat of the metadata file when it was parsed
+        with self.connection:
+            self.connection.execute('DELETE FROM metadata_file WHERE path = ?', (metadata_info['path'],))
+            cursor = self.connection.execute(
+                'INSERT INTO metadata_file (path, mtime_ns, size, header_signature, header_unknown) VALUES (?, ?, ?, ?, ?)',
+                (metadata_info['path'], file_stat.st_mtime_ns, file_stat.st_size, metadata_info['header_signature'], metadata_info['header_unknown']),
+            )
+            metadata_id = cursor.lastrowid
+            self.connection.executemany(
+                'INSERT INTO alf_file (metadata_id, alf_index, name) VALUES (?, ?, ?)',
+                ((metadata_id, alf_index, entry['name']) for alf_index, entry in enumerate(metadata_info['alf_file_info_list'])),
+            )
+            self.connection.executemany(
+                f'INSERT INTO archive_entry (metadata_id, entry_index, {ARCHIVE_ENTRY_COLUMNS}) VALUES (?, ?, ?, ?, ?, ?, ?)',
+                (
+                    (metadata_id, entry_index, entry['name'], entry['archive_index'], entry['file_index'], entry['offset'], entry['length'])
+                    for entry_index, entry in enumerate(metadata_info['archive_entry_info_list'])
+                ),
+            )
+
+        return metadata_id
+
+    def remove_other_metadata_files(self, metadata_filepath_list: list):
+        # remove the metadata files that no longer exist or are not in
+        # `metadata_filepath_list` (e.g. the store was built from another directory)
+        # returns the removed paths
+        metadata_filepath_set = {os.path.abspath(metadata_filepath) for metadata_filepath in metadata_filepath_list}
+        removed_filepath_list = [
+            metadata_file_info['path']
+            for metadata_file_info in self.get_metadata_file_list()
+            if metadata_file_info['path'] not in metadata_filepath_set or not os.path.exists(metadata_file_info['path'])
+        ]
+        with self.connection:
+            self.connection.executemany('DELETE FROM metadata_file WHERE path = ?', ((path,) for path in removed_filepath_list))
+
+        return removed_filepath_list
+
+    def get_alf_file_info_list(self, metadata_id: int):
+        cursor = self.connection.execute('SELECT name FROM alf_file WHERE metadata_id = ? ORDER BY alf_index', (metadata_id,))
+        return [{'name': name} for name, in cursor]
+
+    def get_archive_entry_info_list(
+        self,
+        metadata_id: int,
+        archive_index: int = None,
+    ):
+        # the entries of a metadata file in their original order, only the
+        # ones of ALF file `archive_index` if given
+        if archive_index is None:
+            cursor = self.connection.execute(f'SELECT {ARCHIVE_ENTRY_COLUMNS} FROM archive_entry WHERE metadata_id = ? ORDER BY entry_index', (metadata_id,))
+        else:
+            cursor = self.connection.execute(f'SELECT {ARCHIVE_ENTRY_COLUMNS} FROM archive_entry WHERE metadata_id = ? AND archive_index = ? ORDER BY entry_index', (metadata_id, archive_index))
+
+        return list(map(shared.ArchiveEntryInfo._make, cursor))
+
+    def get_archive_index_count_dict(self, metadata_id: int):
+        # returns {archive_index: number of entries} of a metadata file
+        cursor = self.connection.execute('SELECT archive_index, COUNT(*) FROM archive_entry WHERE metadata_id = ? GROUP BY archive_index', (metadata_id,))
+        return dict(cursor.fetchall())
+
+    def get_metadata_info(self, metadata_id: int):
+        # the same dict as process_metadata_file.process_metadata_file
+        row = self.connection.execute('SELECT path, header_signature, header_unknown FROM metadata_file WHERE metadata_id = ?', (metadata_id,)).fetchone()
+        if row is None:
+            raise Exception(f'no metadata file with id {metadata_id} in {self.filepath}')
+
+        path, header_signature_bs, header_unknown_bs = row
+        return {
+            'path': path,
+            'header_signature': header_signature_bs,
+            'header_unknown': header_unknown_bs,
+            'alf_file_info_list': self.get_alf_file_info_list(metadata_id),
+            'archive_entry_info_list': self.get_archive_entry_info_list(metadata_id),
+        }
+
+    def find_archive_entry_list(self, name: bytes):
+        # returns [(metadata path, ALF file name, ArchiveEntryInfo)] of the entries named `name` in every metadata file
+        cursor = self.connection.execute(
+            f'''SELECT metadata_file.path, alf_file.name, {', '.join('archive_entry.' + column for column in ARCHIVE_ENTRY_COLUMNS.split(', '))}
+            FROM archive_entry
+            JOIN metadata_file ON metadata_file.metadata_id = archive_entry.metadata_id
+            LEFT JOIN alf_file ON alf_file.metadata_id = archive_entry.metadata_id AND alf_file.alf_index = archive_entry.archive_index
+            WHERE archive_entry.name = ?
+            ORDER BY archive_entry.metadata_id, archive_entry.entry_index''',
+            (name,),
+        )
+        return [(row[0], row[1], shared.ArchiveEntryInfo._make(row[2:])) for row in cursor]
+
+    def find_archive_entry_at(
+        self,
+        metadata_id: int,
+        archive_index: int,
+        offset: int,
+    ):
+        # returns the entry of ALF file `archive_index` that contains `offset` or None
+        row = self.connection.execute(
+            f'''SELECT {ARCHIVE_ENTRY_COLUMNS} FROM archive_entry
+            WHERE metadata_id = ? AND archive_index = ? AND offset <= ?
+            ORDER BY offset DESC LIMIT 1''',
+            (metadata_id, archive_index, offset),
+        ).fetchone()
+        if row is None:
+            return None
+
+        entry = shared.ArchiveEntryInfo._make(row)
+        if offset >= (entry.offset + entry.length):
+            return None
+
+        return entry
+
+
+def get_existing_metadata_file_list(store: MetadataStore):
+    # store.get_metadata_file_list without the metadata files that were
+    # removed, with a warning for them and for the ones that changed
+    metadata_file_info_list = []
+    for metadata_file_info in store.get_metadata_file_list():
+        metadata_filepath = metadata_file_info['path']
+        if not os.path.exists(metadata_filepath):
+            print(f'{shared.FG_YELLOW}WARNING: {metadata_filepath} does not exist anymore, it is skipped, run process_metadata_file.py again to remove it from {store.filepath}{shared.RESET_COLOR}')
+            continue
+
+        if not store.is_current(metadata_filepath):
+            print(f'{shared.FG_YELLOW}WARNING: {metadata_filepath} changed since it was added to {store.filepath}, run process_metadata_file.py again{shared.RESET_COLOR}')
+        metadata_file_info_list.append(metadata_file_info)
+
+    return metadata_file_info_list
+
+
+def load_metadata_log(filepath: str):
+    # returns the list of metadata dicts from a metadata store or a pickle log
+    if not is_metadata_store_file(filepath):
+        with open(filepath, mode='rb') as infile:
+            return pickle.load(infile)
+
+    with MetadataStore(filepath) as store:
+        return [store.get_metadata_info(metadata_file_info['metadata_id']) for metadata_file_info in get_existing_metadata_file_list(store)]
+
+
+def load_metadata_file_list(filepath: str):
+    # returns the list of metadata dicts like load_metadata_log but a
+    # metadata store only loads the ALF file names, the entries are read per
+    # ALF file with get_alf_archive_entry_info_list. a pickle log is loaded
+    # completely
+    if not is_metadata_store_file(filepath):
+        return load_metadata_log(filepath)
+
+    # the store stays open as long as the dicts use it
+    store = MetadataStore(filepath)
+    return [
+        {
+            'path': metadata_file_info['path'],
+            'alf_file_info_list': store.get_alf_file_info_list(metadata_file_info['metadata_id']),
+            'store': store,
+            'metadata_id': metadata_file_info['metadata_id'],
+        }
+        for metadata_file_info in get_existing_metadata_file_list(store)
+    ]
+
+
+def get_alf_archive_entry_info_list(
+    metadata_info: dict,
+    archive_index: int = None,
+):
+    # the entries of ALF file `archive_index` (all of them if None) of a
+    # metadata dict from load_metadata_file_list, in their original order
+    store = metadata_info.get('store')
+    if store is not None:
+        return store.get_archive_entry_info_list(metadata_info['metadata_id'], archive_index)
+
+    if archive_index is None:
+        return metadata_info['archive_entry_info_list']
+
+    # pickle log, the entries are grouped by ALF file once
+    archive_group_dict = metadata_info.get('archive_group_dict')
+    if archive_group_dict is None:
+        archive_group_dict = collections.defaultdict(list)
+        for entry in metadata_info['archive_entry_info_list']:
+            archive_group_dict[entry['archive_index']].append(entry)
+        metadata_info['archive_group_dict'] = archive_group_dict
+
+    return archive_group_dict.get(archive_index, [])
+
+
+def get_archive_index_count_dict(metadata_info: dict):
+    # returns {archive_index: number of entries} of a metadata dict from load_metadata_file_list
+    store = metadata_info.get('store')
+    if store is not None:
+        return store.get_archive_index_count_dict(metadata_info['metadata_id'])
+
+    return dict(collections.Counter(entry['archive_index'] for entry in metadata_info['archive_entry_info_list']))
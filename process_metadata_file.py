@@ -1,28 +1,32 @@
 # process metadata file SYS4INI.BIN and *.AAI
 import os
-import io
+import gc
 import time
 import struct
 import pickle
 import argparse
+import concurrent.futures
 
+import numpy as np
 from tqdm import tqdm
 
 import shared
+import metadata_store
 
-def trim_filename_data(filename_data_bs: bytes):
-    result = b''
-    for value in filename_data_bs:
-        if value == 0:
-            break
-        result += bytes([value])
+OUTPUT_FORMAT_SQLITE = 'sqlite'
+OUTPUT_FORMAT_PICKLE = 'pickle'
+OUTPUT_FORMAT_LIST = [OUTPUT_FORMAT_SQLITE, OUTPUT_FORMAT_PICKLE]
 
-    return result
 
+def trim_filename_data(filename_data_bs: bytes):
+    # the name ends at the first null byte, the bytes after it are unknown
+    return bytes(filename_data_bs).partition(b'\x00')[0]
 
 
 
-def process_metadata_file(inpath):
+
+def read_metadata_file(inpath):
+    # returns (header_signature_bs, header_unknown_bs, body_data_bs) with the LZSS section decoded
     infile = open(inpath, 'rb')
     # header format
     # - 240 bytes signature
@@ -50,22 +54,52 @@ def process_metadata_file(inpath):
     body_data_bs = shared.read_lzss_section(infile)
     infile.close()
 
+    return header_signature_bs, header_unknown_bs, body_data_bs
+
+
+def create_metadata_dict(
+    inpath: str,
+    header_signature_bs: bytes,
+    header_unknown_bs: bytes,
+    body_data_bs: bytes,
+):
+    alf_file_info_list, archive_entry_info_list = parse_metadata_body(body_data_bs)
+
+    return {
+        'path': os.path.abspath(inpath),
+        'header_signature': header_signature_bs,
+        'header_unknown': header_unknown_bs,
+        'alf_file_info_list': alf_file_info_list,
+        'archive_entry_info_list': archive_entry_info_list,
+    }
+
+
+def process_metadata_file(inpath):
+    return create_metadata_dict(inpath, *read_metadata_file(inpath))
+
+
+def parse_metadata_body(body_data_bs: bytes):
+    # returns (alf_file_info_list, archive_entry_info_list) of the decoded LZSS section of a metadata file
     # the first 4 bytes store the length of the table of content
-    stream = io.BytesIO(body_data_bs)
+    # the body is parsed by offset instead of wrapping it in a stream
+    body_data_view = memoryview(body_data_bs)
+    body_data_len = len(body_data_view)
+    offset = 0
 
     ####################################################################
-    bs = stream.read(4)
-    if len(bs) != 4:
-        raise Exception(f'bs length {len(bs)} != 4')
-    number_of_alf_files = struct.unpack('<I', bs)[0]
+    if (offset + 4) > body_data_len:
+        raise Exception(f'bs length {body_data_len - offset} != 4')
+    number_of_alf_files = struct.unpack_from('<I', body_data_view, offset)[0]
+    offset += 4
     ####################################################################
     # entry info data is stored after this in chunk of 256 bytes
     # the first few bytes are recognizable as the ALF file name
     # the remaining bytes are unknown for now
     expected_all_entry_info_length = number_of_alf_files * 256
-    all_entry_info_data_bs = stream.read(expected_all_entry_info_length)
+    all_entry_info_data_bs = body_data_view[offset:offset + expected_all_entry_info_length]
     if len(all_entry_info_data_bs) != expected_all_entry_info_length:
         raise Exception(f'len(all_entry_info_data_bs) != expected_all_entry_info_length - {len(all_entry_info_data_bs)} != {expected_all_entry_info_length}')
+    offset += expected_all_entry_info_length
     # split bytes into 256 byte chunks
     all_entry_info_data_list = [
         all_entry_info_data_bs[i*256:(i+1)*256]
@@ -80,38 +114,84 @@ def process_metadata_file(inpath):
         })
     ####################################################################
     # read the number of archive entries
-    bs = stream.read(4)
-    if len(bs) != 4:
-        raise Exception(f'failed to read number of archive entries len(bs) != 4 - {len(bs)}')
-    number_of_archive_entries = struct.unpack('<I', bs)[0]
+    if (offset + 4) > body_data_len:
+        raise Exception(f'failed to read number of archive entries len(bs) != 4 - {body_data_len - offset}')
+    number_of_archive_entries = struct.unpack_from('<I', body_data_view, offset)[0]
+    offset += 4
     ####################################################################
-    archive_entry_info_list = []
-    for i in range(number_of_archive_entries):
-        # the first 64 bytes contains the file name with null terminator
-        # after the null terminator the remaining bytes are unknown
-        # the next 4 bytes supposedly store the archive_index
-        # the next 4 bytes supposedly store the file_index
-        # the next 4 bytes supposedly store the offset
-        # the next 4 bytes supposedly store the length
-        bs = stream.read(80)
-        if len(bs) != 80:
-            raise Exception(f'failed to read archive entry #{i} len(bs) != 80 - {len(bs)}')
-        archive_entry_info_list.append({
-            'name': trim_filename_data(bs[0:64]),
-            'archive_index': struct.unpack('<I', bs[64:68])[0],
-            'file_index': struct.unpack('<I', bs[68:72])[0],
-            'offset': struct.unpack('<I', bs[72:76])[0],
-            'length': struct.unpack('<I', bs[76:80])[0],
-        })
+    # the first 64 bytes contains the file name with null terminator
+    # after the null terminator the remaining bytes are unknown
+    # the next 4 bytes supposedly store the archive_index
+    # the next 4 bytes supposedly store the file_index
+    # the next 4 bytes supposedly store the offset
+    # the next 4 bytes supposedly store the length
+    # the table is unpacked column by column with numpy, the 'S64' names lose
+    # their trailing null bytes but may still have unknown bytes after the
+    # first one
+    expected_archive_entry_table_length = number_of_archive_entries * shared.ARCHIVE_ENTRY_STRUCT.size
+    if (offset + expected_archive_entry_table_length) > body_data_len:
+        i = (body_data_len - offset) // shared.ARCHIVE_ENTRY_STRUCT.size
+        raise Exception(f'failed to read archive entry #{i} len(bs) != 80 - {(body_data_len - offset) % shared.ARCHIVE_ENTRY_STRUCT.size}')
+    archive_entry_table_view = body_data_view[offset:offset + expected_archive_entry_table_length]
+    offset += expected_archive_entry_table_length
+
+    archive_entry_table = np.frombuffer(archive_entry_table_view, dtype=shared.ARCHIVE_ENTRY_DTYPE)
+    # creating this many tuples runs the cyclic garbage collector over and
+    # over for nothing, it takes more time than the parsing
+    gc_enabled = gc.isenabled()
+    gc.disable()
+    try:
+        filename_list = [filename_data_bs.partition(b'\x00')[0] for filename_data_bs in archive_entry_table['name'].tolist()]
+        archive_entry_info_list = list(map(shared.ArchiveEntryInfo._make, zip(
+            filename_list,
+            archive_entry_table['archive_index'].tolist(),
+            archive_entry_table['file_index'].tolist(),
+            archive_entry_table['offset'].tolist(),
+            archive_entry_table['length'].tolist(),
+        )))
+    finally:
+        if gc_enabled:
+            gc.enable()
     ####################################################################
 
-    return {
-        'path': os.path.abspath(inpath),
-        'header_signature': header_signature_bs,
-        'header_unknown': header_unknown_bs,
-        'alf_file_info_list': alf_file_info_list,
-        'archive_entry_info_list': archive_entry_info_list,
-    }
+    return alf_file_info_list, archive_entry_info_list
+
+
+def read_metadata_file_with_stat(inpath):
+    # returns (file_stat, read_metadata_file(inpath)), the file is stat'ed
+    # before it is read so a change while parsing is seen next time
+    file_stat = os.stat(inpath)
+    return file_stat, read_metadata_file(inpath)
+
+
+def iter_processed_metadata_files(metadata_filepath_list: list, jobs: int):
+    # yields (metadata_filepath, file_stat, metadata_dict, exception) in the order of `metadata_filepath_list`
+    # with more than 1 job the files are read and their LZSS section decoded
+    # by worker processes, the decoded bytes are parsed here because sending
+    # back hundreds of thousands of entries costs more than parsing them
+    if jobs <= 1 or len(metadata_filepath_list) <= 1:
+        for metadata_filepath in metadata_filepath_list:
+            try:
+                file_stat, metadata_content = read_metadata_file_with_stat(metadata_filepath)
+                metadata_dict = create_metadata_dict(metadata_filepath, *metadata_content)
+            except Exception as ex:
+                yield metadata_filepath, None, None, ex
+                continue
+
+            yield metadata_filepath, file_stat, metadata_dict, None
+        return
+
+    with concurrent.futures.ProcessPoolExecutor(max_workers=min(jobs, len(metadata_filepath_list))) as executor:
+        future_list = [executor.submit(read_metadata_file_with_stat, metadata_filepath) for metadata_filepath in metadata_filepath_list]
+        for metadata_filepath, future in zip(metadata_filepath_list, future_list):
+            try:
+                file_stat, metadata_content = future.result()
+                metadata_dict = create_metadata_dict(metadata_filepath, *metadata_content)
+            except Exception as ex:
+                yield metadata_filepath, None, None, ex
+                continue
+
+            yield metadata_filepath, file_stat, metadata_dict, None
 
 
 def find_metadata_files(inpath: str, output_log: list):
@@ -131,6 +211,9 @@ def main():
     parser = argparse.ArgumentParser(description='Extract metadata from sys4ini.bin or *.aai files')
     parser.add_argument('inpath', help='input file or directory to search for sys4ini.bin or *.aai files')
     parser.add_argument('outdir', nargs='?', help='output directory to save extracted metadata info')
+    parser.add_argument('--format', default=OUTPUT_FORMAT_SQLITE, choices=OUTPUT_FORMAT_LIST, help=f'sqlite: update the indexed store {metadata_store.METADATA_STORE_FILENAME} (files with the same mtime and size are not parsed again), pickle: write a new metadata-list-*.pickle log')
+    parser.add_argument('--force', action='store_true', help='parse the files that are already in the store again')
+    parser.add_argument('--jobs', type=int, default=os.cpu_count(), help='number of worker processes reading and LZSS decoding the metadata files')
     args = parser.parse_args()
     print('args', args)
 
@@ -144,23 +227,50 @@ def main():
     if len(metadata_filepath_list) == 0:
         raise Exception('no metadata files found')
 
+    if outdir is not None and not os.path.exists(outdir):
+        os.makedirs(outdir)
+
+    if args.format == OUTPUT_FORMAT_SQLITE:
+        store_filepath = metadata_store.METADATA_STORE_FILENAME
+        if outdir is not None:
+            store_filepath = os.path.join(outdir, store_filepath)
+
+        with metadata_store.MetadataStore(store_filepath) as store:
+            changed_filepath_list = metadata_filepath_list
+            if not args.force:
+                changed_filepath_list = [metadata_filepath for metadata_filepath in metadata_filepath_list if not store.is_current(metadata_filepath)]
+
+            pbar = tqdm(iter_processed_metadata_files(changed_filepath_list, args.jobs), total=len(changed_filepath_list))
+            for metadata_filepath, file_stat, metadata_dict, ex in pbar:
+                pbar.set_description(metadata_filepath)
+                if ex is not None:
+                    print(f'failed to process metadata file {metadata_filepath} - {ex}')
+                    continue
+
+                store.put(metadata_dict, file_stat)
+
+            # the metadata files that were deleted or are from another input directory
+            removed_filepath_list = store.remove_other_metadata_files(metadata_filepath_list)
+
+        print('number_of_reused_files', len(metadata_filepath_list) - len(changed_filepath_list))
+        print('number_of_removed_files', len(removed_filepath_list))
+        print(f'store_filepath = {store.filepath}')
+        return
+
     log_filepath = f'metadata-list-{time.time_ns()}.pickle'
     if outdir is not None:
-        if not os.path.exists(outdir):
-            os.makedirs(outdir)
         log_filepath = os.path.join(outdir, log_filepath)
 
     log_list = []
-    pbar = tqdm(metadata_filepath_list)
-    for metadata_filepath in pbar:
+    pbar = tqdm(iter_processed_metadata_files(metadata_filepath_list, args.jobs), total=len(metadata_filepath_list))
+    for metadata_filepath, file_stat, metadata_dict, ex in pbar:
         pbar.set_description(metadata_filepath)
-        try:
-            metadata_dict = process_metadata_file(metadata_filepath)
-            log_list.append(metadata_dict)
-        except Exception as ex:
+        if ex is not None:
             print(f'failed to process metadata file {metadata_filepath} - {ex}')
             continue
 
+        log_list.append(metadata_dict)
+
     with open(log_filepath, 'wb') as outfile:
         pickle.dump(log_list, outfile)
 
@@ -0,0 +1,216 @@
+# persistent on-disk cache of decoded archive entries
+#
+# each cached file holds the content of one archive entry with its LZSS
+# sections already decoded (see convert_agf_to_png.decompress_agf_data) so
+# later runs only have to parse stored sections.
+#
+# the modification time of a cache file is its last use, the least recently
+# used files are removed when the total size goes over the byte budget.
+#
+# with several processes only one of them owns the budget. the others are
+# created with owner=False, they read and write cache files but never remove
+# any, they keep a list of the files they used instead which the owner
+# applies with add_usage_list so the directory stays under max_size.
+import os
+import time
+import hashlib
+
+# the key uses the ALF path, the entry offset and length and the ALF mtime and size
+CACHE_KEY_MODE_MTIME = 'mtime'
+# the key uses a hash of the raw entry bytes, the entry has to be read to look it up
+CACHE_KEY_MODE_HASH = 'hash'
+CACHE_KEY_MODE_LIST = [CACHE_KEY_MODE_MTIME, CACHE_KEY_MODE_HASH]
+
+CACHE_FILE_EXTENSION = '.cache'
+# bump this when the format of the cached content changes
+CACHE_VERSION = 1
+
+
+class DecodedSectionCache:
+    def __init__(
+        self,
+        cache_dir: str,
+        max_size: int,
+        key_mode: str = CACHE_KEY_MODE_MTIME,
+        owner: bool = True,
+    ):
+        if key_mode not in CACHE_KEY_MODE_LIST:
+            raise Exception(f'unknown cache key mode {key_mode} - expecting one of {CACHE_KEY_MODE_LIST}')
+
+        self.cache_dir = os.path.abspath(cache_dir)
+        self.max_size = max_size
+        self.key_mode = key_mode
+        self.owner = owner
+
+        self.hit_count = 0
+        self.miss_count = 0
+        self.hit_bytes = 0
+
+        # ALF path -> (st_mtime_ns, st_size)
+        self._source_stat_dict = {}
+
+        # cache file path -> (last use, size)
+        self._file_info_dict = {}
+        self.total_size = 0
+
+        # (key, size) of the files used since the last take_usage_list, only without owner
+        self._usage_list = []
+
+        if not os.path.exists(self.cache_dir):
+            os.makedirs(self.cache_dir, exist_ok=True)
+
+        if not owner:
+            return
+
+        for parent_dir, _, filename_list in os.walk(self.cache_dir):
+            for filename in filename_list:
+                if not filename.endswith(CACHE_FILE_EXTENSION):
+                    continue
+
+                cache_filepath = os.path.join(parent_dir, filename)
+                try:
+                    file_stat = os.stat(cache_filepath)
+                except FileNotFoundError:
+                    continue
+
+                self._file_info_dict[cache_filepath] = (file_stat.st_mtime_ns, file_stat.st_size)
+                self.total_size += file_stat.st_size
+
+    def make_key(
+        self,
+        alf_filepath: str,
+        offset: int,
+        length: int,
+        raw_content_bs: bytes = None,
+    ):
+        # `raw_content_bs` is only needed (and required) in CACHE_KEY_MODE_HASH
+        hasher = hashlib.blake2b(digest_size=20)
+        hasher.update(f'{CACHE_VERSION}:{self.key_mode}:'.encode('ascii'))
+
+        if self.key_mode == CACHE_KEY_MODE_MTIME:
+            alf_filepath = os.path.abspath(alf_filepath)
+            source_stat = self._source_stat_dict.get(alf_filepath)
+            if source_stat is None:
+                file_stat = os.stat(alf_filepath)
+                source_stat = (file_stat.st_mtime_ns, file_stat.st_size)
+                self._source_stat_dict[alf_filepath] = source_stat
+
+            hasher.update(repr((alf_filepath, offset, length, source_stat)).encode('utf-8'))
+        else:
+            if raw_content_bs is None:
+                raise Exception(f'raw_content_bs is required with cache key mode {CACHE_KEY_MODE_HASH}')
+
+            hasher.update(raw_content_bs)
+
+        return hasher.hexdigest()
+
+    def _get_cache_filepath(self, key: str):
+        # spread the files over 256 sub directories
+        return os.path.join(self.cache_dir, key[:2], key + CACHE_FILE_EXTENSION)
+
+    def contains(self, key: str):
+        # True if there is a file for `key`, it can still be removed before get
+        return os.path.exists(self._get_cache_filepath(key))
+
+    def get(self, key: str):
+        # returns the cached bytes or None
+        cache_filepath = self._get_cache_filepath(key)
+        try:
+            with open(cache_filepath, mode='rb') as infile:
+                content_bs = infile.read()
+        except FileNotFoundError:
+            self._forget(cache_filepath)
+            self.miss_count += 1
+            return None
+
+        # mark as recently used
+        now_ns = time.time_ns()
+        try:
+            os.utime(cache_filepath, ns=(now_ns, now_ns))
+        except OSError:
+            pass
+
+        self._use(key, cache_filepath, len(content_bs))
+        self.hit_count += 1
+        self.hit_bytes += len(content_bs)
+        return content_bs
+
+    def put(self, key: str, content_bs: bytes):
+        content_size = len(content_bs)
+        if content_size > self.max_size:
+            return
+
+        cache_filepath = self._get_cache_filepath(key)
+        parent_dir = os.path.dirname(cache_filepath)
+        if not os.path.exists(parent_dir):
+            os.makedirs(parent_dir, exist_ok=True)
+
+        # write to a temporary file first so other processes never see a partial file
+        tmp_filepath = f'{cache_filepath}.{os.getpid()}.tmp'
+        with open(tmp_filepath, mode='wb') as outfile:
+            outfile.write(content_bs)
+        os.replace(tmp_filepath, cache_filepath)
+
+        self._use(key, cache_filepath, content_size)
+        if self.total_size > self.max_size:
+            self.evict()
+
+    def _use(
+        self,
+        key: str,
+        cache_filepath: str,
+        size: int,
+    ):
+        if not self.owner:
+            self._usage_list.append((key, size))
+            return
+
+        self._forget(cache_filepath)
+        self._file_info_dict[cache_filepath] = (time.time_ns(), size)
+        self.total_size += size
+
+    def take_usage_list(self):
+        # returns and clears the (key, size) of the files used by a cache without owner
+        usage_list = self._usage_list
+        self._usage_list = []
+        return usage_list
+
+    def add_usage_list(self, usage_list: list):
+        # count the files used by another process (see take_usage_list) as
+        # recently used and remove the least recently used ones if needed
+        for key, size in usage_list:
+            self._use(key, self._get_cache_filepath(key), size)
+
+        if self.total_size > self.max_size:
+            self.evict()
+
+    def _forget(self, cache_filepath: str):
+        file_info = self._file_info_dict.pop(cache_filepath, None)
+        if file_info is not None:
+            self.total_size -= file_info[1]
+
+    def evict(self):
+        # remove the least recently used files until the cache fits in max_size
+        if not self.owner:
+            return
+
+        file_info_list = sorted(self._file_info_dict.items(), key=lambda item: item[1][0])
+        for cache_filepath, (last_use, size) in file_info_list:
+            if self.total_size <= self.max_size:
+                break
+
+            try:
+                os.remove(cache_filepath)
+            except FileNotFoundError:
+                pass
+
+            self._forget(cache_filepath)
+
+    def summary(self):
+        return {
+            'hit_count': self.hit_count,
+            'miss_count': self.miss_count,
+            'hit_bytes': self.hit_bytes,
+            'total_size': self.total_size,
+            'max_size': self.max_size,
+        }
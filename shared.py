@@ -1,5 +1,11 @@
 import io
+import os
 import struct
+import shutil
+import bisect
+import collections
+
+import numpy as np
 
 import lzss
 
@@ -32,7 +38,7 @@ def read_lzss_section(infile: io.BufferedReader):
             raise Exception(f'failed to read section content len(section_content_bs) = {len(section_content_bs)} expecting {length}')
 
         # decompress with lzss
-        decoded_section_content_bs = lzss.decode(io.BytesIO(section_content_bs))
+        decoded_section_content_bs = lzss.decode_section(section_content_bs, original_length)
         if len(decoded_section_content_bs) != original_length:
             raise Exception(f'decoded_section_content_bs length {len(decoded_section_content_bs)} not equal to original_length {original_length}')
 
@@ -44,6 +50,273 @@ def read_lzss_section(infile: io.BufferedReader):
         return bs
 
 
+def peek_lzss_section_header(infile: io.BufferedReader):
+    # read the 12 bytes section header without consuming it
+    # returns (original_length, original_length2, length)
+    current_offset = infile.tell()
+    section_header_bs = infile.read(12)
+    infile.seek(current_offset)
+    if len(section_header_bs) != 12:
+        raise Exception(f'failed to read section header len(section_header_bs) = {len(section_header_bs)}')
+
+    return struct.unpack('<3I', section_header_bs)
+
+
+def read_lzss_section_into(infile: io.BufferedReader, dst):
+    # same as read_lzss_section but the section content is written into the
+    # writable buffer `dst` owned by the caller (bytearray, NumPy array, ...)
+    # `dst` must be exactly original_length bytes long
+    section_header_bs = infile.read(12)
+    if len(section_header_bs) != 12:
+        raise Exception(f'failed to read section header len(section_header_bs) = {len(section_header_bs)}')
+
+    original_length, original_length2, length = struct.unpack('<3I', section_header_bs)
+
+    dst_view = memoryview(dst).cast('B')
+    if len(dst_view) != original_length:
+        raise Exception(f'destination buffer length {len(dst_view)} not equal to original_length {original_length}')
+
+    if original_length != length:
+        section_content_bs = infile.read(length)
+        if len(section_content_bs) != length:
+            raise Exception(f'failed to read section content len(section_content_bs) = {len(section_content_bs)} expecting {length}')
+
+        lzss.decode_section_into(section_content_bs, dst_view)
+    else:
+        number_of_read_bytes = infile.readinto(dst_view)
+        if number_of_read_bytes != length:
+            raise Exception(f'failed to read section content number_of_read_bytes = {number_of_read_bytes} expecting {length}')
+
+    return original_length
+
+
+def iter_lzss_section(infile: io.BufferedReader, chunk_size: int = 65536):
+    # incremental version of read_lzss_section
+    # yields the section content in chunks of `chunk_size` bytes without
+    # holding the whole compressed or decoded section in memory
+    section_header_bs = infile.read(12)
+    if len(section_header_bs) != 12:
+        raise Exception(f'failed to read section header len(section_header_bs) = {len(section_header_bs)}')
+
+    original_length, original_length2, length = struct.unpack('<3I', section_header_bs)
+
+    if original_length != length:
+        decoded_length = 0
+        for chunk_bs in lzss.decode_iter(infile, length=length, chunk_size=chunk_size):
+            decoded_length += len(chunk_bs)
+            if decoded_length > original_length:
+                raise Exception(f'decoded section content length exceeds original_length {original_length}')
+            yield chunk_bs
+
+        if decoded_length != original_length:
+            raise Exception(f'decoded section content length {decoded_length} not equal to original_length {original_length}')
+    else:
+        remaining = length
+        while remaining > 0:
+            bs = infile.read(min(remaining, chunk_size))
+            if len(bs) == 0:
+                raise Exception(f'failed to read section content, {remaining} of {length} bytes missing')
+            remaining -= len(bs)
+            yield bs
+
+
+LZSS_SECTION_HEADER_STRUCT = struct.Struct('<3I')
+
+
+def unpack_lzss_section_header(buffer, offset: int):
+    # returns (original_length, original_length2, length) of the section at `offset`
+    header_end = offset + LZSS_SECTION_HEADER_STRUCT.size
+    if header_end > len(buffer):
+        raise Exception(f'failed to read section header at offset {offset}, buffer length is {len(buffer)}')
+
+    return LZSS_SECTION_HEADER_STRUCT.unpack_from(buffer, offset)
+
+
+def read_lzss_section_from_buffer(buffer, offset: int):
+    # buffer based version of read_lzss_section for bytes, memoryview or mmap
+    # returns (section_view, next_offset)
+    # section_view is a memoryview of `buffer` (no copy) if the section is not
+    # compressed, otherwise a bytearray with the decoded content
+    original_length, original_length2, length = unpack_lzss_section_header(buffer, offset)
+
+    content_offset = offset + LZSS_SECTION_HEADER_STRUCT.size
+    next_offset = content_offset + length
+    if next_offset > len(buffer):
+        raise Exception(f'failed to read section content at offset {content_offset} expecting {length} bytes, buffer length is {len(buffer)}')
+
+    section_content_view = memoryview(buffer)[content_offset:next_offset]
+
+    if original_length != length:
+        decoded_section_content_bs = lzss.decode_section(section_content_view, original_length)
+        return decoded_section_content_bs, next_offset
+    else:
+        return section_content_view, next_offset
+
+
+def read_lzss_section_from_buffer_into(buffer, offset: int, dst):
+    # buffer based version of read_lzss_section_into
+    # returns next_offset
+    original_length, original_length2, length = unpack_lzss_section_header(buffer, offset)
+
+    dst_view = memoryview(dst).cast('B')
+    if len(dst_view) != original_length:
+        raise Exception(f'destination buffer length {len(dst_view)} not equal to original_length {original_length}')
+
+    content_offset = offset + LZSS_SECTION_HEADER_STRUCT.size
+    next_offset = content_offset + length
+    if next_offset > len(buffer):
+        raise Exception(f'failed to read section content at offset {content_offset} expecting {length} bytes, buffer length is {len(buffer)}')
+
+    section_content_view = memoryview(buffer)[content_offset:next_offset]
+
+    if original_length != length:
+        lzss.decode_section_into(section_content_view, dst_view)
+    else:
+        dst_view[:] = section_content_view
+
+    return next_offset
+
+
+def encode_lzss_section(section_content_bs: bytes, effort: int = lzss.DEFAULT_EFFORT):
+    # inverse of read_lzss_section
+    # returns the 12 bytes section header followed by the LZSS compressed data
+    # the data is stored as is if compressing does not make it smaller
+    # because original_length == length means uncompressed
+    original_length = len(section_content_bs)
+    encoded_section_content_bs = lzss.encode(section_content_bs, effort=effort)
+    if len(encoded_section_content_bs) >= original_length:
+        encoded_section_content_bs = bytes(section_content_bs)
+
+    length = len(encoded_section_content_bs)
+    # the meaning of original_length2 is unknown (see read_lzss_section) so it is written as original_length
+    section_header_bs = struct.pack('<3I', original_length, original_length, length)
+    return section_header_bs + encoded_section_content_bs
+
+
+def write_lzss_section(outfile: io.BufferedWriter, section_content_bs: bytes, effort: int = lzss.DEFAULT_EFFORT):
+    section_bs = encode_lzss_section(section_content_bs, effort=effort)
+    outfile.write(section_bs)
+    return len(section_bs)
+
+
+class RecordKeyAccessMixin:
+    # the records below used to be dicts, this lets them be read as
+    # record['offset'] as well as record.offset so existing code and
+    # previously saved pickle logs keep working
+    __slots__ = ()
+
+    def __getitem__(self, key):
+        if isinstance(key, str):
+            # only the fields, not the tuple methods like count and index
+            if key not in self._fields:
+                raise KeyError(key)
+            return getattr(self, key)
+        return tuple.__getitem__(self, key)
+
+    def __contains__(self, key):
+        # `'offset' in record` like a dict, other keys are looked up in the values
+        if isinstance(key, str):
+            return key in self._fields
+        return tuple.__contains__(self, key)
+
+    def get(self, key, default=None):
+        if key in self._fields:
+            return getattr(self, key)
+        return default
+
+    def keys(self):
+        return self._fields
+
+    def items(self):
+        return zip(self._fields, self)
+
+
+# BITMAPFILEHEADER (14 bytes), see parse_agf_bitmap_header_bs
+BITMAP_FILE_HEADER_STRUCT = struct.Struct('<HIHHI')
+
+
+class BitmapFileHeader(RecordKeyAccessMixin, collections.namedtuple('BitmapFileHeader', [
+    'bfType',
+    'bfSize',
+    'bfReserved1',
+    'bfReserved2',
+    'bfOffBits',
+])):
+    __slots__ = ()
+
+
+# BITMAPINFOHEADER (40 bytes), see parse_agf_bitmap_header_bs
+BITMAP_INFO_HEADER_STRUCT = struct.Struct('<I2i2H2I2i2I')
+
+
+class BitmapInfoHeader(RecordKeyAccessMixin, collections.namedtuple('BitmapInfoHeader', [
+    'biSize',
+    'biWidth',
+    'biHeight',
+    'biPlanes',
+    'biBitCount',
+    'biCompression',
+    'biSizeImage',
+    'biXPelsPerMeter',
+    'biYPelsPerMeter',
+    'biClrUsed',
+    'biClrImportant',
+])):
+    __slots__ = ()
+
+
+# archive entry in SYS4INI.BIN and *.AAI files (80 bytes)
+# - 64 bytes: file name with null terminator
+# - uint32: archive_index
+# - uint32: file_index
+# - uint32: offset
+# - uint32: length
+ARCHIVE_ENTRY_STRUCT = struct.Struct('<64s4I')
+# the same layout as a structured dtype to unpack a whole table at once
+ARCHIVE_ENTRY_DTYPE = np.dtype([
+    ('name', 'S64'),
+    ('archive_index', '<u4'),
+    ('file_index', '<u4'),
+    ('offset', '<u4'),
+    ('length', '<u4'),
+])
+if ARCHIVE_ENTRY_DTYPE.itemsize != ARCHIVE_ENTRY_STRUCT.size:
+    raise Exception(f'ARCHIVE_ENTRY_DTYPE is {ARCHIVE_ENTRY_DTYPE.itemsize} bytes but ARCHIVE_ENTRY_STRUCT is {ARCHIVE_ENTRY_STRUCT.size} bytes')
+
+
+class ArchiveEntryInfo(RecordKeyAccessMixin, collections.namedtuple('ArchiveEntryInfo', [
+    'name',
+    'archive_index',
+    'file_index',
+    'offset',
+    'length',
+])):
+    __slots__ = ()
+
+
+# BIN script file header (60 bytes), see decompile_bin_file.py
+BIN_FILE_HEADER_STRUCT = struct.Struct('<8s13I')
+
+
+class BinFileHeader(RecordKeyAccessMixin, collections.namedtuple('BinFileHeader', [
+    'signature_bs',
+    'int1',
+    'float1',
+    'string1',
+    'int2',
+    'unknown',
+    'string2',
+    'sub_header_size',
+    'table1_size',
+    'table1_offset',
+    'table2_size',
+    'table2_offset',
+    'table3_size',
+    'table3_offset',
+])):
+    __slots__ = ()
+
+
 AGF_TYPE_24BIT = 1
 AGF_TYPE_32BIT = 2
 
@@ -90,14 +363,7 @@ def parse_agf_bitmap_header_bs(bitmap_header_bs: bytes):
     ####################################################################
     # BITMAPFILEHEADER
     bitmap_file_header_bs = bitmap_header_bs[0:14]
-    bfType, bfSize, bfReserved1, bfReserved2, bfOffBits = struct.unpack('<HIHHI', bitmap_file_header_bs)
-    bitmap_file_header = {
-        'bfType': bfType,
-        'bfSize': bfSize,
-        'bfReserved1': bfReserved1,
-        'bfReserved2': bfReserved2,
-        'bfOffBits': bfOffBits
-    }
+    bitmap_file_header = BitmapFileHeader._make(BITMAP_FILE_HEADER_STRUCT.unpack(bitmap_file_header_bs))
     ####################################################################
     # after the BITMAPFILEHEADER we have 2 bytes probably for padding
     # BITMAPINFOHEADER
@@ -125,20 +391,7 @@ def parse_agf_bitmap_header_bs(bitmap_header_bs: bytes):
     #     'biClrImportant': bitmap_info_header_bs[36:40],
     # }
 
-    biSize, biWidth, biHeight, biPlanes, biBitCount, biCompression, biSizeImage, biXPelsPerMeter, biYPelsPerMeter, biClrUsed, biClrImportant = struct.unpack('<I2i2H2I2i2I', bitmap_info_header_bs)
-    bitmap_info_header = {
-        'biSize': biSize,
-        'biWidth': biWidth,
-        'biHeight': biHeight,
-        'biPlanes': biPlanes,
-        'biBitCount': biBitCount,
-        'biCompression': biCompression,
-        'biSizeImage': biSizeImage,
-        'biXPelsPerMeter': biXPelsPerMeter,
-        'biYPelsPerMeter': biYPelsPerMeter,
-        'biClrUsed': biClrUsed,
-        'biClrImportant': biClrImportant,
-    }
+    bitmap_info_header = BitmapInfoHeader._make(BITMAP_INFO_HEADER_STRUCT.unpack(bitmap_info_header_bs))
     ####################################################################
     # RGBQUAD
     # if this image is 32 bit, then we have to parse the RGBQUAD
@@ -159,3 +412,142 @@ def parse_agf_bitmap_header_bs(bitmap_header_bs: bytes):
         'BITMAPINFOHEADER': bitmap_info_header,
         'RGBQUAD': rgb_quad_array_bs,
     }
+
+
+# ways to give a file the content of another one, see link_file
+LINK_MODE_HARDLINK = 'hardlink'
+LINK_MODE_REFLINK = 'reflink'
+LINK_MODE_COPY = 'copy'
+LINK_MODE_LIST = [LINK_MODE_HARDLINK, LINK_MODE_REFLINK, LINK_MODE_COPY]
+
+# FICLONE from linux/fs.h, shares the extents of a file on btrfs / XFS
+FICLONE = 0x40049409
+
+
+def link_file(src: str, dst: str, link_mode: str):
+    # make `dst` a file with the content of `src`
+    # - hardlink: both names point to the same file
+    # - reflink: copy-on-write clone, the data is shared until one file is modified
+    # falls back to a copy if the file system cannot do it (different devices,
+    # no reflink support, not Linux)
+    # returns the link mode that was used
+    if link_mode not in LINK_MODE_LIST:
+        raise Exception(f'unknown link mode {link_mode} - expecting one of {LINK_MODE_LIST}')
+
+    if os.path.lexists(dst):
+        os.remove(dst)
+
+    if link_mode == LINK_MODE_HARDLINK:
+        try:
+            os.link(src, dst)
+            return LINK_MODE_HARDLINK
+        except OSError:
+            pass
+    elif link_mode == LINK_MODE_REFLINK:
+        try:
+            import fcntl
+            with open(src, mode='rb') as infile, open(dst, mode='wb') as outfile:
+                fcntl.ioctl(outfile.fileno(), FICLONE, infile.fileno())
+            return LINK_MODE_REFLINK
+        except (ImportError, OSError):
+            if os.path.lexists(dst):
+                os.remove(dst)
+
+    shutil.copyfile(src, dst)
+    return LINK_MODE_COPY
+
+
+# coalesced reads of archive entries
+# the entries are read in offset order and entries that are at most `max_gap`
+# bytes apart are merged into one read of up to `max_chunk_size` bytes, the
+# gaps are read and thrown away
+DEFAULT_READ_GAP = 64 * 1024
+DEFAULT_READ_CHUNK_SIZE = 16 * 1024 * 1024
+
+
+def create_read_chunk_list(
+    entry_list: list,
+    max_gap: int = DEFAULT_READ_GAP,
+    max_chunk_size: int = DEFAULT_READ_CHUNK_SIZE,
+):
+    # `entry_list` is a list of (key, archive_info) with the 'offset' and 'length' of each entry
+    # returns a list of {'offset', 'length', 'entry_list'} sorted by offset, the
+    # entry_list of each chunk is sorted by offset too
+    # an entry larger than `max_chunk_size` gets a chunk on its own, with
+    # `max_chunk_size` 0 every entry does
+    chunk_list = []
+    chunk_info = None
+    for key, archive_info in sorted(entry_list, key=lambda entry: entry[1]['offset']):
+        offset = archive_info['offset']
+        end = offset + archive_info['length']
+        if chunk_info is not None:
+            chunk_end = chunk_info['offset'] + chunk_info['length']
+            # overlapping entries are always merged
+            if offset < chunk_end or ((offset - chunk_end) <= max_gap and (max(end, chunk_end) - chunk_info['offset']) <= max_chunk_size):
+                chunk_info['length'] = max(end, chunk_end) - chunk_info['offset']
+                chunk_info['entry_list'].append((key, archive_info))
+                continue
+
+        chunk_info = {
+            'offset': offset,
+            'length': end - offset,
+            'entry_list': [(key, archive_info)],
+        }
+        chunk_list.append(chunk_info)
+
+    return chunk_list
+
+
+class CoalescingReader:
+    # reads the entries of `chunk_list` (see create_read_chunk_list) from
+    # `infile`, the chunk of an entry is read on the first read inside it and
+    # kept until a read outside of it, ranges that are not in any chunk are
+    # read directly
+    def __init__(self, infile: io.BufferedReader, chunk_list: list):
+        self.infile = infile
+        self.chunk_list = chunk_list
+        self.chunk_offset_list = [chunk_info['offset'] for chunk_info in chunk_list]
+        self.chunk_info = None
+        self.chunk_bs = None
+        self.read_count = 0
+        self.read_bytes = 0
+
+    def read_range(self, offset: int, length: int):
+        self.infile.seek(offset)
+        content_bs = self.infile.read(length)
+        self.read_count += 1
+        self.read_bytes += len(content_bs)
+        return content_bs
+
+    def find_chunk(self, offset: int, length: int):
+        chunk_index = bisect.bisect_right(self.chunk_offset_list, offset) - 1
+        if chunk_index < 0:
+            return None
+
+        chunk_info = self.chunk_list[chunk_index]
+        if (offset + length) > (chunk_info['offset'] + chunk_info['length']):
+            return None
+
+        return chunk_info
+
+    def read_view(self, offset: int, length: int):
+        # returns a memoryview of the range without copying it out of the chunk
+        chunk_info = self.chunk_info
+        if chunk_info is None or offset < chunk_info['offset'] or (offset + length) > (chunk_info['offset'] + chunk_info['length']):
+            chunk_info = self.find_chunk(offset, length)
+            if chunk_info is None:
+                return memoryview(self.read_range(offset, length))
+
+            self.chunk_info = chunk_info
+            self.chunk_bs = self.read_range(chunk_info['offset'], chunk_info['length'])
+
+        start = offset - chunk_info['offset']
+        return memoryview(self.chunk_bs)[start:start + length]
+
+    def read(self, offset: int, length: int):
+        content_view = self.read_view(offset, length)
+        # a chunk of one entry is returned as it is
+        if len(content_view) == len(content_view.obj):
+            return content_view.obj
+
+        return content_view.tobytes()
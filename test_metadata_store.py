@@ -0,0 +1,73 @@
+import os
+
+import shared
+import metadata_store
+
+
+def create_metadata_info(metadata_filepath: str):
+    with open(metadata_filepath, mode='wb') as outfile:
+        outfile.write(b'S4IC')
+
+    return {
+        'path': os.path.abspath(metadata_filepath),
+        'header_signature': b'S4IC',
+        'header_unknown': bytes(60),
+        'alf_file_info_list': [{'name': b'DATA1.ALF'}, {'name': b'DATA2.ALF'}],
+        'archive_entry_info_list': [
+            shared.ArchiveEntryInfo(b'IMG001.AGF', 1, 0, 0, 100),
+            shared.ArchiveEntryInfo(b'IMG002.AGF', 0, 1, 0, 200),
+            shared.ArchiveEntryInfo(b'IMG003.AGF', 1, 2, 100, 300),
+        ],
+    }
+
+
+def test_alf_archive_entry_info_list(tmp_path):
+    metadata_info = create_metadata_info(str(tmp_path / 'SYS4INI.BIN'))
+    store_filepath = str(tmp_path / metadata_store.METADATA_STORE_FILENAME)
+    with metadata_store.MetadataStore(store_filepath) as store:
+        store.put(metadata_info, os.stat(metadata_info['path']))
+
+    stored_metadata_info, = metadata_store.load_metadata_file_list(store_filepath)
+    assert 'archive_entry_info_list' not in stored_metadata_info
+    for archive_index in [None, 0, 1, 2]:
+        expected_list = metadata_store.get_alf_archive_entry_info_list(dict(metadata_info), archive_index)
+        assert metadata_store.get_alf_archive_entry_info_list(stored_metadata_info, archive_index) == expected_list
+
+    assert [entry.name for entry in metadata_store.get_alf_archive_entry_info_list(stored_metadata_info, 1)] == [b'IMG001.AGF', b'IMG003.AGF']
+    stored_metadata_info['store'].close()
+
+
+def test_remove_other_metadata_files(tmp_path):
+    kept_metadata_info = create_metadata_info(str(tmp_path / 'SYS4INI.BIN'))
+    deleted_metadata_info = create_metadata_info(str(tmp_path / 'APPEND01.AAI'))
+    other_dir = tmp_path / 'other'
+    other_dir.mkdir()
+    other_metadata_info = create_metadata_info(str(other_dir / 'SYS4INI.BIN'))
+
+    store_filepath = str(tmp_path / metadata_store.METADATA_STORE_FILENAME)
+    with metadata_store.MetadataStore(store_filepath) as store:
+        for metadata_info in [kept_metadata_info, deleted_metadata_info, other_metadata_info]:
+            store.put(metadata_info, os.stat(metadata_info['path']))
+
+        os.remove(deleted_metadata_info['path'])
+        # a metadata file that is gone is skipped when loading
+        assert [metadata_info['path'] for metadata_info in metadata_store.load_metadata_log(store_filepath)] == [kept_metadata_info['path'], other_metadata_info['path']]
+
+        removed_filepath_list = store.remove_other_metadata_files([kept_metadata_info['path'], deleted_metadata_info['path']])
+        assert sorted(removed_filepath_list) == sorted([deleted_metadata_info['path'], other_metadata_info['path']])
+        assert [metadata_file_info['path'] for metadata_file_info in store.get_metadata_file_list()] == [kept_metadata_info['path']]
+        assert store.get_archive_entry_info_list(store.get_metadata_id(kept_metadata_info['path'])) == kept_metadata_info['archive_entry_info_list']
+
+
+def test_archive_index_count_dict(tmp_path):
+    metadata_info = create_metadata_info(str(tmp_path / 'SYS4INI.BIN'))
+    # an entry of an ALF file that is not in alf_file_info_list
+    metadata_info['archive_entry_info_list'].append(shared.ArchiveEntryInfo(b'IMG004.AGF', 5, 3, 0, 400))
+    store_filepath = str(tmp_path / metadata_store.METADATA_STORE_FILENAME)
+    with metadata_store.MetadataStore(store_filepath) as store:
+        store.put(metadata_info, os.stat(metadata_info['path']))
+
+    stored_metadata_info, = metadata_store.load_metadata_file_list(store_filepath)
+    assert metadata_store.get_archive_index_count_dict(stored_metadata_info) == {0: 1, 1: 2, 5: 1}
+    assert metadata_store.get_archive_index_count_dict(metadata_info) == {0: 1, 1: 2, 5: 1}
+    stored_metadata_info['store'].close()
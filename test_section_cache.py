@@ -0,0 +1,40 @@
+import os
+
+import section_cache
+
+
+def get_directory_size(dirpath: str):
+    return sum(
+        os.path.getsize(os.path.join(parent_dir, filename))
+        for parent_dir, _, filename_list in os.walk(dirpath)
+        for filename in filename_list
+    )
+
+
+def test_put_evicts_least_recently_used(tmp_path):
+    cache = section_cache.DecodedSectionCache(str(tmp_path), max_size=3000)
+    for index in range(5):
+        cache.put(f'{index:02x}key', bytes(1000))
+
+    assert cache.total_size <= 3000
+    assert get_directory_size(str(tmp_path)) <= 3000
+    assert cache.get('04key') is not None
+    assert cache.get('00key') is None
+
+
+def test_workers_stay_under_max_size(tmp_path):
+    # the workers of unpack_all_images.py --jobs only report the files they
+    # used, the owner in the parent process keeps the directory under max_size
+    max_size = 10000
+    cache = section_cache.DecodedSectionCache(str(tmp_path), max_size=max_size)
+    worker_cache_list = [section_cache.DecodedSectionCache(str(tmp_path), max_size=max_size, owner=False) for _ in range(4)]
+    for index in range(40):
+        worker_cache = worker_cache_list[index % len(worker_cache_list)]
+        worker_cache.put(f'{index:02x}key', bytes(1000))
+        if index % len(worker_cache_list) == len(worker_cache_list) - 1:
+            for worker_cache in worker_cache_list:
+                cache.add_usage_list(worker_cache.take_usage_list())
+            assert get_directory_size(str(tmp_path)) <= max_size
+
+    assert cache.total_size == get_directory_size(str(tmp_path))
+    assert section_cache.DecodedSectionCache(str(tmp_path), max_size=max_size).total_size <= max_size
@@ -0,0 +1,66 @@
+import io
+
+import numpy as np
+
+import shared
+
+
+def test_record_key_access():
+    archive_entry_info = shared.ArchiveEntryInfo(b'IMG001.AGF', 0, 1, 1024, 256)
+
+    assert archive_entry_info['offset'] == 1024
+    assert archive_entry_info.get('length') == 256
+    assert archive_entry_info[3] == 1024
+
+    # tuple methods are not keys
+    assert archive_entry_info.get('count') is None
+    assert archive_entry_info.get('index', 'default') == 'default'
+    try:
+        archive_entry_info['count']
+        raise AssertionError('expected KeyError')
+    except KeyError:
+        pass
+
+
+def test_record_contains():
+    archive_entry_info = shared.ArchiveEntryInfo(b'IMG001.AGF', 0, 1, 1024, 256)
+
+    assert 'offset' in archive_entry_info
+    assert 'name' in archive_entry_info
+    assert 'count' not in archive_entry_info
+    assert 'missing' not in archive_entry_info
+    assert 1024 in archive_entry_info
+    assert b'IMG001.AGF' in archive_entry_info
+
+
+def test_archive_entry_dtype_matches_struct():
+    assert shared.ARCHIVE_ENTRY_DTYPE.itemsize == shared.ARCHIVE_ENTRY_STRUCT.size
+
+    entry_bs = shared.ARCHIVE_ENTRY_STRUCT.pack(b'IMG001.AGF', 1, 2, 3, 4)
+    entry = np.frombuffer(entry_bs, dtype=shared.ARCHIVE_ENTRY_DTYPE)[0]
+    assert (entry['name'], entry['archive_index'], entry['file_index'], entry['offset'], entry['length']) == (b'IMG001.AGF', 1, 2, 3, 4)
+
+
+def test_coalescing_reader_reads_only_requested_entries():
+    # 1000 adjacent entries of 10 KiB, only every 50th one is needed
+    entry_length = 10 * 1024
+    content_bs = bytes(range(256)) * (1000 * entry_length // 256)
+    archive_list = [{'offset': index * entry_length, 'length': entry_length} for index in range(1000)]
+    requested_entry_list = [(index, archive_info) for index, archive_info in enumerate(archive_list) if index % 50 == 0]
+
+    chunk_list = shared.create_read_chunk_list(requested_entry_list)
+    alf_reader = shared.CoalescingReader(io.BytesIO(content_bs), chunk_list)
+    for index, archive_info in requested_entry_list:
+        assert alf_reader.read(archive_info['offset'], archive_info['length']) == content_bs[archive_info['offset']:archive_info['offset'] + entry_length]
+
+    assert alf_reader.read_count == len(requested_entry_list)
+    assert alf_reader.read_bytes == len(requested_entry_list) * entry_length
+
+    # nearby requested entries are still read together
+    chunk_list = shared.create_read_chunk_list([(index, archive_list[index]) for index in [10, 11, 13]])
+    alf_reader = shared.CoalescingReader(io.BytesIO(content_bs), chunk_list)
+    for index in [10, 11, 13]:
+        alf_reader.read(archive_list[index]['offset'], entry_length)
+
+    assert alf_reader.read_count == 1
+    assert alf_reader.read_bytes == 4 * entry_length
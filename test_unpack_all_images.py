@@ -0,0 +1,25 @@
+import multiprocessing
+
+import unpack_all_images
+
+
+def test_register_dedup_entry_with_shared_output_dict():
+    with multiprocessing.Manager() as manager:
+        output_dict = manager.dict()
+        # one dedup_state per worker process, the output_dict is shared
+        first_dedup_state = unpack_all_images.create_dedup_state(output_dict)
+        second_dedup_state = unpack_all_images.create_dedup_state(output_dict)
+
+        assert not unpack_all_images.register_dedup_entry(first_dedup_state, b'same', 'DATA1.ALF/IMG001.png', ('DATA1.ALF', 0))
+        assert unpack_all_images.register_dedup_entry(second_dedup_state, b'same', 'APPEND01.ALF/IMG001.png', ('APPEND01.ALF', 0))
+        # the same output path with the same bytes is still a duplicate if it is another entry
+        assert unpack_all_images.register_dedup_entry(second_dedup_state, b'same', 'DATA1.ALF/IMG001.png', ('DATA1.ALF', 1024))
+        assert not unpack_all_images.register_dedup_entry(second_dedup_state, b'other', 'APPEND01.ALF/IMG002.png', ('APPEND01.ALF', 512))
+
+        assert first_dedup_state['unique_entries'] == 1
+        assert second_dedup_state['unique_entries'] == 1
+        assert second_dedup_state['duplicate_entries'] == 2
+        assert second_dedup_state['duplicate_list'] == [
+            ('DATA1.ALF/IMG001.png', 'APPEND01.ALF/IMG001.png'),
+            ('DATA1.ALF/IMG001.png', 'DATA1.ALF/IMG001.png'),
+        ]
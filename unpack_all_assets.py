@@ -1,9 +1,11 @@
-# load the pickle log and unpack all the assets
+# load the metadata log and unpack all the assets
 import os
 import io
+import sys
+import mmap
 import time
+import errno
 import struct
-import pickle
 import argparse
 import collections
 import traceback
@@ -11,9 +13,98 @@ import traceback
 import tqdm
 
 import shared
+import metadata_store
 
 STOP_FILEPATH = 'stop'
 
+# ways to copy an entry from the ALF file to its output file
+# - copy_file_range: the kernel copies between the files (or shares the
+#   blocks on file systems that support it), nothing goes through Python
+# - sendfile: same without block sharing, any Linux with regular files
+# - mmap: the entry is written from a memory map of the ALF file, one copy
+# - read: read the entry into a bytes object and write it, two copies
+COPY_METHOD_AUTO = 'auto'
+COPY_METHOD_COPY_FILE_RANGE = 'copy_file_range'
+COPY_METHOD_SENDFILE = 'sendfile'
+COPY_METHOD_MMAP = 'mmap'
+COPY_METHOD_READ = 'read'
+COPY_METHOD_LIST = [COPY_METHOD_COPY_FILE_RANGE, COPY_METHOD_SENDFILE, COPY_METHOD_MMAP, COPY_METHOD_READ]
+
+# errors of copy_file_range / sendfile meaning the files are not supported
+# by the call (e.g. across file systems on older kernels), the next method is used
+COPY_FALLBACK_ERRNO_LIST = [errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP, errno.ENOTSUP]
+
+
+def get_available_copy_method_list():
+    copy_method_list = []
+    if hasattr(os, 'copy_file_range'):
+        copy_method_list.append(COPY_METHOD_COPY_FILE_RANGE)
+    # sendfile only takes a socket as destination on macOS / BSD
+    if hasattr(os, 'sendfile') and sys.platform.startswith('linux'):
+        copy_method_list.append(COPY_METHOD_SENDFILE)
+    copy_method_list.append(COPY_METHOD_MMAP)
+    copy_method_list.append(COPY_METHOD_READ)
+    return copy_method_list
+
+
+def copy_archive_entry(
+    alf_reader: shared.CoalescingReader,
+    alf_view: memoryview,
+    offset: int,
+    length: int,
+    outfile: io.BufferedWriter,
+    copy_method: str,
+):
+    # write the `length` bytes at `offset` of the ALF file to `outfile`
+    # `alf_view` is a memoryview of the mmap of the ALF file (COPY_METHOD_MMAP only)
+    # COPY_METHOD_READ reads the entry from the chunk of `alf_reader` it belongs to
+    if copy_method == COPY_METHOD_COPY_FILE_RANGE or copy_method == COPY_METHOD_SENDFILE:
+        alf_fd = alf_reader.infile.fileno()
+        out_fd = outfile.fileno()
+        copied = 0
+        while copied < length:
+            # both calls may copy less than asked
+            if copy_method == COPY_METHOD_COPY_FILE_RANGE:
+                number_of_bytes = os.copy_file_range(alf_fd, out_fd, length - copied, offset + copied)
+            else:
+                number_of_bytes = os.sendfile(out_fd, alf_fd, offset + copied, length - copied)
+
+            if number_of_bytes == 0:
+                raise Exception(f'unexpected end of the ALF file at {offset + copied}')
+            copied += number_of_bytes
+    elif copy_method == COPY_METHOD_MMAP:
+        outfile.write(alf_view[offset:offset + length])
+    else:
+        outfile.write(alf_reader.read_view(offset, length))
+
+
+def get_copy_summary(copy_state: dict):
+    seconds = copy_state['seconds']
+    return {
+        'entries': copy_state['entries'],
+        'bytes': copy_state['bytes'],
+        'seconds': round(seconds, 3),
+        'GB/s': round(copy_state['bytes'] / seconds / 1e9, 3) if seconds > 0 else 0.0,
+        'copy_methods': dict(copy_state['copy_method_counter']),
+        # reads of COPY_METHOD_READ, including the gaps between the entries
+        'read_count': copy_state['read_count'],
+        'read_bytes': copy_state['read_bytes'],
+    }
+
+
+def is_archive_entry_copied(
+    archive_info: dict,
+    export_config: dict,
+):
+    # True if the output file of the entry exists already
+    # False if the name cannot be decoded, the error is reported when copying
+    try:
+        filename = archive_info['name'].decode('ascii')
+    except UnicodeDecodeError:
+        return False
+
+    return os.path.exists(os.path.join(export_config['destination'], filename))
+
 
 def handle_single_alf_file(
     filepath: str,
@@ -21,64 +112,123 @@ def handle_single_alf_file(
     export_config: dict,
     error_log: list,
 ):
+    copy_state = export_config['copy_state']
+    copy_method_list = copy_state['copy_method_list']
     with open(filepath, mode='rb') as alf_infile:
-        number_of_archive_entries = len(archive_list)
+        alf_size = os.fstat(alf_infile.fileno()).st_size
+        # the fastest method that works for this ALF file, see the fallback below
+        copy_method_index = 0
+
+        # mapped when COPY_METHOD_MMAP is first used
+        alf_mmap = None
+        alf_view = None
+
+        # the entries are copied in offset order, the chunks are only read
+        # with COPY_METHOD_READ, the other methods read sequentially anyway
+        # only the entries that are copied go into the chunks, a chunk is read
+        # completely even if only one of its entries is needed
+        archive_entry_list = sorted(enumerate(archive_list), key=lambda entry: entry[1]['offset'])
+        copy_entry_list = [
+            (archive_index, archive_info)
+            for archive_index, archive_info in archive_entry_list
+            if export_config['force'] or not is_archive_entry_copied(archive_info, export_config)
+        ]
+        chunk_list = shared.create_read_chunk_list(
+            copy_entry_list,
+            max_gap=export_config['read_gap'],
+            max_chunk_size=export_config['read_chunk_size'],
+        )
+        alf_reader = shared.CoalescingReader(alf_infile, chunk_list)
+        copy_archive_index_set = {archive_index for archive_index, _ in copy_entry_list}
 
-        pbar = tqdm.tqdm(range(number_of_archive_entries), leave=True)
-        for archive_index in pbar:
-            if os.path.exists(STOP_FILEPATH):
-                break
-
-            try:
-                archive_info = archive_list[archive_index]
-
-                filename_bs = archive_info['name']
-                filename = filename_bs.decode('ascii')
-
-                pbar.set_description(filename)
-
-                output_filepath = os.path.join(export_config['destination'], filename)
-                # print(output_filepath)
-                if not export_config['force'] and os.path.exists(output_filepath):
-                    continue
-
-                if export_config['run']:
-                    offset = archive_info['offset']
-                    length = archive_info['length']
-                    alf_infile.seek(offset)
-                    agf_content_bs = alf_infile.read(length)
-
-                    parent_dir = os.path.dirname(output_filepath)
-                    if not os.path.exists(parent_dir):
-                        try:
-                            os.makedirs(parent_dir)
-                        except Exception as ex:
-                            print(f'{shared.FG_RED}ERROR: Failed to create directory: {parent_dir}{shared.RESET_COLOR}')
-                            print(stack_trace)
-                            print(ex)
-                            error_log.append({
-                                'exception': ex,
-                                'stack_trace': stack_trace,
-                                'archive_index': archive_index,
-                                'archive_info': archive_info,
-                                'export_config': export_config,
-                            })
-
-                            continue
+        try:
+            pbar = tqdm.tqdm(archive_entry_list, leave=True)
+            for archive_index, archive_info in pbar:
+                if os.path.exists(STOP_FILEPATH):
+                    break
 
-                    with open(output_filepath, mode='wb') as outfile:
-                        outfile.write(agf_content_bs)
-            except Exception as ex:
-                stack_trace = traceback.format_exc()
-                print(f'{shared.FG_RED}ERROR: Error occurs while processing archive_info index {archive_index}{shared.RESET_COLOR}')
-                print(stack_trace)
-                print(ex)
-                error_log.append({
-                    'exception': ex,
-                    'stack_trace': stack_trace,
-                    'filepath': filepath,
-                    'archive_index': archive_index,
-                })
+                try:
+                    filename_bs = archive_info['name']
+                    filename = filename_bs.decode('ascii')
+
+                    pbar.set_description(filename)
+
+                    output_filepath = os.path.join(export_config['destination'], filename)
+                    # print(output_filepath)
+                    if archive_index not in copy_archive_index_set:
+                        continue
+
+                    if export_config['run']:
+                        offset = archive_info['offset']
+                        length = archive_info['length']
+                        if (offset + length) > alf_size:
+                            raise Exception(f'entry ends at {offset + length} after the end of the ALF file {alf_size}')
+
+                        parent_dir = os.path.dirname(output_filepath)
+                        if not os.path.exists(parent_dir):
+                            try:
+                                os.makedirs(parent_dir)
+                            except Exception as ex:
+                                print(f'{shared.FG_RED}ERROR: Failed to create directory: {parent_dir}{shared.RESET_COLOR}')
+                                print(stack_trace)
+                                print(ex)
+                                error_log.append({
+                                    'exception': ex,
+                                    'stack_trace': stack_trace,
+                                    'archive_index': archive_index,
+                                    'archive_info': archive_info,
+                                    'export_config': export_config,
+                                })
+
+                                continue
+
+                        start = time.perf_counter()
+                        with open(output_filepath, mode='wb') as outfile:
+                            while True:
+                                copy_method = copy_method_list[copy_method_index]
+                                if copy_method == COPY_METHOD_MMAP and alf_view is None:
+                                    # empty files cannot be mapped
+                                    if alf_size > 0:
+                                        alf_mmap = mmap.mmap(alf_infile.fileno(), 0, access=mmap.ACCESS_READ)
+                                        alf_view = memoryview(alf_mmap)
+                                    else:
+                                        alf_view = memoryview(b'')
+
+                                try:
+                                    copy_archive_entry(alf_reader, alf_view, offset, length, outfile, copy_method)
+                                    break
+                                except OSError as ex:
+                                    if ex.errno not in COPY_FALLBACK_ERRNO_LIST or copy_method_index + 1 >= len(copy_method_list):
+                                        raise
+
+                                    # use the next method for the rest of this ALF file
+                                    copy_method_index += 1
+                                    print(f'{shared.FG_YELLOW}WARNING: {copy_method} is not supported for {filepath} ({ex}), using {copy_method_list[copy_method_index]}{shared.RESET_COLOR}')
+                                    outfile.seek(0)
+                                    outfile.truncate()
+
+                        copy_state['seconds'] += time.perf_counter() - start
+                        copy_state['entries'] += 1
+                        copy_state['bytes'] += length
+                        copy_state['copy_method_counter'][copy_method] += 1
+                except Exception as ex:
+                    stack_trace = traceback.format_exc()
+                    print(f'{shared.FG_RED}ERROR: Error occurs while processing archive_info index {archive_index}{shared.RESET_COLOR}')
+                    print(stack_trace)
+                    print(ex)
+                    error_log.append({
+                        'exception': ex,
+                        'stack_trace': stack_trace,
+                        'filepath': filepath,
+                        'archive_index': archive_index,
+                    })
+        finally:
+            copy_state['read_count'] += alf_reader.read_count
+            copy_state['read_bytes'] += alf_reader.read_bytes
+            if alf_view is not None:
+                alf_view.release()
+            if alf_mmap is not None:
+                alf_mmap.close()
 
 
 def handle_metadata_info_obj(
@@ -93,17 +243,9 @@ def handle_metadata_info_obj(
     alf_filename_list = [entry['name'].decode('ascii') for entry in alf_file_info_list]
     number_of_alf_files = len(alf_filename_list)
 
-    archive_entry_info_list = metadata_info['archive_entry_info_list']
-
-    # - the archive file entries order may have already been sorted but for consistency we sort them ourselves
-    # - group the archive entries by archive_index
+    # the archive entries are loaded by archive_index
     # so that we can unpack them by the ALF file they belong to
 
-    if number_of_alf_files > 1:
-        archive_group_dict = collections.defaultdict(list)
-        for entry in archive_entry_info_list:
-            archive_group_dict[entry['archive_index']].append(entry)
-
     # archive_index is mapped to the index of the ALF filename list
 
     if number_of_alf_files == 0:
@@ -132,9 +274,12 @@ def handle_metadata_info_obj(
                 'destination': export_dir,
                 'force': export_config['force'],
                 'run': export_config['run'],
+                'copy_state': export_config['copy_state'],
+                'read_gap': export_config['read_gap'],
+                'read_chunk_size': export_config['read_chunk_size'],
             }
 
-            archive_list = archive_entry_info_list
+            archive_list = metadata_store.get_alf_archive_entry_info_list(metadata_info)
             handle_single_alf_file(
                 filepath=alf_filepath,
                 archive_list=archive_list,
@@ -182,9 +327,12 @@ def handle_metadata_info_obj(
                     'destination': export_dir,
                     'force': export_config['force'],
                     'run': export_config['run'],
+                    'copy_state': export_config['copy_state'],
+                    'read_gap': export_config['read_gap'],
+                    'read_chunk_size': export_config['read_chunk_size'],
                 }
 
-                archive_list = archive_group_dict[alf_filename_index]
+                archive_list = metadata_store.get_alf_archive_entry_info_list(metadata_info, alf_filename_index)
                 handle_single_alf_file(
                     filepath=alf_filepath,
                     archive_list=archive_list,
@@ -208,10 +356,13 @@ def handle_metadata_info_obj(
 
 def main():
     parser = argparse.ArgumentParser(description='Unpack all assets from a pickle metadata file log.')
-    parser.add_argument('inpath', help='path to the pickle log')
+    parser.add_argument('inpath', help='path to the metadata store or pickle log from process_metadata_file.py')
     parser.add_argument('outpath', nargs='?', default='sameasinput', help='path to the output directory')
     parser.add_argument('--force', action='store_true', help='overwrite existing files')
     parser.add_argument('-r', '--run', action='store_true', help='actually destroying your files')
+    parser.add_argument('--copy-method', default=COPY_METHOD_AUTO, choices=[COPY_METHOD_AUTO] + COPY_METHOD_LIST, help=f'how the entries are copied out of the ALF files (default: the first available of {COPY_METHOD_LIST})')
+    parser.add_argument('--read-gap', type=int, default=shared.DEFAULT_READ_GAP // 1024, help='with --copy-method read, entries at most this many KiB apart are read together')
+    parser.add_argument('--read-chunk-size', type=int, default=shared.DEFAULT_READ_CHUNK_SIZE // (1024 * 1024), help='with --copy-method read, maximum size in MiB of one read of several entries (0 to read every entry on its own)')
 
     args = parser.parse_args()
     print('args', args)
@@ -220,7 +371,7 @@ def main():
     outpath = args.outpath
 
     if not os.path.exists(pickle_filepath):
-        print(f'{shared.FG_RED}ERROR: Pickle file does not exist: {pickle_filepath}{shared.RESET_COLOR}')
+        print(f'{shared.FG_RED}ERROR: Metadata file does not exist: {pickle_filepath}{shared.RESET_COLOR}')
         return
 
     if outpath != 'sameasinput':
@@ -234,16 +385,36 @@ def main():
                 print(ex)
                 return
 
+    available_copy_method_list = get_available_copy_method_list()
+    if args.copy_method == COPY_METHOD_AUTO:
+        copy_method_list = available_copy_method_list
+    elif args.copy_method in available_copy_method_list:
+        # the slower methods are still there as fallback
+        copy_method_list = available_copy_method_list[available_copy_method_list.index(args.copy_method):]
+    else:
+        print(f'{shared.FG_RED}ERROR: --copy-method {args.copy_method} is not available on this system - {available_copy_method_list}{shared.RESET_COLOR}')
+        return
+
     EXPORT_CONFIG = {
         'force': args.force,
         'destination': outpath,
         'run': args.run,
+        'read_gap': args.read_gap * 1024,
+        'read_chunk_size': args.read_chunk_size * 1024 * 1024,
+        'copy_state': {
+            'copy_method_list': copy_method_list,
+            'entries': 0,
+            'bytes': 0,
+            'seconds': 0.0,
+            'copy_method_counter': collections.Counter(),
+            'read_count': 0,
+            'read_bytes': 0,
+        },
     }
 
     error_log = []
 
-    with open(pickle_filepath, mode='rb') as infile:
-        log_list = pickle.load(infile)
+    log_list = metadata_store.load_metadata_file_list(pickle_filepath)
 
     number_of_metadata_logs = len(log_list)
 
@@ -307,6 +478,9 @@ def main():
                     'export_config': EXPORT_CONFIG,
                 })
 
+    if args.run:
+        print('copy', get_copy_summary(EXPORT_CONFIG['copy_state']))
+
 
 if __name__ == '__main__':
     main()
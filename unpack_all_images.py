@@ -1,97 +1,545 @@
-# load the pickle log and unpack all the assets
+# load the metadata log and unpack all the assets
 import os
 import io
 import time
+import heapq
+import hashlib
+import queue
 import struct
-import pickle
 import argparse
+import threading
 import collections
 import traceback
+import multiprocessing
+import concurrent.futures
 
 import tqdm
 import enlighten
 
-import numpy as np
 import cv2
 
 import shared
+import metadata_store
+import section_cache
 
 import convert_agf_to_png
 
 
-IMAGE_OUTPUT_FORMAT_LIST = ['png', 'bmp', 'jpg']
+IMAGE_OUTPUT_FORMAT_LIST = convert_agf_to_png.OUTPUT_FORMAT_LIST
 
 
-def convert_rgb_to_opencv_format(
-    rgb_image: np.ndarray,
+# the ALF file is read by the calling thread, the entries then go through
+# two pools of threads connected by bounded queues
+# - decoder threads: LZSS decoding (and caching) and building the pixel array
+# - encoder threads: image encoding and writing the file
+# the LZSS decoder (with numba), NumPy, OpenCV and zlib release the GIL for
+# most of their work so the stages overlap with each other and with the reads
+DEFAULT_DECODE_WORKERS = min(4, os.cpu_count() or 1)
+DEFAULT_ENCODE_WORKERS = os.cpu_count() or 1
+# number of queued entries per worker, this bounds the memory held by the queues
+QUEUE_SIZE_PER_WORKER = 2
+
+# --thumbnail writes IMAGE.thumb.png next to where IMAGE.png would go
+THUMBNAIL_FILENAME_SUFFIX = '.thumb'
+# --contact-sheet writes pages of thumbnails named after the ALF export directory
+# e.g. DATA1.ALF-contact-sheet-0000.png next to the DATA1.ALF directory
+CONTACT_SHEET_FILENAME_SUFFIX = '-contact-sheet'
+DEFAULT_CONTACT_SHEET_THUMBNAIL_SIZE = 192
+
+
+def get_archive_entry_output_filepath(
+    archive_info: dict,
+    export_config: dict,
 ):
-    image_shape = rgb_image.shape
-    if len(image_shape) == 2:
-        # grayscale image
-        return rgb_image
-    elif len(image_shape) == 3:
-        if image_shape[2] == 3:
-            # RGB image
-            return cv2.cvtColor(rgb_image, cv2.COLOR_RGB2BGR)
-        elif image_shape[2] == 4:
-            # RGBA image
-            return cv2.cvtColor(rgb_image, cv2.COLOR_RGBA2BGRA)
-        else:
-            raise Exception(f'Unsupported image shape {image_shape}')
+    # returns None if the entry is not an AGF image or if the output file
+    # already exists (without --force)
+    filename_bs = archive_info['name']
+    filename = filename_bs.decode('ascii')
+    base_filename, ext = os.path.splitext(filename)
 
+    ext = ext.lower()
+    if not ext == '.agf':
+        return None
 
-def handle_single_alf_file(
-    filepath: str,
+    if export_config['thumbnail_size'] is not None:
+        base_filename += THUMBNAIL_FILENAME_SUFFIX
+
+    output_filename = base_filename + '.' + export_config['format']
+    output_filepath = os.path.join(export_config['destination'], output_filename)
+    if not export_config['force'] and os.path.exists(output_filepath):
+        return None
+
+    return output_filepath
+
+
+def read_archive_entry(
+    alf_reader: shared.CoalescingReader,
+    alf_filepath: str,
+    archive_info: dict,
+    cache: section_cache.DecodedSectionCache,
+    cache_lock: threading.Lock,
+    raw_agf_content_bs: bytes = None,
+):
+    # returns (agf_content_bs, cache_key)
+    # cache_key is None unless the entry has to be decompressed and put in the cache
+    # `raw_agf_content_bs` is the entry if it has been read already
+    offset = archive_info['offset']
+    length = archive_info['length']
+
+    if cache is not None:
+        if raw_agf_content_bs is None and cache.key_mode == section_cache.CACHE_KEY_MODE_HASH:
+            raw_agf_content_bs = alf_reader.read(offset, length)
+
+        with cache_lock:
+            cache_key = cache.make_key(alf_filepath, offset, length, raw_agf_content_bs)
+            agf_content_bs = cache.get(cache_key)
+
+        if agf_content_bs is not None:
+            # the cached content has all LZSS sections decoded already
+            return agf_content_bs, None
+
+        if raw_agf_content_bs is not None:
+            return raw_agf_content_bs, cache_key
+    else:
+        cache_key = None
+
+    if raw_agf_content_bs is not None:
+        return raw_agf_content_bs, cache_key
+
+    return alf_reader.read(offset, length), cache_key
+
+
+def is_cached_archive_entry(
+    cache: section_cache.DecodedSectionCache,
+    alf_filepath: str,
+    archive_info: dict,
+):
+    # True if the entry can be taken from the cache without reading the ALF file
+    # always False with CACHE_KEY_MODE_HASH, the key needs the raw entry
+    if cache is None or cache.key_mode != section_cache.CACHE_KEY_MODE_MTIME:
+        return False
+
+    return cache.contains(cache.make_key(alf_filepath, archive_info['offset'], archive_info['length']))
+
+
+# --dedup
+# the raw bytes of every entry are hashed before decoding, only the first
+# entry with given bytes is decoded and encoded, the outputs of the other ones
+# are linked to its output (see shared.link_file) once it has been written
+# with --jobs the workers hash the entries they read and share output_dict
+# through a multiprocessing manager, the links are made after the pool
+def create_dedup_state(output_dict=None):
+    return {
+        'lock': threading.Lock(),
+        # hash -> (output path, entry key) of the first entry
+        'output_dict': output_dict if output_dict is not None else {},
+        # (output path of the first entry, output path) waiting to be linked
+        'duplicate_list': [],
+        'unique_entries': 0,
+        'duplicate_entries': 0,
+        'duplicate_input_bytes': 0,
+        'linked_output_bytes': 0,
+        'link_mode_counter': collections.Counter(),
+        'link_errors': 0,
+        # CPU time spent on the unique entries
+        'cpu_seconds': 0.0,
+    }
+
+
+def register_dedup_entry(
+    dedup_state: dict,
+    raw_agf_content_bs: bytes,
+    output_filepath: str,
+    entry_key: tuple,
+):
+    # returns True if the same bytes have been seen before, the output is
+    # then linked by link_duplicate_outputs instead of being decoded
+    # `entry_key` is (ALF path, offset), it tells an entry from another one with the same output path
+    digest = hashlib.blake2b(raw_agf_content_bs, digest_size=16).digest()
+    with dedup_state['lock']:
+        # setdefault is atomic on the shared dict of a multiprocessing manager too
+        source_filepath, source_entry_key = dedup_state['output_dict'].setdefault(digest, (output_filepath, entry_key))
+        if source_entry_key == entry_key:
+            dedup_state['unique_entries'] += 1
+            return False
+
+        dedup_state['duplicate_list'].append((source_filepath, output_filepath))
+        dedup_state['duplicate_entries'] += 1
+        dedup_state['duplicate_input_bytes'] += len(raw_agf_content_bs)
+        return True
+
+
+def link_duplicate_outputs(
+    dedup_state: dict,
+    link_mode: str,
+):
+    # call when every output registered so far has been written
+    with dedup_state['lock']:
+        duplicate_list = dedup_state['duplicate_list']
+        dedup_state['duplicate_list'] = []
+
+    for source_filepath, output_filepath in duplicate_list:
+        if source_filepath == output_filepath:
+            # same name and content in one ALF file
+            continue
+
+        try:
+            if not os.path.exists(source_filepath):
+                raise Exception(f'the first copy was not written {source_filepath}')
+
+            used_link_mode = shared.link_file(source_filepath, output_filepath, link_mode)
+            dedup_state['link_mode_counter'][used_link_mode] += 1
+            dedup_state['linked_output_bytes'] += os.path.getsize(output_filepath)
+        except Exception as ex:
+            print(f'{shared.FG_RED}ERROR: Failed to link {output_filepath} to {source_filepath}{shared.RESET_COLOR}')
+            print(ex)
+            dedup_state['link_errors'] += 1
+
+
+def get_dedup_summary(dedup_state: dict):
+    unique_entries = dedup_state['unique_entries']
+    duplicate_entries = dedup_state['duplicate_entries']
+    if unique_entries > 0:
+        # average CPU time per decoded entry times the number of skipped ones
+        estimated_cpu_seconds_saved = dedup_state['cpu_seconds'] * duplicate_entries / unique_entries
+    else:
+        estimated_cpu_seconds_saved = 0.0
+
+    return {
+        'unique_entries': unique_entries,
+        'duplicate_entries': duplicate_entries,
+        'duplicate_input_bytes': dedup_state['duplicate_input_bytes'],
+        'linked_output_bytes': dedup_state['linked_output_bytes'],
+        'link_modes': dict(dedup_state['link_mode_counter']),
+        'link_errors': dedup_state['link_errors'],
+        'cpu_seconds': round(dedup_state['cpu_seconds'], 3),
+        'estimated_cpu_seconds_saved': round(estimated_cpu_seconds_saved, 3),
+    }
+
+
+def report_archive_entry_error(archive_index: int, ex: Exception, pipeline_state: dict):
+    stack_trace = traceback.format_exc()
+    with pipeline_state['lock']:
+        print(f'{shared.FG_RED}ERROR: Error occurs while processing archive_info index {archive_index}{shared.RESET_COLOR}')
+        print(stack_trace)
+        print(ex)
+        pipeline_state['counter'].update()
+
+
+def decode_archive_entries(
+    decode_queue: queue.Queue,
+    encode_queue: queue.Queue,
+    export_config: dict,
+    pipeline_state: dict,
+):
+    cache = export_config['cache']
+    while True:
+        task = decode_queue.get()
+        if task is None:
+            break
+
+        archive_index, output_filepath, agf_content_bs, cache_key = task
+        try:
+            if cache_key is not None:
+                # cache miss, the cached content has all LZSS sections decoded already
+                agf_content_bs = convert_agf_to_png.decompress_agf_data(agf_content_bs)
+                with pipeline_state['lock']:
+                    cache.put(cache_key, agf_content_bs)
+
+            # no buffer_pool, the array is handed over to an encoder thread
+            decoded_agf_data = convert_agf_to_png.decode_agf_data_for_encoder(
+                agf_content_bs=agf_content_bs,
+                encoder=export_config['encoder'],
+                thumbnail_size=export_config['thumbnail_size'],
+            )
+        except Exception as ex:
+            report_archive_entry_error(archive_index, ex, pipeline_state)
+            continue
+
+        encode_queue.put((archive_index, output_filepath, decoded_agf_data))
+
+
+def encode_archive_entries(
+    encode_queue: queue.Queue,
+    export_config: dict,
+    pipeline_state: dict,
+):
+    while True:
+        task = encode_queue.get()
+        if task is None:
+            break
+
+        archive_index, output_filepath, decoded_agf_data = task
+        try:
+            chunk_list = convert_agf_to_png.encode_decoded_agf_data(
+                decoded_agf_data,
+                encoder=export_config['encoder'],
+                profile=export_config['profile'],
+            )
+            convert_agf_to_png.write_chunk_list(output_filepath, chunk_list)
+        except Exception as ex:
+            report_archive_entry_error(archive_index, ex, pipeline_state)
+            continue
+
+        with pipeline_state['lock']:
+            pipeline_state['counter'].update()
+
+
+def create_contact_sheet_page_list(
     archive_list: list,
     export_config: dict,
 ):
-    with open(filepath, mode='rb') as alf_infile:
-        number_of_archive_entries = len(archive_list)
-        enlighten_counter = enlighten.Counter(total=number_of_archive_entries)
+    # split the AGF entries of an ALF file into pages of
+    # contact_sheet_columns * contact_sheet_rows entries
+    # returns a list of {'output_filepath', 'entry_list'} with entry_list a list
+    # of (archive_index, archive_info), pages whose file already exists are
+    # left out (without --force)
+    agf_entry_list = [
+        (archive_index, archive_info)
+        for archive_index, archive_info in enumerate(archive_list)
+        if os.path.splitext(archive_info['name'])[1].lower() == b'.agf'
+    ]
 
-        for archive_index in range(number_of_archive_entries):
-            try:
-                archive_info = archive_list[archive_index]
+    tiles_per_page = export_config['contact_sheet_columns'] * export_config['contact_sheet_rows']
+    page_list = []
+    for page_index, start in enumerate(range(0, len(agf_entry_list), tiles_per_page)):
+        output_filepath = f'{export_config["destination"]}{CONTACT_SHEET_FILENAME_SUFFIX}-{page_index:04d}.{export_config["format"]}'
+        if not export_config['force'] and os.path.exists(output_filepath):
+            continue
 
-                filename_bs = archive_info['name']
-                filename = filename_bs.decode('ascii')
-                base_filename, ext = os.path.splitext(filename)
+        page_list.append({
+            'output_filepath': output_filepath,
+            'entry_list': agf_entry_list[start:start + tiles_per_page],
+        })
 
-                ext = ext.lower()
-                if not ext == '.agf':
-                    enlighten_counter.update()
-                    continue
+    return page_list
 
-                output_filename = base_filename + '.' + export_config['format']
-                output_filepath = os.path.join(export_config['destination'], output_filename)
-                if not export_config['force'] and os.path.exists(output_filepath):
-                    enlighten_counter.update()
-                    continue
 
-                offset = archive_info['offset']
-                length = archive_info['length']
-                alf_infile.seek(offset)
-                agf_content_bs = alf_infile.read(length)
+def write_contact_sheet_page(
+    alf_filepath: str,
+    page_info: dict,
+    export_config: dict,
+    cache_lock: threading.Lock,
+):
+    # decode the thumbnails of one page, lay them out and write the page
+    # returns the status of every entry: (archive_index, stack trace or None)
+    # entries that fail are left out of the page
+    cache = export_config['cache']
+    thumbnail_size = export_config['thumbnail_size']
+    # the entries are read in offset order, the tiles keep the page order
+    # the cached entries are left out of the read chunks
+    position_list = [
+        (position, archive_info)
+        for position, (_, archive_info) in enumerate(page_info['entry_list'])
+    ]
+    with cache_lock:
+        read_position_list = [
+            (position, archive_info)
+            for position, archive_info in position_list
+            if not is_cached_archive_entry(cache, alf_filepath, archive_info)
+        ]
 
-                # TODO handle BMP format with minimal processing to reduce execution time
-                rgb_image = convert_agf_to_png.convert_agf_data_to_numpy_array(
-                    agf_content_bs=agf_content_bs,
-                    force_rgb=True,
+    chunk_list = shared.create_read_chunk_list(
+        read_position_list,
+        max_gap=export_config['read_gap'],
+        max_chunk_size=export_config['read_chunk_size'],
+    )
+    tile_list = []
+    status_list = []
+    with open(alf_filepath, mode='rb') as alf_infile:
+        alf_reader = shared.CoalescingReader(alf_infile, chunk_list)
+        for position, archive_info in sorted(position_list, key=lambda entry: entry[1]['offset']):
+            archive_index = page_info['entry_list'][position][0]
+            try:
+                agf_content_bs, cache_key = read_archive_entry(
+                    alf_reader=alf_reader,
+                    alf_filepath=alf_filepath,
+                    archive_info=archive_info,
+                    cache=cache,
+                    cache_lock=cache_lock,
                 )
+                if cache_key is not None:
+                    agf_content_bs = convert_agf_to_png.decompress_agf_data(agf_content_bs)
+                    with cache_lock:
+                        cache.put(cache_key, agf_content_bs)
 
-                cv2_image = convert_rgb_to_opencv_format(rgb_image)
+                # no buffer_pool, the thumbnails are kept until the page is written
+                image = convert_agf_to_png.convert_agf_data_to_numpy_array(agf_content_bs)
+                label = os.path.splitext(archive_info['name'].decode('ascii'))[0]
+                tile_list.append((position, label, convert_agf_to_png.resize_to_thumbnail(image, thumbnail_size)))
+                status_list.append((archive_index, None))
+            except Exception:
+                status_list.append((archive_index, traceback.format_exc()))
+
+    if len(tile_list) > 0:
+        tile_list = [(label, thumbnail) for _, label, thumbnail in sorted(tile_list, key=lambda tile: tile[0])]
+        sheet_image = convert_agf_to_png.create_contact_sheet(tile_list, thumbnail_size, export_config['contact_sheet_columns'])
+        if convert_agf_to_png.ENCODER_CONFIG_DICT[export_config['encoder']]['force_rgb']:
+            sheet_image = cv2.cvtColor(sheet_image, cv2.COLOR_BGR2RGB)
+
+        encoded_bs = convert_agf_to_png.encode_image(sheet_image, export_config['encoder'], export_config['profile'])
+        convert_agf_to_png.write_chunk_list(page_info['output_filepath'], [encoded_bs])
+
+    return status_list
+
+
+def handle_single_alf_file_contact_sheet(
+    filepath: str,
+    archive_list: list,
+    export_config: dict,
+):
+    # --contact-sheet, the pages are built by a pool of threads
+    page_list = create_contact_sheet_page_list(archive_list, export_config)
+    enlighten_counter = enlighten.Counter(total=sum(len(page_info['entry_list']) for page_info in page_list))
+    cache_lock = threading.Lock()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=export_config['encode_workers']) as executor:
+        future_dict = {
+            executor.submit(write_contact_sheet_page, filepath, page_info, export_config, cache_lock): page_info
+            for page_info in page_list
+        }
 
-                if export_config['format'] == 'png':
-                    cv2.imwrite(output_filepath, cv2_image, [cv2.IMWRITE_PNG_COMPRESSION, 9])
-                else:
-                    cv2.imwrite(output_filepath, cv2_image)
+        for future in concurrent.futures.as_completed(future_dict):
+            page_info = future_dict[future]
+            try:
+                status_list = future.result()
             except Exception as ex:
                 stack_trace = traceback.format_exc()
-                print(f'{shared.FG_RED}ERROR: Error occurs while processing archive_info index {archive_index}{shared.RESET_COLOR}')
+                print(f'{shared.FG_RED}ERROR: Error occurs while writing {page_info["output_filepath"]}{shared.RESET_COLOR}')
                 print(stack_trace)
                 print(ex)
+                enlighten_counter.update(len(page_info['entry_list']))
+                continue
+
+            for archive_index, stack_trace in status_list:
+                if stack_trace is not None:
+                    print(f'{shared.FG_RED}ERROR: Error occurs while processing archive_info index {archive_index}{shared.RESET_COLOR}')
+                    print(stack_trace)
+
+            enlighten_counter.update(len(status_list))
+
+
+def handle_single_alf_file(
+    filepath: str,
+    archive_list: list,
+    export_config: dict,
+):
+    if export_config['contact_sheet']:
+        handle_single_alf_file_contact_sheet(filepath, archive_list, export_config)
+        return
+
+    number_of_archive_entries = len(archive_list)
+    pipeline_state = {
+        'counter': enlighten.Counter(total=number_of_archive_entries),
+        # guards the counter, the cache and the error output
+        'lock': threading.Lock(),
+    }
+
+    # only the entries that are read go into the read chunks, a chunk is read
+    # completely even if only one of its entries is needed. the entries that
+    # are skipped or cached are not (with --dedup every entry is read to hash it)
+    cache = export_config['cache']
+    dedup_state = export_config['dedup_state']
+    read_entry_list = []
+    cached_entry_list = []
+    for archive_index, archive_info in enumerate(archive_list):
+        try:
+            output_filepath = get_archive_entry_output_filepath(archive_info, export_config)
+            if output_filepath is None:
+                pipeline_state['counter'].update()
+            elif dedup_state is None and is_cached_archive_entry(cache, filepath, archive_info):
+                cached_entry_list.append(((archive_index, output_filepath), archive_info))
+            else:
+                read_entry_list.append(((archive_index, output_filepath), archive_info))
+        except Exception as ex:
+            report_archive_entry_error(archive_index, ex, pipeline_state)
+
+    # the entries are read in offset order, nearby entries with one read
+    chunk_list = shared.create_read_chunk_list(
+        read_entry_list,
+        max_gap=export_config['read_gap'],
+        max_chunk_size=export_config['read_chunk_size'],
+    )
+
+    decode_workers = export_config['decode_workers']
+    encode_workers = export_config['encode_workers']
+    decode_queue = queue.Queue(maxsize=decode_workers * QUEUE_SIZE_PER_WORKER)
+    encode_queue = queue.Queue(maxsize=encode_workers * QUEUE_SIZE_PER_WORKER)
+
+    decode_thread_list = [
+        threading.Thread(target=decode_archive_entries, args=(decode_queue, encode_queue, export_config, pipeline_state), daemon=True)
+        for _ in range(decode_workers)
+    ]
+    encode_thread_list = [
+        threading.Thread(target=encode_archive_entries, args=(encode_queue, export_config, pipeline_state), daemon=True)
+        for _ in range(encode_workers)
+    ]
+    for thread in decode_thread_list + encode_thread_list:
+        thread.start()
+
+    try:
+        with open(filepath, mode='rb') as alf_infile:
+            alf_reader = shared.CoalescingReader(alf_infile, chunk_list)
+            # a cached entry that has been removed since is read on its own
+            for (archive_index, output_filepath), archive_info in cached_entry_list + [entry for chunk_info in chunk_list for entry in chunk_info['entry_list']]:
+                try:
+                    raw_agf_content_bs = None
+                    if dedup_state is not None:
+                        raw_agf_content_bs = alf_reader.read(archive_info['offset'], archive_info['length'])
+                        if register_dedup_entry(dedup_state, raw_agf_content_bs, output_filepath, (filepath, archive_info['offset'])):
+                            with pipeline_state['lock']:
+                                pipeline_state['counter'].update()
+                            continue
+
+                    agf_content_bs, cache_key = read_archive_entry(
+                        alf_reader=alf_reader,
+                        alf_filepath=filepath,
+                        archive_info=archive_info,
+                        cache=cache,
+                        cache_lock=pipeline_state['lock'],
+                        raw_agf_content_bs=raw_agf_content_bs,
+                    )
+                except Exception as ex:
+                    report_archive_entry_error(archive_index, ex, pipeline_state)
+                    continue
 
-            enlighten_counter.update()
+                # blocks while the decoders are behind
+                decode_queue.put((archive_index, output_filepath, agf_content_bs, cache_key))
+    finally:
+        for _ in decode_thread_list:
+            decode_queue.put(None)
+        for thread in decode_thread_list:
+            thread.join()
+
+        for _ in encode_thread_list:
+            encode_queue.put(None)
+        for thread in encode_thread_list:
+            thread.join()
+
+    # the outputs of this and the previous ALF files are written
+    if dedup_state is not None:
+        link_duplicate_outputs(dedup_state, export_config['dedup'])
+
+
+def get_alf_export_dir(
+    metadata_parent: str,
+    alf_filename: str,
+    destination: str,
+):
+    # returns None if the directory cannot be created
+    if destination == 'sameasinput':
+        alf_basename = os.path.splitext(alf_filename)[0]
+        return os.path.join(metadata_parent, alf_basename)
+
+    export_dir = os.path.join(destination, alf_filename)
+    if not os.path.exists(export_dir):
+        try:
+            os.makedirs(export_dir)
+        except Exception as ex:
+            print(f'{shared.FG_RED}ERROR: Failed to create directory {export_dir}{shared.RESET_COLOR}')
+            print(ex)
+            return None
+
+    return export_dir
 
 
 def handle_metadata_info_obj(
@@ -104,15 +552,8 @@ def handle_metadata_info_obj(
     alf_file_info_list = metadata_info['alf_file_info_list']
     alf_filename_list = [entry['name'].decode('ascii') for entry in alf_file_info_list]
 
-    archive_entry_info_list = metadata_info['archive_entry_info_list']
-
-    # - the archive file entries order may have already been sorted but for consistency we sort them ourselves
-    # - group the archive entries by archive_index
+    # the archive entries are loaded by archive_index
     # so that we can unpack them by the ALF file they belong to
-    archive_group_dict = collections.defaultdict(list)
-    for entry in archive_entry_info_list:
-        archive_group_dict[entry['archive_index']].append(entry)
-
     # archive_index is mapped to the index of the ALF filename list
     number_of_alf_files = len(alf_filename_list)
     enlighten_counter = enlighten.Counter(total=number_of_alf_files)
@@ -123,26 +564,13 @@ def handle_metadata_info_obj(
         alf_filepath = os.path.join(metadata_parent, alf_filename)
 
         try:
-            if export_config['destination'] == 'sameasinput':
-                alf_basename = os.path.splitext(alf_filename)[0]
-                export_dir = os.path.join(metadata_parent, alf_basename)
-            else:
-                export_dir = os.path.join(export_config['destination'], alf_filename)
-                if not os.path.exists(export_dir):
-                    try:
-                        os.makedirs(export_dir)
-                    except Exception as ex:
-                        print(f'{shared.FG_RED}ERROR: Failed to create directory {export_dir}{shared.RESET_COLOR}')
-                        print(ex)
-                        continue
+            export_dir = get_alf_export_dir(metadata_parent, alf_filename, export_config['destination'])
+            if export_dir is None:
+                continue
 
-            child_export_config = {
-                'destination': export_dir,
-                'format': export_config['format'],
-                'force': export_config['force'],
-            }
+            child_export_config = dict(export_config, destination=export_dir)
 
-            archive_list = archive_group_dict[alf_filename_index]
+            archive_list = metadata_store.get_alf_archive_entry_info_list(metadata_info, alf_filename_index)
             handle_single_alf_file(
                 filepath=alf_filepath,
                 archive_list=archive_list,
@@ -157,12 +585,368 @@ def handle_metadata_info_obj(
         enlighten_counter.update()
 
 
+# --jobs mode
+# the AGF entries of every ALF file are split into shards of about the same
+# total compressed length, each shard is unpacked by a worker process that
+# opens the ALF files itself and only sends the status of every entry back
+# more shards than processes so the ones that finish early pick up the rest
+SHARDS_PER_JOB = 16
+
+# export_config of the worker process, set by init_shard_worker
+worker_export_config = None
+
+
+def init_shard_worker(
+    export_config: dict,
+    cache_config: dict,
+    dedup_output_dict,
+):
+    # the workers only read and write cache files, the parent process owns
+    # the cache size and removes files (see unpack_with_process_pool)
+    # `dedup_output_dict` is the output_dict shared by all workers with --dedup or None
+    global worker_export_config
+    cache = None
+    if cache_config is not None:
+        cache = section_cache.DecodedSectionCache(**cache_config, owner=False)
+
+    worker_export_config = dict(export_config, cache=cache, dedup_output_dict=dedup_output_dict)
+
+
+def take_dedup_result(dedup_state: dict):
+    # the counters and the duplicates of the dedup_state of a shard, None without --dedup
+    if dedup_state is None:
+        return None
+
+    return {
+        'unique_entries': dedup_state['unique_entries'],
+        'duplicate_entries': dedup_state['duplicate_entries'],
+        'duplicate_input_bytes': dedup_state['duplicate_input_bytes'],
+        'duplicate_list': dedup_state['duplicate_list'],
+    }
+
+
+def get_worker_counter_dict(
+    cache: section_cache.DecodedSectionCache,
+    start_worker_counter_dict: dict = None,
+):
+    # the counters of the cache and the CPU time of the worker process, minus
+    # `start_worker_counter_dict` if given
+    worker_counter_dict = {
+        'hit_count': cache.hit_count if cache is not None else 0,
+        'miss_count': cache.miss_count if cache is not None else 0,
+        'hit_bytes': cache.hit_bytes if cache is not None else 0,
+        'cpu_seconds': time.process_time(),
+    }
+    if start_worker_counter_dict is not None:
+        for key, value in start_worker_counter_dict.items():
+            worker_counter_dict[key] -= value
+
+    return worker_counter_dict
+
+
+def take_cache_usage_list(cache: section_cache.DecodedSectionCache):
+    return cache.take_usage_list() if cache is not None else []
+
+
+def create_task_chunk_list_dict(
+    task_list: list,
+    export_config: dict,
+):
+    # returns {alf_filepath: chunk_list} of the (alf_filepath, archive_index, archive_info, output_filepath)
+    # tasks, the tasks are the keys of the chunk entries, see shared.create_read_chunk_list
+    task_group_dict = collections.defaultdict(list)
+    for task in task_list:
+        task_group_dict[task[0]].append((task, task[2]))
+
+    return {
+        alf_filepath: shared.create_read_chunk_list(
+            entry_list,
+            max_gap=export_config['read_gap'],
+            max_chunk_size=export_config['read_chunk_size'],
+        )
+        for alf_filepath, entry_list in task_group_dict.items()
+    }
+
+
+def iter_chunk_list_dict_tasks(chunk_list_dict: dict):
+    # the tasks of create_task_chunk_list_dict by ALF file and offset
+    for chunk_list in chunk_list_dict.values():
+        for chunk_info in chunk_list:
+            for task, _ in chunk_info['entry_list']:
+                yield task
+
+
+def unpack_archive_entry_shard(shard: list):
+    # runs in a worker process
+    # shard is a list of (alf_filepath, archive_index, archive_info, output_filepath) sorted by ALF file and offset
+    # returns the error (stack trace) or None of every entry, the counters of get_worker_counter_dict,
+    # the (key, size) of the cache files used (see section_cache.DecodedSectionCache.take_usage_list)
+    # and the duplicates found with --dedup (see take_dedup_result)
+    export_config = worker_export_config
+    cache = export_config['cache']
+    cache_lock = threading.Lock()
+    start_worker_counter_dict = get_worker_counter_dict(cache)
+    dedup_state = None
+    if export_config['dedup_output_dict'] is not None:
+        dedup_state = create_dedup_state(export_config['dedup_output_dict'])
+
+    # pixel storage reused between images of the same size
+    buffer_pool = {}
+    status_list = []
+    # the cached entries are left out of the read chunks (with --dedup every entry is read to hash it)
+    cached_task_list = []
+    read_task_list = []
+    for task in shard:
+        if dedup_state is None and is_cached_archive_entry(cache, task[0], task[2]):
+            cached_task_list.append(task)
+        else:
+            read_task_list.append(task)
+
+    chunk_list_dict = create_task_chunk_list_dict(read_task_list, export_config)
+    alf_reader = None
+    try:
+        for alf_filepath, archive_index, archive_info, output_filepath in cached_task_list + list(iter_chunk_list_dict_tasks(chunk_list_dict)):
+            try:
+                if alf_reader is None or alf_reader.infile.name != alf_filepath:
+                    if alf_reader is not None:
+                        alf_reader.infile.close()
+                    # a cached entry that has been removed since is read on its own
+                    alf_reader = shared.CoalescingReader(open(alf_filepath, mode='rb'), chunk_list_dict.get(alf_filepath, []))
+
+                raw_agf_content_bs = None
+                if dedup_state is not None:
+                    raw_agf_content_bs = alf_reader.read(archive_info['offset'], archive_info['length'])
+                    if register_dedup_entry(dedup_state, raw_agf_content_bs, output_filepath, (alf_filepath, archive_info['offset'])):
+                        status_list.append((alf_filepath, archive_index, None))
+                        continue
+
+                agf_content_bs, cache_key = read_archive_entry(
+                    alf_reader=alf_reader,
+                    alf_filepath=alf_filepath,
+                    archive_info=archive_info,
+                    cache=cache,
+                    cache_lock=cache_lock,
+                    raw_agf_content_bs=raw_agf_content_bs,
+                )
+                if cache_key is not None:
+                    agf_content_bs = convert_agf_to_png.decompress_agf_data(agf_content_bs)
+                    cache.put(cache_key, agf_content_bs)
+
+                convert_agf_to_png.write_agf_data_as_image(
+                    agf_content_bs=agf_content_bs,
+                    output_filepath=output_filepath,
+                    encoder=export_config['encoder'],
+                    profile=export_config['profile'],
+                    buffer_pool=buffer_pool,
+                    thumbnail_size=export_config['thumbnail_size'],
+                )
+                status_list.append((alf_filepath, archive_index, None))
+            except Exception:
+                status_list.append((alf_filepath, archive_index, traceback.format_exc()))
+    finally:
+        if alf_reader is not None:
+            alf_reader.infile.close()
+
+    return status_list, get_worker_counter_dict(cache, start_worker_counter_dict), take_cache_usage_list(cache), take_dedup_result(dedup_state)
+
+
+def write_contact_sheet_page_in_worker(
+    alf_filepath: str,
+    page_info: dict,
+):
+    # runs in a worker process, see create_contact_sheet_page_list
+    # returns the same as unpack_archive_entry_shard
+    export_config = worker_export_config
+    cache = export_config['cache']
+    start_worker_counter_dict = get_worker_counter_dict(cache)
+    page_status_list = write_contact_sheet_page(alf_filepath, page_info, export_config, threading.Lock())
+    status_list = [(alf_filepath, archive_index, stack_trace) for archive_index, stack_trace in page_status_list]
+    return status_list, get_worker_counter_dict(cache, start_worker_counter_dict), take_cache_usage_list(cache), None
+
+
+def create_archive_entry_task_list(
+    log_list: list,
+    export_config: dict,
+):
+    # returns (task_list, number_of_skipped_entries)
+    # one (alf_filepath, archive_index, archive_info, output_filepath) task per AGF entry to unpack
+    # or with --contact-sheet one (alf_filepath, page_info) task per page
+    task_list = []
+    number_of_skipped_entries = 0
+    for metadata_info in log_list:
+        metadata_filepath = metadata_info['path']
+        metadata_parent = os.path.dirname(metadata_filepath)
+        alf_filename_list = [entry['name'].decode('ascii') for entry in metadata_info['alf_file_info_list']]
+
+        for alf_filename_index, alf_filename in enumerate(alf_filename_list):
+            archive_list = metadata_store.get_alf_archive_entry_info_list(metadata_info, alf_filename_index)
+            export_dir = get_alf_export_dir(metadata_parent, alf_filename, export_config['destination'])
+            if export_dir is None:
+                number_of_skipped_entries += len(archive_list)
+                continue
+
+            alf_filepath = os.path.join(metadata_parent, alf_filename)
+            child_export_config = dict(export_config, destination=export_dir)
+            if export_config['contact_sheet']:
+                page_list = create_contact_sheet_page_list(archive_list, child_export_config)
+                number_of_skipped_entries += len(archive_list) - sum(len(page_info['entry_list']) for page_info in page_list)
+                task_list.extend((alf_filepath, page_info) for page_info in page_list)
+                continue
+
+            for archive_index, archive_info in enumerate(archive_list):
+                output_filepath = get_archive_entry_output_filepath(archive_info, child_export_config)
+                if output_filepath is None:
+                    number_of_skipped_entries += 1
+                    continue
+
+                task_list.append((alf_filepath, archive_index, archive_info, output_filepath))
+
+    return task_list, number_of_skipped_entries
+
+
+def create_archive_entry_shard_list(
+    task_list: list,
+    number_of_shards: int,
+):
+    # greedy balancing: the largest entries first, each one goes to the shard
+    # with the smallest total compressed length so far
+    number_of_shards = max(1, min(number_of_shards, len(task_list)))
+    shard_heap = [(0, shard_index) for shard_index in range(number_of_shards)]
+    shard_list = [[] for _ in range(number_of_shards)]
+    for task in sorted(task_list, key=lambda task: task[2]['length'], reverse=True):
+        shard_length, shard_index = heapq.heappop(shard_heap)
+        shard_list[shard_index].append(task)
+        heapq.heappush(shard_heap, (shard_length + task[2]['length'], shard_index))
+
+    # read each ALF file front to back inside a shard
+    for shard in shard_list:
+        shard.sort(key=lambda task: (task[0], task[2]['offset']))
+
+    return [shard for shard in shard_list if len(shard) > 0]
+
+
+def unpack_with_process_pool(
+    log_list: list,
+    export_config: dict,
+    cache_config: dict,
+    jobs: int,
+):
+    task_list, number_of_skipped_entries = create_archive_entry_task_list(log_list, export_config)
+    print('len(task_list)', len(task_list))
+    print('number_of_skipped_entries', number_of_skipped_entries)
+
+    # (function, arguments, number of entries) of every worker task
+    if export_config['contact_sheet']:
+        # one contact sheet page per task, the pages hold the same number of entries
+        worker_task_list = [
+            (write_contact_sheet_page_in_worker, (alf_filepath, page_info), len(page_info['entry_list']))
+            for alf_filepath, page_info in task_list
+        ]
+        number_of_entries = sum(worker_task[2] for worker_task in worker_task_list)
+    else:
+        shard_list = create_archive_entry_shard_list(task_list, jobs * SHARDS_PER_JOB)
+        print('len(shard_list)', len(shard_list))
+        worker_task_list = [(unpack_archive_entry_shard, (shard,), len(shard)) for shard in shard_list]
+        number_of_entries = len(task_list)
+
+    # the workers build their own cache object that never removes files, the
+    # parent applies the cache files they used to its own so the directory
+    # stays under the size limit with any number of workers
+    # the workers find the duplicates with a shared output_dict, the parent
+    # links them after the pool when every first copy has been written
+    worker_config = dict(export_config, cache=None, dedup_state=None)
+    cache = None
+    if cache_config is not None:
+        cache = section_cache.DecodedSectionCache(**cache_config)
+
+    dedup_state = export_config['dedup_state']
+    dedup_manager = None
+    dedup_output_dict = None
+    if dedup_state is not None:
+        # a server process holding output_dict for the workers
+        dedup_manager = multiprocessing.Manager()
+        dedup_output_dict = dedup_manager.dict()
+
+    enlighten_counter = enlighten.Counter(total=number_of_entries)
+    number_of_errors = 0
+    worker_counter_dict = collections.Counter()
+    with concurrent.futures.ProcessPoolExecutor(
+        max_workers=jobs,
+        initializer=init_shard_worker,
+        initargs=(worker_config, cache_config, dedup_output_dict),
+    ) as executor:
+        future_dict = {
+            executor.submit(worker_function, *worker_args): task_number_of_entries
+            for worker_function, worker_args, task_number_of_entries in worker_task_list
+        }
+
+        for future in concurrent.futures.as_completed(future_dict):
+            task_number_of_entries = future_dict[future]
+            try:
+                status_list, task_worker_counter_dict, cache_usage_list, dedup_result = future.result()
+            except Exception as ex:
+                stack_trace = traceback.format_exc()
+                print(f'{shared.FG_RED}ERROR: Error occurs while processing a task of {task_number_of_entries} entries{shared.RESET_COLOR}')
+                print(stack_trace)
+                print(ex)
+                number_of_errors += task_number_of_entries
+                enlighten_counter.update(task_number_of_entries)
+                continue
+
+            worker_counter_dict.update(task_worker_counter_dict)
+            if cache is not None:
+                cache.add_usage_list(cache_usage_list)
+            if dedup_result is not None:
+                for key in ['unique_entries', 'duplicate_entries', 'duplicate_input_bytes']:
+                    dedup_state[key] += dedup_result[key]
+                dedup_state['duplicate_list'].extend(dedup_result['duplicate_list'])
+            for alf_filepath, archive_index, stack_trace in status_list:
+                if stack_trace is not None:
+                    number_of_errors += 1
+                    print(f'{shared.FG_RED}ERROR: Error occurs while processing archive_info index {archive_index} of {alf_filepath}{shared.RESET_COLOR}')
+                    print(stack_trace)
+
+            enlighten_counter.update(len(status_list))
+
+    print('number_of_errors', number_of_errors)
+    if cache is not None:
+        # scan the directory again, the files of failed tasks were never reported
+        cache = section_cache.DecodedSectionCache(**cache_config)
+        cache.evict()
+        cache_summary = cache.summary()
+        cache_summary.update({key: worker_counter_dict[key] for key in ['hit_count', 'miss_count', 'hit_bytes']})
+        print('cache', cache_summary)
+
+    if dedup_manager is not None:
+        dedup_manager.shutdown()
+
+    if dedup_state is not None:
+        link_duplicate_outputs(dedup_state, export_config['dedup'])
+        dedup_state['cpu_seconds'] += worker_counter_dict['cpu_seconds']
+        print('dedup', get_dedup_summary(dedup_state))
+
+
 def main():
     parser = argparse.ArgumentParser(description='Unpack all images from a pickle metadata file log.')
-    parser.add_argument('inpath', help='path to the pickle log')
+    parser.add_argument('inpath', help='path to the metadata store or pickle log from process_metadata_file.py')
     parser.add_argument('outpath', nargs='?', default='sameasinput', help='path to the output directory')
-    parser.add_argument('--output-format', default='png', choices=IMAGE_OUTPUT_FORMAT_LIST, help='output format')
+    parser.add_argument('--output-format', default=None, choices=IMAGE_OUTPUT_FORMAT_LIST, help='output format (default: the format of --encoder or png)')
+    parser.add_argument('--encoder', default=None, choices=convert_agf_to_png.ENCODER_LIST, help=f'image encoder (default: {convert_agf_to_png.DEFAULT_ENCODER_DICT})')
+    parser.add_argument('--profile', default=None, choices=convert_agf_to_png.PROFILE_LIST, help=f'encoding speed / file size trade-off (default: {convert_agf_to_png.PROFILE_FAST} for thumbnails and contact sheets, otherwise {convert_agf_to_png.DEFAULT_PROFILE})')
+    parser.add_argument('--thumbnail', type=int, default=None, metavar='MAX_EDGE', help=f'write previews shrunk to at most MAX_EDGE pixels (area averaging) named *{THUMBNAIL_FILENAME_SUFFIX}.<format> instead of the full size images')
+    parser.add_argument('--contact-sheet', action='store_true', help=f'write pages of labeled thumbnails (*{CONTACT_SHEET_FILENAME_SUFFIX}-NNNN.<format>) per ALF file instead of one file per image, the tiles are --thumbnail pixels (default: {DEFAULT_CONTACT_SHEET_THUMBNAIL_SIZE})')
+    parser.add_argument('--contact-sheet-columns', type=int, default=8, help='number of thumbnails per contact sheet row')
+    parser.add_argument('--contact-sheet-rows', type=int, default=8, help='number of thumbnail rows per contact sheet page')
+    parser.add_argument('--dedup', default=None, choices=shared.LINK_MODE_LIST, help='decode entries with the same raw bytes (e.g. in DATA*.ALF and APPEND*.ALF) once and hardlink / reflink / copy the output for the others (not used with --contact-sheet)')
     parser.add_argument('--force', action='store_true', help='overwrite existing files')
+    parser.add_argument('--jobs', type=int, default=1, help='number of worker processes, with more than 1 the entries of all ALF files are split between processes (balanced by compressed length) and --decode-workers / --encode-workers are not used')
+    parser.add_argument('--decode-workers', type=int, default=DEFAULT_DECODE_WORKERS, help='number of threads decoding the AGF entries')
+    parser.add_argument('--encode-workers', type=int, default=DEFAULT_ENCODE_WORKERS, help='number of threads encoding and writing the images')
+    parser.add_argument('--read-gap', type=int, default=shared.DEFAULT_READ_GAP // 1024, help='entries of an ALF file at most this many KiB apart are read together')
+    parser.add_argument('--read-chunk-size', type=int, default=shared.DEFAULT_READ_CHUNK_SIZE // (1024 * 1024), help='maximum size in MiB of one read of several entries (0 to read every entry on its own)')
+    parser.add_argument('--cache-dir', default=None, help='keep decoded LZSS sections in this directory so later runs can skip decoding')
+    parser.add_argument('--cache-size', type=int, default=4096, help='maximum size of the cache directory in MiB (least recently used entries are removed first)')
+    parser.add_argument('--cache-key', default=section_cache.CACHE_KEY_MODE_MTIME, choices=section_cache.CACHE_KEY_MODE_LIST, help='identify cached entries by ALF path + offset + mtime or by a hash of the raw entry')
 
     args = parser.parse_args()
     print('args', args)
@@ -171,7 +955,7 @@ def main():
     outpath = args.outpath
 
     if not os.path.exists(pickle_filepath):
-        print(f'{shared.FG_RED}ERROR: Pickle file does not exist: {pickle_filepath}{shared.RESET_COLOR}')
+        print(f'{shared.FG_RED}ERROR: Metadata file does not exist: {pickle_filepath}{shared.RESET_COLOR}')
         return
 
     if outpath != 'sameasinput':
@@ -185,17 +969,73 @@ def main():
                 print(ex)
                 return
 
+    try:
+        encoder = convert_agf_to_png.resolve_encoder(args.output_format, args.encoder)
+    except Exception as ex:
+        print(f'{shared.FG_RED}ERROR: {ex}{shared.RESET_COLOR}')
+        return
+
+    cache_config = None
+    if args.cache_dir is not None:
+        cache_config = {
+            'cache_dir': args.cache_dir,
+            'max_size': args.cache_size * 1024 * 1024,
+            'key_mode': args.cache_key,
+        }
+
+    thumbnail_size = args.thumbnail
+    if args.contact_sheet and thumbnail_size is None:
+        thumbnail_size = DEFAULT_CONTACT_SHEET_THUMBNAIL_SIZE
+    if thumbnail_size is not None and thumbnail_size < 1:
+        print(f'{shared.FG_RED}ERROR: --thumbnail must be at least 1 pixel - {thumbnail_size}{shared.RESET_COLOR}')
+        return
+
+    profile = args.profile
+    if profile is None:
+        # previews are for browsing, encoding speed matters more than size
+        profile = convert_agf_to_png.PROFILE_FAST if thumbnail_size is not None else convert_agf_to_png.DEFAULT_PROFILE
+
     EXPORT_CONFIG = {
-        'format': args.output_format,
+        'format': convert_agf_to_png.ENCODER_CONFIG_DICT[encoder]['format'],
+        'encoder': encoder,
+        'profile': profile,
         'force': args.force,
         'destination': outpath,
+        'cache': None,
+        'decode_workers': max(1, args.decode_workers),
+        'encode_workers': max(1, args.encode_workers),
+        'thumbnail_size': thumbnail_size,
+        'contact_sheet': args.contact_sheet,
+        'contact_sheet_columns': max(1, args.contact_sheet_columns),
+        'contact_sheet_rows': max(1, args.contact_sheet_rows),
+        'dedup': args.dedup,
+        'dedup_state': None,
+        'read_gap': args.read_gap * 1024,
+        'read_chunk_size': args.read_chunk_size * 1024 * 1024,
     }
 
-    with open(pickle_filepath, mode='rb') as infile:
-        log_list = pickle.load(infile)
+    if args.dedup is not None and not args.contact_sheet:
+        EXPORT_CONFIG['dedup_state'] = create_dedup_state()
+
+    log_list = metadata_store.load_metadata_file_list(pickle_filepath)
+
+    if args.jobs > 1:
+        unpack_with_process_pool(
+            log_list=log_list,
+            export_config=EXPORT_CONFIG,
+            cache_config=cache_config,
+            jobs=args.jobs,
+        )
+        return
+
+    cache = None
+    if cache_config is not None:
+        cache = section_cache.DecodedSectionCache(**cache_config)
+        EXPORT_CONFIG['cache'] = cache
 
     number_of_metadata_logs = len(log_list)
     enlighten_counter = enlighten.Counter(total=number_of_metadata_logs)
+    start_cpu_seconds = time.process_time()
 
     for log_index in range(number_of_metadata_logs):
         try:
@@ -218,6 +1058,14 @@ def main():
 
         enlighten_counter.update()
 
+    if cache is not None:
+        print('cache', cache.summary())
+
+    dedup_state = EXPORT_CONFIG['dedup_state']
+    if dedup_state is not None:
+        dedup_state['cpu_seconds'] = time.process_time() - start_cpu_seconds
+        print('dedup', get_dedup_summary(dedup_state))
+
 
 if __name__ == '__main__':
     main()